@@ -1,23 +1,35 @@
 import json
 import os
 import pickle
-import shutil
 import threading
 import time
 from datetime import datetime
-from telnetlib import Telnet
-from collections import deque
 import math
 
-from flask import Flask, jsonify, render_template, request
-from flask_socketio import SocketIO
+from flask import Flask, Response, abort, jsonify, render_template, request, send_file, url_for
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from markupsafe import escape
 import markupsafe
 
+import OmronVTInterfaceModule.ovtimassets
 import OmronVTInterfaceModule.ovtimconfig
+import OmronVTInterfaceModule.ovtimdiscovery
 import OmronVTInterfaceModule.ovtimfunctions
+import OmronVTInterfaceModule.ovtimhistory
+import OmronVTInterfaceModule.ovtimhub
+import OmronVTInterfaceModule.ovtimingest
+import OmronVTInterfaceModule.ovtimingestclient
+import OmronVTInterfaceModule.ovtimjournal
+import OmronVTInterfaceModule.ovtimlogging
+import OmronVTInterfaceModule.ovtimmetrics
+import OmronVTInterfaceModule.ovtimnotify
+import OmronVTInterfaceModule.ovtimpipeline
+import OmronVTInterfaceModule.ovtimprobe
+import OmronVTInterfaceModule.ovtimstartup
+import OmronVTInterfaceModule.ovtimstore
 
 # gunicorn -w 1 -b 127.0.0.1:5000 --threads 100 "OmronVTInterfaceModule:app"
+# with the ingest daemon running (KARLBOX_INGEST_MODE=daemon, see ovtimdaemon) gunicorn can run several workers
 """
 scanner reads a barcode
     python code reads barcode from scanner
@@ -58,43 +70,203 @@ def create_app(test_config=None):
         os.makedirs(app.instance_path)
     except OSError:
         pass
+
+    # fingerprinted assets built by ovtimassetbuild; the templates load every stylesheet, script and webfont through asset_url()
+    assetManifest = OmronVTInterfaceModule.ovtimassets.AssetManifest(app.static_folder, enabled=OmronVTInterfaceModule.ovtimconfig.assetMode == 'built')
+
+    # a built asset's name changes with its content, so browsers may keep it forever; the precompressed variant
+    # matching the browser's Accept-Encoding is sent as is
+    @app.route('/static/dist/<path:filename>')
+    def builtasset(filename):
+        found = assetManifest.lookup(OmronVTInterfaceModule.ovtimassets.DIST_DIRECTORY + '/' + filename, request.headers.get('Accept-Encoding', ''))
+        if found is None:
+            abort(404)
+        path, encoding, etag, mimetype = found
+        headers = {'ETag': etag, 'Cache-Control': OmronVTInterfaceModule.ovtimassets.CACHE_CONTROL, 'Vary': 'Accept-Encoding'}
+        if etag in request.headers.get('If-None-Match', ''):
+            return Response(status=304, headers=headers)
+        response = send_file(path, mimetype=mimetype, conditional=False, etag=False, max_age=None)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.headers.update(headers)
+        return response
     
     # initialize webapp and barcode logging
-    app.logger = OmronVTInterfaceModule.ovtimfunctions.initLogging(app.instance_path, OmronVTInterfaceModule.ovtimconfig.logConfigWebapp)
-    barcodeLogger = OmronVTInterfaceModule.ovtimfunctions.initLogging(app.instance_path, OmronVTInterfaceModule.ovtimconfig.logConfigBarcode)
+    # (in daemon mode the records of every worker are written by the ingest daemon, the only process rotating the files)
+    forwardLogs = OmronVTInterfaceModule.ovtimconfig.ingestMode == 'daemon'
+    app.logger = OmronVTInterfaceModule.ovtimfunctions.initLogging(app.instance_path, OmronVTInterfaceModule.ovtimconfig.logConfigWebapp, forwardLogs)
+    barcodeLogger = OmronVTInterfaceModule.ovtimfunctions.initLogging(app.instance_path, OmronVTInterfaceModule.ovtimconfig.logConfigBarcode, forwardLogs)
+    OmronVTInterfaceModule.ovtimlogging.logPipeline.reportLogger = app.logger
+    OmronVTInterfaceModule.ovtimlogging.logCompressor.reportLogger = app.logger
+    # every phase of the start is logged with the seconds since the process started (see ovtimstartup)
+    startup = OmronVTInterfaceModule.ovtimstartup.StartupTimer(app.logger, 'webapp')
+    startup.mark('logging')
+    if assetManifest.isBuilt():
+        app.logger.info('Serving %s built static asset(s) from %s', len(assetManifest.assets), OmronVTInterfaceModule.ovtimassets.DIST_DIRECTORY)
 
     OmronVTInterfaceModule.ovtimconfig.karlboxConfigFilePath = os.path.join(app.instance_path, 'static', OmronVTInterfaceModule.ovtimconfig.karlboxConfigFilePath)
+    OmronVTInterfaceModule.ovtimconfig.karlboxStoreFilePath = os.path.join(app.instance_path, 'data', OmronVTInterfaceModule.ovtimconfig.karlboxStoreFilePath)
+
+    # profiles are kept in an SQLite store; the json config file is imported the first time the store is created
+    profileStore = OmronVTInterfaceModule.ovtimstore.ProfileStore(OmronVTInterfaceModule.ovtimconfig.karlboxStoreFilePath, OmronVTInterfaceModule.ovtimconfig.scannerPositions, OmronVTInterfaceModule.ovtimconfig.storeHistoryDepth)
+    if profileStore.importJson(OmronVTInterfaceModule.ovtimconfig.karlboxConfigFilePath):
+        app.logger.info('Imported profiles from %s into %s', OmronVTInterfaceModule.ovtimconfig.karlboxConfigFilePath, OmronVTInterfaceModule.ovtimconfig.karlboxStoreFilePath)
+    startup.mark('profiles')
+
+    # counters and latency histograms of the scanner pipeline, exported by /metrics
+    metrics = OmronVTInterfaceModule.ovtimmetrics.metrics
+
+    # scanner ingest and serial output run in this process, or in the ingest daemon which every gunicorn worker connects to
+    ingestMode = OmronVTInterfaceModule.ovtimconfig.ingestMode
+    if ingestMode not in ('inprocess', 'daemon'):
+        raise ValueError('unknown ingest mode: ' + str(ingestMode))
+
+    # every barcode read (including duplicates and reads ignored because they came too soon) is appended to the barcode journal
+    # (by the ingest daemon in daemon mode; the webapp maps its segments read only to answer queries)
+    barcodeJournal = OmronVTInterfaceModule.ovtimjournal.BarcodeJournal(os.path.join(app.instance_path, OmronVTInterfaceModule.ovtimconfig.journalDirectory), OmronVTInterfaceModule.ovtimconfig.journalSegmentCapacity, OmronVTInterfaceModule.ovtimconfig.journalRetentionDays, readOnly=ingestMode == 'daemon')
 
     # index page
     @app.route('/')
     def index():
-        configData = OmronVTInterfaceModule.ovtimfunctions.readConfig(app.logger, OmronVTInterfaceModule.ovtimconfig.karlboxConfigFilePath, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues)
+        configData = OmronVTInterfaceModule.ovtimfunctions.readConfig(app.logger, profileStore, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues)
         #print(configData)
         dictActiveProfile = configData[1][configData[2]]
         activeProfile = configData[2]
-        app.logger.debug('{0}|{1}'.format(request.remote_addr, request.url))
+        app.logger.debug('%s|%s', request.remote_addr, request.url)
         return render_template('index.html', dictActiveProfile = dictActiveProfile, activeProfile = activeProfile)
 
     # create, change, or delete scanner profiles
     @app.route('/managescanners')
     def managescanners():
-        configData = OmronVTInterfaceModule.ovtimfunctions.readConfig(app.logger, OmronVTInterfaceModule.ovtimconfig.karlboxConfigFilePath, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues)
+        configData = OmronVTInterfaceModule.ovtimfunctions.readConfig(app.logger, profileStore, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues)
         dictProfiles = configData[1]
         activeProfile = configData[2]
-        app.logger.debug('{0} requested {1}'.format(request.remote_addr, request.url))
-        return render_template('managescanners.html', jsonString = json.dumps(json.load(open(OmronVTInterfaceModule.ovtimconfig.karlboxConfigFilePath, 'r'))), activeProfile = activeProfile, dictProfiles = dictProfiles, karlboxConfigFilePath = OmronVTInterfaceModule.ovtimconfig.karlboxConfigFilePath)
+        app.logger.debug('%s requested %s', request.remote_addr, request.url)
+        # keep the scanner inventory warm while the page is used, so the Auto buttons answer right away
+        scannerDiscovery.start(socketio.start_background_task)
+        return render_template('managescanners.html', jsonString = OmronVTInterfaceModule.ovtimfunctions.readConfigJson(app.logger, profileStore, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues), activeProfile = activeProfile, dictProfiles = dictProfiles, karlboxConfigFilePath = OmronVTInterfaceModule.ovtimconfig.karlboxStoreFilePath)
+
+    # current config (same layout as karlboxconfig.json), used by the manage scanners page
+    @app.route('/karlboxconfig.json')
+    def karlboxconfig():
+        return app.response_class(OmronVTInterfaceModule.ovtimfunctions.readConfigJson(app.logger, profileStore, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues), mimetype='application/json')
+
+    # probes every ethernet scanner of every profile; results are streamed as one json object per line, in order of completion
+    @app.route('/scanners/probe')
+    def scannerprobe():
+        configData = OmronVTInterfaceModule.ovtimfunctions.readConfig(app.logger, profileStore, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues)
+        scanners = OmronVTInterfaceModule.ovtimfunctions.getEthernetScanners(configData[1])
+        app.logger.debug('%s requested %s', request.remote_addr, request.url)
+        def generate():
+            for result in scannerProber.probeAll(scanners.keys()):
+                result['profiles'] = scanners[(result['ip'], result['port'])]
+                yield json.dumps(result) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    # scanners found by the discovery service, most recently seen first
+    @app.route('/scanners/discovered')
+    def scannerdiscovered():
+        scannerDiscovery.start(socketio.start_background_task)
+        try:
+            return jsonify(scannerDiscovery.getDevices())
+        except OSError as e:
+            return jsonify({'error': str(e)}), 503
+
+    # scanner endpoints with their subscriber count and connection state
+    @app.route('/status/scanners')
+    def scannerstatus():
+        return jsonify(scannerHub.summary())
+
+    # notification batching counters
+    @app.route('/status/notifications')
+    def notificationstatus():
+        return jsonify(scannerNotifier.getStats())
+
+    # pipeline metrics in the Prometheus text format (including the ones counted by the ingest daemon)
+    @app.route('/metrics')
+    def metricsexport():
+        try:
+            extra = scannerPipeline.collectMetrics()
+        except OSError as e:
+            app.logger.warning('Metrics of the ingest daemon not available: %s', e)
+            extra = None
+        return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+    # queue depth and counters of the inspection machine output and of every output of the active profile
+    @app.route('/status/outputs')
+    def outputstatus():
+        try:
+            return jsonify(scannerPipeline.getOutputStats())
+        except OSError as e:
+            return jsonify({'error': str(e)}), 503
+
+    # phases of the start of the webapp (and of the ingest daemon in daemon mode), in seconds since the process started
+    @app.route('/status/startup')
+    def startupstatus():
+        result = [startup.getStats()]
+        if ingestMode == 'daemon':
+            try:
+                result.append(scannerPipeline.getStartupStats())
+            except OSError as e:
+                result.append({'process': 'ingest daemon', 'error': str(e)})
+        return jsonify(result)
+
+    # logging pipeline queue depth and counters, bytes written per hour and compression of the rotated logs
+    # (in daemon mode the files are written by the ingest daemon, whose statistics are under 'daemon')
+    @app.route('/status/logging')
+    def loggingstatus():
+        result = OmronVTInterfaceModule.ovtimlogging.logPipeline.getStats()
+        if ingestMode == 'daemon':
+            try:
+                result['daemon'] = scannerPipeline.getLoggingStats()
+            except OSError as e:
+                result['daemon'] = {'error': str(e)}
+        return jsonify(result)
+
+    # barcodes read between start and end (seconds since the epoch or local ISO 8601 time), optionally only from one scanner (ip or ip:port)
+    # results are streamed as one json object per line
+    @app.route('/barcodes/query')
+    def barcodequery():
+        try:
+            start = OmronVTInterfaceModule.ovtimjournal.parseTime(request.args.get('start', '0'))
+            end = OmronVTInterfaceModule.ovtimjournal.parseTime(request.args['end']) if 'end' in request.args else time.time_ns() + 1
+            limit = int(request.args['limit']) if 'limit' in request.args else None
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        scanner = request.args.get('scanner')
+        app.logger.debug('%s requested %s', request.remote_addr, request.url)
+        def generate():
+            for entry in barcodeJournal.query(start, end, scanner, limit):
+                entry['timestamp'] = datetime.fromtimestamp(entry['wall'] / 1e9).strftime('%m/%d/%Y %H:%M:%S.%f')[:-3]
+                entry['flags'] = OmronVTInterfaceModule.ovtimjournal.flagNames(entry['flags'])
+                yield json.dumps(entry) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    # barcodes recently read by one scanner, paged by sequence number: ?ip=&port=[&after=seq | &before=seq][&limit=100]
+    # without ip and port, lists the scanners which have a history
+    @app.route('/barcodes/history')
+    def barcodehistory():
+        if 'ip' not in request.args:
+            return jsonify(scannerPipeline.historySummary())
+        try:
+            page = scannerPipeline.historyPage(request.args['ip'] + ':' + request.args.get('port', ''), request.args.get('after'), request.args.get('before'), request.args.get('limit', 100))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if page is None:
+            return jsonify({'error': 'no barcode history for this scanner'}), 404
+        return jsonify(page)
 
     # display quick start guide and helpful resources
     @app.route('/help')
     def help():
-        app.logger.debug('{0} requested {1}'.format(request.remote_addr, request.url))
+        app.logger.debug('%s requested %s', request.remote_addr, request.url)
         return render_template('help.html')
 
     # "main application" which shows weblink, reads input barcodes and outputs to inspection machine
     @app.route('/displayweblink', methods=['GET'])
     def displayweblink():
-        OmronVTInterfaceModule.ovtimfunctions.readConfig(app.logger, OmronVTInterfaceModule.ovtimconfig.karlboxConfigFilePath, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues)
-        app.logger.debug('{0} requested {1}'.format(request.remote_addr, request.url))
+        OmronVTInterfaceModule.ovtimfunctions.readConfig(app.logger, profileStore, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues)
+        app.logger.debug('%s requested %s', request.remote_addr, request.url)
         if 'scanner1ip' in request.args.keys():
             scanner1ip = request.args['scanner1ip']
             if 'scanner1port' in request.args.keys():
@@ -118,183 +290,196 @@ def create_app(test_config=None):
     def utility_processor():
         def writeWebLog(logcontent, loglevel='DEBUG'):
             if loglevel == 'DEBUG':
-                app.logger.debug('{0}|{1}| {2}'.format(request.remote_addr, request.url, logcontent))
+                app.logger.debug('%s|%s| %s', request.remote_addr, request.url, logcontent)
             elif loglevel == 'INFO':
-                app.logger.info('{0}|{1}| {2}'.format(request.remote_addr, request.url, logcontent))
+                app.logger.info('%s|%s| %s', request.remote_addr, request.url, logcontent)
             elif loglevel == 'ERROR':
-                app.logger.error('{0}|{1}| {2}'.format(request.remote_addr, request.url, logcontent))
+                app.logger.error('%s|%s| %s', request.remote_addr, request.url, logcontent)
             return
         def writeBarcodeLog(logcontent, loglevel='INFO'):
             if loglevel == 'DEBUG':
-                barcodeLogger.debug('{0}|{1}| {2}'.format(request.remote_addr, request.url, logcontent))
+                barcodeLogger.debug('%s|%s| %s', request.remote_addr, request.url, logcontent)
             elif loglevel == 'INFO':
-                barcodeLogger.info('{0}|{1}| {2}'.format(request.remote_addr, request.url, logcontent))
+                barcodeLogger.info('%s|%s| %s', request.remote_addr, request.url, logcontent)
             elif loglevel == 'ERROR':
-                barcodeLogger.error('{0}|{1}| {2}'.format(request.remote_addr, request.url, logcontent))
+                barcodeLogger.error('%s|%s| %s', request.remote_addr, request.url, logcontent)
             return
-        return dict(writeWebLog=writeWebLog, writeBarcodeLog=writeBarcodeLog)
+        def asset_url(filename):
+            return url_for('static', filename=assetManifest.url(filename))
+        return dict(writeWebLog=writeWebLog, writeBarcodeLog=writeBarcodeLog, asset_url=asset_url, socketioOptions={'transports': OmronVTInterfaceModule.ovtimconfig.socketioTransports})
         
+    # finds scanners on every local subnet in the background
+    # (in daemon mode the ingest daemon does, see the DaemonClient below; one listener sees every reply)
+    if ingestMode != 'daemon':
+        scannerDiscovery = OmronVTInterfaceModule.ovtimdiscovery.DiscoveryService(app.logger, interval=OmronVTInterfaceModule.ovtimconfig.discoveryInterval, forgetTime=OmronVTInterfaceModule.ovtimconfig.discoveryForgetTime, extraAddresses=OmronVTInterfaceModule.ovtimconfig.discoveryExtraAddresses)
+
+    # probes scanner reachability concurrently; results are cached for a few seconds
+    scannerProber = OmronVTInterfaceModule.ovtimprobe.ProbeService(app.logger, maxWorkers=OmronVTInterfaceModule.ovtimconfig.probeWorkers, timeout=OmronVTInterfaceModule.ovtimconfig.probeTimeout, ttl=OmronVTInterfaceModule.ovtimconfig.probeCacheTime)
+
     # used to determine if scanner is accessible via the IP and port provided as arguments
+    # the result is sent to the requesting browser as 'Event_isScannerConnectedLanResult' when the probe completes
     @socketio.on('Event_isScannerConnectedLan')
     def isScannerConnectedLan(ip, port):
-        app.logger.debug('Testing if scanner is connected via LAN: ' + str(ip) + ':' + str(port))
-        t = threading.Thread(target=OmronVTInterfaceModule.ovtimfunctions.testTelnetConn, args=(str(ip), int(port), OmronVTInterfaceModule.ovtimconfig.testLAN, app.logger))
-        t.setDaemon(True)
-        OmronVTInterfaceModule.ovtimconfig.testLAN[t.name] = 0
-        t.start()
-        startTimer = time.time()
-        while OmronVTInterfaceModule.ovtimconfig.testLAN[t.name] == 0:
-            if time.time() - startTimer > 5: # timeout 5 seconds
-                app.logger.debug('Scanner (' + str(ip) + ':' + str(port) + ') not connected via LAN- connection timed out after 5 seconds')
-                socketio.emit('Event_isScannerConnectedLanResult', {'ip': ip, 'port': port, 'result': 'fail'})
-                return
-        app.logger.debug('Scanner (' + str(ip) + ':' + str(port) + ') connected via LAN')
-        socketio.emit('Event_isScannerConnectedLanResult', {'ip': ip, 'port': port, 'result': 'success'})
-        OmronVTInterfaceModule.ovtimconfig.testLAN[t.name] = 0
-        return
+        app.logger.debug('Testing if scanner is connected via LAN: %s:%s', ip, port)
+        sid = request.sid
+        def sendResult(future):
+            result = future.result()
+            socketio.emit('Event_isScannerConnectedLanResult', {'ip': ip, 'port': port, 'result': result['result'], 'cached': result['cached']}, to=sid)
+        scannerProber.probe(str(ip), int(port)).add_done_callback(sendResult)
+
+    # probes every ethernet scanner of every profile at once
+    # each result is sent to the requesting browser as 'Event_probeResult' (result dict plus the profiles using the scanner) as soon as it completes,
+    # followed by 'Event_probeAllScannersDone'
+    @socketio.on('Event_probeAllScanners')
+    def probeAllScanners():
+        sid = request.sid
+        configData = OmronVTInterfaceModule.ovtimfunctions.readConfig(app.logger, profileStore, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues)
+        scanners = OmronVTInterfaceModule.ovtimfunctions.getEthernetScanners(configData[1])
+        def run():
+            startTime = time.monotonic()
+            for result in scannerProber.probeAll(scanners.keys()):
+                result['profiles'] = scanners[(result['ip'], result['port'])]
+                socketio.emit('Event_probeResult', result, to=sid)
+            socketio.emit('Event_probeAllScannersDone', {'count': len(scanners), 'ms': round((time.monotonic() - startTime) * 1000, 1)}, to=sid)
+        socketio.start_background_task(run)
 
     
 
-    # connects to scanner via LAN, then enters infinite loop to read data from scanner and pass along via 'Event_scannerNotification' event
+    # notifications of the scanner pipeline go to the browsers through scannerNotifier
+    def publishNotification(ip, port, event, readTime=None, **fields):
+        scannerNotifier.publish(ip, port, event, readTime=readTime, **fields)
+
+    if ingestMode == 'daemon':
+        # the ingest daemon reads the scanners, keeps the barcode histories and sends barcodes to the inspection machine
+        scannerPipeline = OmronVTInterfaceModule.ovtimingestclient.DaemonClient(OmronVTInterfaceModule.ovtimconfig.ingestSocketPath, publishNotification, app.logger, timeout=OmronVTInterfaceModule.ovtimconfig.ingestCallTimeout)
+        scannerPipeline.start(socketio.start_background_task)
+        OmronVTInterfaceModule.ovtimconfig.logConfigWebapp['loghandler'].send = scannerPipeline.sendLog
+        OmronVTInterfaceModule.ovtimconfig.logConfigBarcode['loghandler'].send = scannerPipeline.sendLog
+        scannerDiscovery = scannerPipeline.discovery
+    else:
+        # recent barcodes of every scanner, paged through by the kiosk with /barcodes/history or Event_getBarcodeHistory
+        barcodeHistories = OmronVTInterfaceModule.ovtimhistory.HistoryRegistry(OmronVTInterfaceModule.ovtimconfig.barcodeHistoryDepth)
+        # one ingest engine holds every scanner connection for this process, one output dispatcher sends every barcode to the inspection machine
+        scannerPipeline = OmronVTInterfaceModule.ovtimpipeline.ScannerPipeline(publishNotification, app.logger, barcodeLogger, barcodeJournal, barcodeHistories)
+    scannerIngest = scannerPipeline.ingest
+
+    # the hub shares one connection per scanner between every browser showing it
+    scannerHub = OmronVTInterfaceModule.ovtimhub.ScannerHub(scannerIngest, app.logger, lingerTime=OmronVTInterfaceModule.ovtimconfig.scannerLingerTime)
+
+    # scanner notifications are batched and sent to the rooms of the scanners they belong to
+    scannerNotifier = OmronVTInterfaceModule.ovtimnotify.NotificationFanout(socketio, scannerHub, window=OmronVTInterfaceModule.ovtimconfig.notificationWindow)
+    startup.mark('pipeline')
+
+    # the active profile's scanners and the serial output are started right away instead of when the kiosk's page asks for them;
+    # the page only subscribes to their notifications (in daemon mode the ingest daemon starts them)
+    autoStart = None
+    if ingestMode == 'inprocess' and OmronVTInterfaceModule.ovtimconfig.autoStart:
+        autoStart = OmronVTInterfaceModule.ovtimstartup.AutoStarter(scannerPipeline, scannerHub, app.logger, startup, readyTimeout=OmronVTInterfaceModule.ovtimconfig.startupReadyTimeout)
+        configData = OmronVTInterfaceModule.ovtimfunctions.readConfig(app.logger, profileStore, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues)
+        scannerNotifier.start(socketio.start_background_task)
+        autoStart.apply(configData[1].get(configData[2], {}), socketio.start_background_task)
+        startup.mark('autostart')
+
+    # subscribes the browser to a scanner; the ingest engine reads data from the scanner and passes it along via 'Event_scannerNotifications' events to the scanner's room
+    # encoding 'msgpack' subscribes to msgpack encoded 'Event_scannerNotificationsPacked' events instead (if msgpack is installed)
     @socketio.on('Event_readDataFromLan')
-    def readDataFromLan(ip, port):
-        attemptNo = 1
-        while True:
-            app.logger.info('Establishing LAN connection with scanner to receive data: ' + str(ip) + ':' + str(port) + ' (this is attempt #' + str(attemptNo) + ' of 3)')
-            try:
-                tnclient = Telnet(str(ip), int(port), 5)
-                app.logger.info('LAN connection established with scanner: ' + str(ip) + ':' + str(port))
-                break
-            except Exception as e:
-                app.logger.error('Failed to establish LAN connection with scanner (' + str(ip) + ':' + str(port) + ') because of error: ' + str(e) + '. Retrying in 30 seconds (this was attempt #' + str(attemptNo) + ' of 3)')
-                if attemptNo > 2:
-                    socketio.emit('Event_scannerNotification', {'title': 'Failed to Establish Connection', 'ip':str(ip), 'port':str(port), 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S'), 'type': 'error', 'msg': 'Could not establish connection to scanner (Attempt #' + str(attemptNo) + ' of 3). Please ensure the scanner is plugged in, powered on, and settings have been configured in <a href="{{ url_for(\'managescanners\') }}">Manage Scanners</a>. Refresh the page to try again.'})
-                    return
-                else:
-                    socketio.emit('Event_scannerNotification', {'title': 'Failed to Establish Connection', 'ip':str(ip), 'port':str(port), 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S'), 'type': 'error_retry', 'msg': 'Could not establish connection to scanner (Attempt #' + str(attemptNo) + ' of 3). Waiting 30 seconds before retrying.'})
-                attemptNo += 1
-                time.sleep(30)
-                continue
-
-        while True:
-            time.sleep(0.5)
-            try:
-                rcvData = tnclient.read_until(b'\r\n', timeout=3)
-            except EOFError as e:
-                app.logger.warning('LAN connection reset for scanner (' + str(ip) + ':' + str(port) + ')')
-                socketio.emit('Event_scannerNotification', {'title': 'Connection Reset', 'ip':str(ip), 'port':str(port), 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S'), 'type': 'error', 'msg': 'The connection was reset. If you do not detect new barcodes, please refresh the page.'})
-                return
-            except Exception as e:
-                app.logger.error('LAN connection closed for scanner (' + str(ip) + ':' + str(port) + ') due to error: ' + str(e))
-                socketio.emit('Event_scannerNotification', {'title': 'Connection Error', 'ip':str(ip), 'port':str(port), 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S'), 'type': 'error', 'msg': 'Connection error: ' + str(e) + '. Please check the connection and refresh the web page.'})
-                return
-            if len(rcvData) > 1:
-
-                ### barcode handling logic:
-                # is this the first time seeing the scanner?
-                #   yes -> initialize variables, set initial timer to a value that ensures it will get read
-                # has it been at least 30 seconds since we last recorded a barcode from this scanner?
-                #   no -> Do not pass the barcode to the UI. Have we already logged it?
-                #       yes -> do nothing (do not log it)
-                #       no -> log a message saying the scanner scanned something before its time limit, and set a flag to prevent additional log messages
-                #   yes -> Clear any "too soon" scanner flags. Reset the 30 second timer. Is this the first barcode we've scanned?
-                #       yes -> append barcode+data to variable
-                #       no -> is the barcode the same as the previous scan?
-                #           yes -> update existing variable but dont append new one
-                #           no -> append barcode+data to variable
-
-                # convert raw barcode to a string with leading/trailing whitespace stripped and properly URL escaped
-                scannedBarcode = str(escape(rcvData.decode('ascii'))).strip()
-
-                # scannerData[ip address] = {'barcodes': deque, 'timer': time.time(), 'timerMsgFlag': 0}
-                # scannerData[ip]['barcodes'] = [{'barcode': str, 'timestamp': datetime}, {'barcode': str, 'timestamp': datetime}, etc]
-                scannerData = OmronVTInterfaceModule.ovtimconfig.scannerData
-                
-                if ip not in scannerData.keys():
-                    scannerData[ip] = {'barcodes': deque(maxlen=1), 'timer': time.time() - 1000, 'timerMsgFlag': 0}
-                    
-                if time.time() - scannerData[ip]['timer'] < OmronVTInterfaceModule.ovtimconfig.scannerTimelimit:
-                    if scannerData[ip]['timerMsgFlag'] == 0:
-                        barcodeLogger.info('Received barcode from scanner (' + str(ip) + ':' + str(port) + '), but scanner time limit hasnt been reached (' + str(round(time.time() - scannerData[ip]['timer'], 1)) + ' seconds elapsed out of ' + str(OmronVTInterfaceModule.ovtimconfig.scannerTimelimit) + '). Data will be ignored and future notifications are surpressed until the time limit has elapsed. (Barcode: ' + scannedBarcode + ')')
-                        scannerData[ip]['timerMsgFlag'] = 1
-                else:
-                    scannerData[ip]['timer'] = time.time()
-                    scannerData[ip]['timerMsgFlag'] = 0
-
-                    if len(scannerData[ip]['barcodes']) > 0:
-                        if scannerData[ip]['barcodes'][-1]['barcode'] == scannedBarcode:
-                            scannerData[ip]['barcodes'][-1] = {'barcode': scannedBarcode, 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S')}
-                            barcodeLogger.info('Received barcode from scanner (' + str(ip) + ':' + str(port) + '): ' + scannedBarcode + ' | (The barcode was a duplicate of the previously scanned barcode)')
-                            OmronVTInterfaceModule.ovtimconfig.currentBarcode = scannedBarcode
-                            OmronVTInterfaceModule.ovtimconfig.currentBarcodeTimestamp = time.time()
-                            socketio.emit('Event_scannerNotification', {'title': 'Barcode Read', 'ip':str(ip), 'port':str(port), 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S'), 'type': 'update', 'msg': 'Barcode read: ' + scannedBarcode, 'data': list(scannerData[ip]['barcodes'])})
-                        else:
-                            scannerData[ip]['barcodes'].append({'barcode': scannedBarcode, 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S')})
-                            barcodeLogger.info('[1]Received barcode from scanner (' + str(ip) + ':' + str(port) + '): ' + scannedBarcode)
-                            OmronVTInterfaceModule.ovtimconfig.currentBarcode = scannedBarcode
-                            OmronVTInterfaceModule.ovtimconfig.currentBarcodeTimestamp = time.time()
-                            socketio.emit('Event_scannerNotification', {'title': 'Barcode Read', 'ip':str(ip), 'port':str(port), 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S'), 'type': 'info', 'msg': 'Barcode read: ' + scannedBarcode, 'data': list(scannerData[ip]['barcodes'])})
-                    else:
-                        scannerData[ip]['barcodes'].append({'barcode': scannedBarcode, 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S')})
-                        barcodeLogger.info('[2]Received barcode from scanner (' + str(ip) + ':' + str(port) + '): ' + scannedBarcode)
-                        OmronVTInterfaceModule.ovtimconfig.currentBarcode = scannedBarcode
-                        OmronVTInterfaceModule.ovtimconfig.currentBarcodeTimestamp = time.time()
-                        socketio.emit('Event_scannerNotification', {'title': 'Barcode Read', 'ip':str(ip), 'port':str(port), 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S'), 'type': 'info', 'msg': 'Barcode read: ' + scannedBarcode, 'data': list(scannerData[ip]['barcodes'])})
+    def readDataFromLan(ip, port, encoding='json'):
+        if encoding not in OmronVTInterfaceModule.ovtimnotify.getEncodings():
+            encoding = 'json'
+        configData = OmronVTInterfaceModule.ovtimfunctions.readConfig(app.logger, profileStore, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues)
+        # rs232 scanners of the profile are opened with its serial settings (ip is the serial port, port is 0)
+        framing, serialSettings = OmronVTInterfaceModule.ovtimfunctions.getScannerSettings(configData[1].get(configData[2], {}), str(ip), str(port))
+        scannerPipeline.setProfile(configData[1].get(configData[2], {}))
+        scannerPipeline.setHistoryDepth(str(ip) + ':' + str(port), OmronVTInterfaceModule.ovtimfunctions.getHistoryDepth(configData[1].get(configData[2], {})))
+        scannerPipeline.start(socketio.start_background_task)
+        scannerNotifier.start(socketio.start_background_task)
+        metrics.inc('karlbox_scanner_subscriptions_total', (str(ip) + ':' + str(port),))
+        join_room(scannerHub.subscribe(request.sid, str(ip), int(port), framing, encoding, serialSettings))
+
+    # stop receiving notifications from a scanner
+    @socketio.on('Event_stopDataFromLan')
+    def stopDataFromLan(ip, port):
+        leave_room(scannerHub.unsubscribe(request.sid, str(ip), int(port)))
+
+    @socketio.on('disconnect')
+    def disconnect(*args):
+        scannerHub.disconnect(request.sid)
             
-    # connects to the serial output device and sends it the last-read barcode
+    # gauges read when /metrics is requested
+    metrics.gauge('karlbox_scanner_connected', 'Scanner connection is established (1) or not (0)', lambda: [(('%s:%s' % key,), int(state == 'connected')) for key, state in scannerIngest.getStates().items()], ('scanner',))
+    metrics.gauge('karlbox_scanner_subscribers', 'Browsers subscribed to a scanner', lambda: [(('%s:%s' % (x['ip'], x['port']),), x['subscribers']) for x in scannerHub.summary()], ('scanner',))
+    metrics.gauge('karlbox_output_queue_length', 'Barcodes waiting to be sent to the inspection machine', lambda: [((), scannerPipeline.getOutputStats()['queued'])])
+    metrics.gauge('karlbox_output_dropped_total', 'Barcodes dropped because the output queue was full', lambda: [((), scannerPipeline.getOutputStats()['dropped'])], kind='counter')
+    metrics.gauge('karlbox_sink_queue_length', 'Barcodes waiting to be written to an output of the active profile', lambda: [((x['name'],), x['queued']) for x in scannerPipeline.getOutputStats()['outputs']], ('sink',))
+    metrics.gauge('karlbox_sink_sent_total', 'Barcodes written to an output of the active profile', lambda: [((x['name'],), x['sent']) for x in scannerPipeline.getOutputStats()['outputs']], ('sink',), kind='counter')
+    metrics.gauge('karlbox_sink_dropped_total', 'Barcodes dropped because the queue of an output was full', lambda: [((x['name'],), x['dropped']) for x in scannerPipeline.getOutputStats()['outputs']], ('sink',), kind='counter')
+    metrics.gauge('karlbox_sink_failed_total', 'Barcodes dropped because every attempt to write them to an output failed', lambda: [((x['name'],), x['failed']) for x in scannerPipeline.getOutputStats()['outputs']], ('sink',), kind='counter')
+    metrics.gauge('karlbox_log_dropped_total', 'Log records dropped because the logging queue was full', lambda: [((), OmronVTInterfaceModule.ovtimlogging.logPipeline.dropped)], kind='counter')
+
+    # connects to the serial output device and starts the dispatcher which sends it every barcode as soon as it is read
+    # (in daemon mode the ingest daemon connects in the background)
     @socketio.on('Event_startBarcodeOutput')
     def sendBarcode():
         app.logger.info('Event_startBarcodeOutput event received!')
-        # initialize connection
-        attemptNo = 1
-        while True:
-            app.logger.info('Establishing serial connection with inspection machine to send barcode data on port /dev/ttyTHS2/ (this is attempt #' + str(attemptNo) + ' of 3)')
-            try:
-                tm = OmronVTInterfaceModule.ovtimfunctions.TimeManager("/dev/ttyTHS2")
-                app.logger.info('Serial connection established on port /dev/ttyTHS2')
-                break
-            except Exception as e:
-                app.logger.error('Failed to establish serial connection to insection machine on port /dev/ttyTHS2 because of error: ' + str(e) + '. Retrying in 30 seconds (this was attempt #' + str(attemptNo) + ' of 3)')
-                if attemptNo > 2:
-                    socketio.emit('Event_scannerNotification', {'title': 'Failed to Establish Serial Connection', 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S'), 'type': 'errorSerial', 'msg': 'Could not establish serial connection to inspection machine because of error: ' + str(e) + ' (Attempt #' + str(attemptNo) + ' of 3). Please ensure the inspection machine is powered on and all cables and connectors are securely inserted. Selecting an inspection program on the inspection machine before attempting to connect may help. You must refresh this web page to attempt the connection again.'})
-                    return
-                else:
-                    socketio.emit('Event_scannerNotification', {'title': 'Failed to Establish Serial Connection', 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S'), 'type': 'errorSerial', 'msg': 'Could not establish connection to inspection machine (Attempt #' + str(attemptNo) + ' of 3). Waiting 30 seconds before retrying.'})
-                attemptNo += 1
-                time.sleep(30)
-                continue
-
-        while True:
-            if time.time() - OmronVTInterfaceModule.ovtimconfig.currentBarcodeTimestamp <= OmronVTInterfaceModule.ovtimconfig.barcodeOutputTimelimit:
-                try:
-                    tm.send(str(OmronVTInterfaceModule.ovtimconfig.currentBarcode.strip() + '\r\n').encode('utf-8'))
-                    socketio.emit('Event_scannerNotification', {'title': 'Barcode Sent to Inspection Machine', 'ip':str(0), 'port':str(0), 'timestamp': datetime.now().strftime('%m/%d/%Y %H:%M:%S'), 'type': 'info', 'msg': 'Barcode sent to inspection machine: ' + str(OmronVTInterfaceModule.ovtimconfig.currentBarcode.strip()), 'data': str(OmronVTInterfaceModule.ovtimconfig.currentBarcode.strip())})
-                    barcodeLogger.info('Sent barcode to inspection machine: ' + str(OmronVTInterfaceModule.ovtimconfig.currentBarcode.strip()))
-                    time.sleep(OmronVTInterfaceModule.ovtimconfig.barcodeSleepTime)
-                except Exception as e:
-                    app.logger.error('Failed to send barcode (' + str(OmronVTInterfaceModule.ovtimconfig.currentBarcode.strip()) + ') to inspection machine because ' + str(e))
-                    time.sleep(OmronVTInterfaceModule.ovtimconfig.barcodeSleepTime)
-                    continue
-            
+        scannerNotifier.start(socketio.start_background_task)
+        scannerPipeline.startOutput(socketio.start_background_task)
 
+    # saves the config sent by the manage scanners page; only the profiles which changed are written (previous versions are kept in the store's history)
     @socketio.on('Event_overwriteConfigFile')
     def overwriteConfigFile(jsonData):
         try:
-            shutil.copy2(OmronVTInterfaceModule.ovtimconfig.karlboxConfigFilePath, OmronVTInterfaceModule.ovtimconfig.karlboxConfigFilePath.split('.')[0] + '_old.json')
+            changed = profileStore.saveConfig(jsonData)
         except Exception as e:
-            return 'Failed to save config file. Error when backing up original config file: ' + str(e)
+            return "Failed to save config file. Error when saving profiles: " + str(e)
+        finally:
+            OmronVTInterfaceModule.ovtimfunctions.configCache.invalidate()
+        app.logger.info('Config saved, %s profile(s) changed', changed)
+        # the barcode rules and deduplication settings of the (possibly changed) active profile apply from the next barcode on
+        # (and its scanners are the ones started without a page)
+        configData = OmronVTInterfaceModule.ovtimfunctions.readConfig(app.logger, profileStore, OmronVTInterfaceModule.ovtimconfig.possibleIniValues, OmronVTInterfaceModule.ovtimconfig.possibleModelValues)
+        if autoStart is not None:
+            autoStart.apply(configData[1].get(configData[2], {}), socketio.start_background_task)
+        else:
+            scannerPipeline.setProfile(configData[1].get(configData[2], {}))
+        return "success"
 
+    # returns one page of a scanner's barcode history (see ovtimhistory.BarcodeHistory.page), or None if the scanner has no history
+    # invalid arguments are answered with {'error': message}, like /barcodes/history
+    @socketio.on('Event_getBarcodeHistory')
+    def getBarcodeHistory(ip, port, after=None, before=None, limit=100):
         try:
-            with open(OmronVTInterfaceModule.ovtimconfig.karlboxConfigFilePath, 'w') as cfile:
-                cfile.write(json.dumps(jsonData))
-        except Exception as e:
-            return "Failed to save config file. Error when overwriting config file: " + str(e)
-        return "success"
+            after = None if after is None else int(after)
+            before = None if before is None else int(before)
+            return scannerPipeline.historyPage(str(ip) + ':' + str(port), after, before, int(limit))
+        except (TypeError, ValueError) as e:
+            return {'error': 'invalid barcode history request: ' + str(e)}
 
+    # answers from the discovery inventory with the most recently seen scanner whose MAC address is not in exclude
+    # (e.g. the scanner already filled in for the other side), waiting a few seconds for replies only if no scanner was found yet
+    # all devices in the inventory are included as 'devices'
     @socketio.on('Event_detectScannerInfo')
-    def getScannerInfo(side):
-        OmronVTInterfaceModule.ovtimfunctions.ethernetAutoDetect(side, OmronVTInterfaceModule.ovtimconfig.testLAN, app.logger, socketio)
+    def getScannerInfo(side, exclude=None):
+        scannerDiscovery.start(socketio.start_background_task)
+        try:
+            devices = scannerDiscovery.waitForDevices(OmronVTInterfaceModule.ovtimconfig.discoveryWaitTime)
+        except OSError as e:
+            app.logger.error('ScannerDiscovery- Inventory of the ingest daemon not available: %s', e)
+            devices = []
+        exclude = [str(x).upper() for x in (exclude or []) if x]
+        device = next((x for x in devices if x['mac'].upper() not in exclude), None)
+        if device is None:
+            app.logger.info('ScannerDiscovery- No compatible devices found for %s side (%s device(s) in inventory)', side, len(devices))
+            emit('Event_detectScannerInfoResult', {'result':'failure', 'side':side, 'ip':str(-1), 'tcp1':str(-1), 'name': '', 'model': '', 'mac':'', 'devices': devices})
+            return
+        emit('Event_detectScannerInfoResult', {'result':'success', 'side':side, 'ip':device['ip'], 'tcp1':device['tcp1'], 'name': device['name'], 'model': device['model'], 'mac':device['mac'], 'devices': devices})
     
+    startup.mark('webapp ready')
     return app
 
-app = create_app()
\ No newline at end of file
+# the app is created on first use (gunicorn loads "OmronVTInterfaceModule:app"), so the ingest daemon can import the package without starting a webapp
+def __getattr__(name):
+    global app
+    if name == 'app':
+        app = create_app()
+        return app
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
\ No newline at end of file
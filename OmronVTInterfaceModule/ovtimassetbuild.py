@@ -0,0 +1,219 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+try:
+	from fontTools import subset as fontSubset
+except ImportError:
+	fontSubset = None
+
+from OmronVTInterfaceModule.ovtimassets import DIST_DIRECTORY, MANIFEST_NAME
+
+# static asset build: the stylesheets, scripts and webfonts the templates load through asset_url() are trimmed, minified,
+# fingerprinted (name.<hash>.ext) and written to static/dist together with gzip (and brotli, if installed) variants
+# and the manifest read by ovtimassets.AssetManifest
+#	Font Awesome is cut down to the icons used by the templates and scripts, and to the woff2 webfonts of the styles used;
+#	with fontTools installed the webfonts themselves are subset to those icons
+# Usage:
+#	python -m OmronVTInterfaceModule.ovtimassetbuild			(run before the webapp starts, see services/gunicorn.service)
+
+ASSET_REFERENCE = re.compile(r'''asset_url\(\s*['"]([^'"]+)['"]\s*\)''')
+ICON_CLASS = re.compile(r'\bfa-[a-z0-9]+(?:-[a-z0-9]+)*')
+STYLE_CLASS = re.compile(r'\bfa[bdlrs]?\b')
+ICON_RULE = re.compile(r'((?:\.fa-[a-z0-9-]+:before\s*,?\s*)+)\{\s*content:\s*"\\([0-9a-f]+)";?\s*\}')
+ICON_SELECTOR = re.compile(r'\.(fa-[a-z0-9-]+):before')
+FONT_FACE = re.compile(r'@font-face\s*\{[^}]*\}')
+FONT_SOURCE = re.compile(r'''url\(\s*["']?([^"')]+)["']?\s*\)\s*format\(\s*["']woff2["']\s*\)''')
+CSS_URL = re.compile(r'''url\(\s*["']?/static/([^"')?#]+)([^"')]*)["']?\s*\)''')
+CSS_COMMENT = re.compile(r'/\*(?!!).*?\*/', re.DOTALL)
+
+# Font Awesome style classes and the webfont each of them uses
+FONT_AWESOME_STYLES = {'fa': 'fa-solid-900', 'fas': 'fa-solid-900', 'far': 'fa-regular-400', 'fab': 'fa-brands-400'}
+
+COMPRESSED_TYPES = ('.css', '.js', '.svg', '.json', '.ttf', '.eot')
+MIN_COMPRESS_SIZE = 512
+
+def fingerprint(data):
+	return hashlib.sha256(data).hexdigest()[:12]
+
+# removes comments (except /*! license comments) and whitespace which carries no meaning
+def minifyCss(text):
+	text = CSS_COMMENT.sub('', text)
+	text = re.sub(r'\s+', ' ', text)
+	text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+	text = re.sub(r':\s+', ':', text)
+	return text.replace(';}', '}').strip()
+
+# keeps the Font Awesome icon rules of the used icons and the webfonts of the used styles
+# returns tuple: (css, {webfont name: set of codepoints})
+def trimFontAwesome(text, usedIcons, usedStyles):
+	codepoints = set()
+
+	def keepIcons(m):
+		selectors = [x for x in ICON_SELECTOR.findall(m.group(1)) if x in usedIcons]
+		if not selectors:
+			return ''
+		codepoints.add(int(m.group(2), 16))
+		return ', '.join('.%s:before' % x for x in selectors) + ' { content: "\\%s"; }' % m.group(2)
+
+	text = ICON_RULE.sub(keepIcons, text)
+	usedFonts = set(FONT_AWESOME_STYLES[x] for x in usedStyles if x in FONT_AWESOME_STYLES)
+	unusedFonts = set(FONT_AWESOME_STYLES.values()) - usedFonts
+
+	def keepFontFace(m):
+		if any(font in m.group(0) for font in unusedFonts):
+			return ''
+		return m.group(0)
+
+	text = FONT_FACE.sub(keepFontFace, text)
+	return (text, {font: codepoints for font in usedFonts})
+
+# reduces every @font-face to its woff2 source (supported by every browser the kiosk runs)
+def woff2Only(text):
+	def rewrite(m):
+		block = m.group(0)
+		source = FONT_SOURCE.search(block)
+		if source is None:
+			return block
+		block = re.sub(r'src\s*:[^;}]*;?', '', block)[:-1].rstrip()
+		if not block.endswith(('{', ';')):
+			block += ';' # the last declaration may leave out its semicolon
+		return block + ' src: url("%s") format("woff2"); }' % source.group(1)
+	return FONT_FACE.sub(rewrite, text)
+
+# returns the webfont subset to the given codepoints, or None if fontTools (and brotli, for woff2) is not installed
+def subsetFont(path, codepoints):
+	if fontSubset is None or brotli is None or not codepoints:
+		return None
+	options = fontSubset.Options()
+	options.flavor = 'woff2'
+	font = fontSubset.load_font(path, options)
+	subsetter = fontSubset.Subsetter(options)
+	subsetter.populate(unicodes=sorted(codepoints))
+	subsetter.subset(font)
+	tempPath = path + '.subset'
+	try:
+		fontSubset.save_font(font, tempPath, options)
+		with open(tempPath, 'rb') as f:
+			return f.read()
+	finally:
+		if os.path.exists(tempPath):
+			os.remove(tempPath)
+
+# writes one asset to the dist directory under its fingerprinted name, with compressed variants
+# returns the fingerprinted name relative to the static directory
+def writeAsset(staticDir, name, data):
+	base, ext = os.path.splitext(name)
+	distName = '%s/%s.%s%s' % (DIST_DIRECTORY, base, fingerprint(data), ext)
+	path = os.path.join(staticDir, distName)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, 'wb') as f:
+		f.write(data)
+	if ext in COMPRESSED_TYPES and len(data) >= MIN_COMPRESS_SIZE:
+		variants = [('.gz', gzip.compress(data, 9, mtime=0))]
+		if brotli is not None:
+			variants.append(('.br', brotli.compress(data, quality=11)))
+		for suffix, compressed in variants:
+			if len(compressed) < len(data):
+				with open(path + suffix, 'wb') as f:
+					f.write(compressed)
+	return distName
+
+# builds every asset the templates reference through asset_url() into static/dist and writes the manifest
+# returns list of tuples: (name, source bytes, built bytes, gzip bytes) for every asset built
+def buildAssets(staticDir, templateDir):
+	templates = ''
+	for name in sorted(os.listdir(templateDir)):
+		if name.endswith('.html'):
+			with open(os.path.join(templateDir, name), encoding='utf-8') as f:
+				templates += f.read()
+	references = sorted(set(ASSET_REFERENCE.findall(templates)))
+	references = [x for x in references if os.path.isfile(os.path.join(staticDir, x))]
+
+	# icons can be set by the templates' scripts and by the bundled scripts (e.g. bootstrap-table's buttons)
+	usageText = templates
+	for name in references:
+		if name.endswith('.js'):
+			with open(os.path.join(staticDir, name), encoding='utf-8', errors='replace') as f:
+				usageText += f.read()
+	usedIcons = set(ICON_CLASS.findall(usageText))
+	usedStyles = set(STYLE_CLASS.findall(usageText))
+
+	distPath = os.path.join(staticDir, DIST_DIRECTORY)
+	shutil.rmtree(distPath, ignore_errors=True)
+	assets = {}
+	stats = []
+
+	def build(name, data, sourceSize):
+		assets[name] = writeAsset(staticDir, name, data)
+		stats.append((name, sourceSize, len(data), len(gzip.compress(data, 9, mtime=0))))
+
+	# stylesheets first collect the webfonts they use, which are built before the stylesheets refer to their new names
+	stylesheets = {}
+	fontCodepoints = {}
+	for name in references:
+		if not name.endswith('.css'):
+			continue
+		with open(os.path.join(staticDir, name), encoding='utf-8') as f:
+			text = f.read()
+		sourceSize = len(text.encode('utf-8'))
+		if ICON_RULE.search(text):
+			text, codepoints = trimFontAwesome(text, usedIcons, usedStyles)
+			for font, points in codepoints.items():
+				fontCodepoints.setdefault(font, set()).update(points)
+		stylesheets[name] = (minifyCss(woff2Only(text)), sourceSize)
+	fonts = set()
+	for text, sourceSize in stylesheets.values():
+		fonts.update(x[0] for x in CSS_URL.findall(text))
+	fonts.update(x for x in references if x.startswith('webfonts/'))
+	for name in sorted(fonts):
+		path = os.path.join(staticDir, name)
+		if not os.path.isfile(path):
+			continue
+		with open(path, 'rb') as f:
+			data = f.read()
+		base = os.path.splitext(os.path.basename(name))[0]
+		subset = None
+		if base in fontCodepoints and name.endswith('.woff2'):
+			try:
+				subset = subsetFont(path, fontCodepoints[base])
+			except Exception as e:
+				print('Could not subset %s, using the whole font: %s' % (name, e))
+		build(name, subset or data, len(data))
+	for name, (text, sourceSize) in stylesheets.items():
+		text = CSS_URL.sub(lambda m: 'url("/static/%s%s")' % (assets.get(m.group(1), m.group(1)), m.group(2)), text)
+		build(name, text.encode('utf-8'), sourceSize)
+	for name in references:
+		if name not in assets:
+			with open(os.path.join(staticDir, name), 'rb') as f:
+				data = f.read()
+			build(name, data, len(data))
+
+	with open(os.path.join(distPath, MANIFEST_NAME + '.tmp'), 'w') as f:
+		json.dump({'assets': assets}, f, indent=1, sort_keys=True)
+	os.replace(os.path.join(distPath, MANIFEST_NAME + '.tmp'), os.path.join(distPath, MANIFEST_NAME))
+	return stats
+
+def main():
+	packagePath = os.path.dirname(os.path.abspath(__file__))
+	parser = argparse.ArgumentParser(description='Build the fingerprinted and precompressed static assets')
+	parser.add_argument('--static', default=os.path.join(packagePath, 'static'))
+	parser.add_argument('--templates', default=os.path.join(packagePath, 'templates'))
+	args = parser.parse_args()
+
+	stats = buildAssets(args.static, args.templates)
+	for name, sourceSize, size, gzipSize in stats:
+		print('%-40s %8d -> %8d bytes (%d gzip)' % (name, sourceSize, size, gzipSize))
+	print('%d assets: %d -> %d bytes (%d gzip)%s%s' % (len(stats), sum(x[1] for x in stats), sum(x[2] for x in stats), sum(x[3] for x in stats), '' if brotli is not None else ', brotli not installed', '' if fontSubset is not None else ', fontTools not installed (webfonts not subset)'))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,56 @@
+import json
+import mimetypes
+import os
+
+# fingerprinted and precompressed static assets built by ovtimassetbuild into static/dist
+# the webapp serves them from /static/dist with Cache-Control: immutable, so the kiosk's browser loads them once and
+# never asks for them again; without a build (or with KARLBOX_ASSETS=source) asset_url() returns the files in static/
+# Usage:
+#	assets = AssetManifest(staticDir)
+#	assets.url('css/all.css')								'dist/css/all.2f0c1d9e4b7a.css'
+#	assets.lookup('dist/css/all.2f0c1d9e4b7a.css', 'gzip, deflate')
+
+DIST_DIRECTORY = 'dist'
+MANIFEST_NAME = 'manifest.json'
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+FONT_TYPES = {'.woff2': 'font/woff2', '.woff': 'font/woff', '.ttf': 'font/ttf'} # not known to every mimetypes database
+
+# the built assets, loaded once when the webapp starts
+class AssetManifest(object):
+	def __init__(self, staticDir, enabled=True):
+		self.staticDir = staticDir
+		self.assets = {} # name in static/ -> fingerprinted name
+		self.files = {} # fingerprinted name -> (etag, mimetype, encodings available)
+		manifestPath = os.path.join(staticDir, DIST_DIRECTORY, MANIFEST_NAME)
+		if not enabled or not os.path.isfile(manifestPath):
+			return
+		with open(manifestPath) as f:
+			self.assets = json.load(f)['assets']
+		for distName in self.assets.values():
+			path = os.path.join(staticDir, distName)
+			encodings = tuple(encoding for encoding, suffix in (('br', '.br'), ('gzip', '.gz')) if os.path.isfile(path + suffix))
+			etag = '"%s"' % distName.rsplit('.', 2)[-2]
+			mimetype = mimetypes.guess_type(distName)[0] or FONT_TYPES.get(os.path.splitext(distName)[1], 'application/octet-stream')
+			self.files[distName] = (etag, mimetype, encodings)
+
+	def isBuilt(self):
+		return bool(self.assets)
+
+	# returns the name to load an asset by (relative to static/), the fingerprinted one if it was built
+	def url(self, name):
+		return self.assets.get(name, name)
+
+	# returns tuple: (path, content encoding or None, etag, mimetype) of the best variant for the Accept-Encoding header,
+	# or None if distName is not a built asset
+	def lookup(self, distName, acceptEncoding):
+		entry = self.files.get(distName)
+		if entry is None:
+			return None
+		etag, mimetype, encodings = entry
+		path = os.path.join(self.staticDir, distName)
+		if encodings:
+			accepted = set(x.split(';')[0].strip() for x in acceptEncoding.split(',') if not x.replace(' ', '').endswith(';q=0'))
+			for encoding in encodings:
+				if encoding in accepted:
+					return (path + ('.br' if encoding == 'br' else '.gz'), encoding, etag, mimetype)
+		return (path, None, etag, mimetype)
@@ -4,38 +4,125 @@ import sys
 # create a reference to the module instance that can be used from other modules
 this = sys.modules[__name__]
 
-# configuration file where profiles are stored
+# configuration file where profiles were stored before the profile store, imported once
 this.karlboxConfigFilePath = 'karlboxconfig.json' #os.path.join(os.path.join(os.getcwd(), 'static'), 'karlboxconfig.json')
 
+# profile store (SQLite); created from karlboxConfigFilePath on first start
+# (relative to the package's data directory unless absolute; KARLBOX_STORE lets the benchmarks use a store of their own)
+this.karlboxStoreFilePath = os.environ.get('KARLBOX_STORE', 'karlboxconfig.db')
+this.storeHistoryDepth = 50 # revisions of each profile kept in the store's history table (0 keeps every revision)
+
+# directory of the webapp and barcode logs and of the barcode journal, relative to the package directory unless absolute
+# (KARLBOX_LOG_DIRECTORY lets the benchmarks keep their logs out of the installation)
+this.logDirectory = os.environ.get('KARLBOX_LOG_DIRECTORY', 'log')
+
 # logging settings
-this.logConfigWebapp = {'logname': 'webapp', 'basefilename': 'webapp.log', 'logdirectory': os.path.join('log', 'webapp'), 'loglevel': 'DEBUG', 'loghandler': None, 'logformatter': None, 'logmsgformat': '%(asctime)s|%(levelname)-8s|%(message)s', 'logdateformat':'%Y/%m/%d %H:%M:%S', 'logrotatecount': 30}
-this.logConfigBarcode = {'logname': 'barcode', 'basefilename': 'barcode.log', 'logdirectory': os.path.join('log', 'barcodes'), 'loglevel': 'INFO', 'loghandler': None, 'logformatter': None, 'logmsgformat': '%(asctime)s|%(levelname)-8s|%(message)s', 'logdateformat':'%Y/%m/%d %H:%M:%S', 'logrotatecount': 30}
+# logs rotate at midnight and whenever they grow past logmaxbytes; rotated segments are gzipped in the background and the oldest
+# are removed beyond logrotatecount segments or logmaxtotalbytes (compressed) per log
+# the webapp and ingest logs are written at INFO (KARLBOX_LOG_LEVEL=DEBUG also logs every page request and socket event)
+this.logLevel = os.environ.get('KARLBOX_LOG_LEVEL', 'INFO')
+this.logConfigWebapp = {'logname': 'webapp', 'basefilename': 'webapp.log', 'logdirectory': os.path.join(this.logDirectory, 'webapp'), 'loglevel': this.logLevel, 'loghandler': None, 'logformatter': None, 'logmsgformat': '%(asctime)s|%(levelname)-8s|%(message)s', 'logdateformat':'%Y/%m/%d %H:%M:%S', 'logrotatecount': 30, 'logmaxbytes': 8 * 1024 * 1024, 'logmaxtotalbytes': 64 * 1024 * 1024}
+this.logConfigBarcode = {'logname': 'barcode', 'basefilename': 'barcode.log', 'logdirectory': os.path.join(this.logDirectory, 'barcodes'), 'loglevel': 'INFO', 'loghandler': None, 'logformatter': None, 'logmsgformat': '%(asctime)s|%(levelname)-8s|%(message)s', 'logdateformat':'%Y/%m/%d %H:%M:%S', 'logrotatecount': 30, 'logmaxbytes': 16 * 1024 * 1024, 'logmaxtotalbytes': 128 * 1024 * 1024}
+this.logConfigIngest = {'logname': 'ingest', 'basefilename': 'ingest.log', 'logdirectory': os.path.join(this.logDirectory, 'ingest'), 'loglevel': this.logLevel, 'loghandler': None, 'logformatter': None, 'logmsgformat': '%(asctime)s|%(levelname)-8s|%(message)s', 'logdateformat':'%Y/%m/%d %H:%M:%S', 'logrotatecount': 30, 'logmaxbytes': 8 * 1024 * 1024, 'logmaxtotalbytes': 64 * 1024 * 1024}
+this.logQueueSize = 10000 # records waiting to be written; further records are dropped (and counted) until the queue drains
+this.logBatchSize = 256 # records written per flush
+this.logFlushInterval = 1.0 # in seconds, how often the logging listener wakes up when logging is idle
+this.logCommitInterval = 5 # in seconds, records are collected this long and then written and synced (fsync) as one chunk per log file
+this.logCommitLevel = 'ERROR' # records at this level or above are written and synced right away
+this.logCompressLevel = 6 # gzip level of rotated log segments
+this.logStatsHours = 24 # hours of bytes written reported by /status/logging
+
+# barcode journal (binary record of every barcode read, queried through /barcodes/query)
+this.journalDirectory = os.path.join(this.logDirectory, 'journal')
+this.journalSegmentCapacity = 65536 # records per segment file (40 bytes each, preallocated)
+this.journalRetentionDays = 90 # segments older than this are removed when a new segment is started
 
 # global variables
 # TODO determine if these are necessary
 this.activeProfile = '' # tracks the active scanner profile
 this.dictProfiles = {} # holds all profile data 
 
-this.scannerBarcodes = {} # scannerBarcodes['192.168.188.1'] = []
-this.scannerTimers = {} # scannerTimers['192.168.188.1'] = []
-this.scannerTimestamps = {} # scannerTimestamps['192.168.188.1'] = []
-
-this.scannerData = {}
+this.barcodeHistoryDepth = 1000 # barcodes kept per scanner, profiles can set their own with "historydepth"
 this.scannerTimelimit = 0.1 # in seconds
+this.dedupWindow = 0 # in seconds, a barcode read again within the window (by any scanner of the cell) is a duplicate and is not sent to the inspection machine; 0 only compares with the previous barcode of the scanner; profiles can set their own with "dedupwindow"
+this.dedupKey = 'barcode' # 'barcode' deduplicates across all scanners, 'barcode+scanner' per scanner; profiles can set their own with "dedupkey"
+this.dedupMaxEntries = 100000 # barcodes remembered for deduplication, the oldest are forgotten first
 this.barcodeOutputTimelimit = 30 # in seconds
-this.barcodeSleepTime = 10 # in seconds
+this.barcodeSleepTime = 10 # in seconds, interval between re-sends when barcodeResendPolicy is 'repeat'
+this.barcodeResendPolicy = 'none' # 'none' sends each barcode once, 'repeat' re-sends the last barcode every barcodeSleepTime seconds for barcodeOutputTimelimit seconds
+this.serialOutputPort = os.environ.get('KARLBOX_OUTPUT_PORT', '/dev/ttyTHS2') # serial port of the inspection machine (KARLBOX_OUTPUT_PORT overrides it, e.g. with a pty)
+this.barcodeOutputQueueSize = 64 # barcodes waiting to be sent to the inspection machine
+this.serialAckMode = False # wait for the inspection machine to acknowledge each barcode
+this.serialAckBytes = b'\x06' # acknowledgement sent by the inspection machine (ACK)
+this.serialAckTimeout = 2 # in seconds
+this.serialOutputBaudrate = 9600 # serial settings of the inspection machine
+this.serialOutputBytesize = 8
+this.serialOutputStopbits = 1
+this.serialOutputParity = 'N'
+this.serialConnectAttempts = 0 # give up opening the serial port after this many failed attempts in a row (0 keeps trying)
+this.serialBackoffBase = 0.5 # in seconds, delay before opening the serial port again; doubled after every failed attempt
+this.serialBackoffMax = 30 # in seconds, longest delay between attempts
+# additional barcode outputs declared in a profile's "outputs" list (see ovtimsinks)
+this.sinkQueueSize = 256 # barcodes waiting per output
+this.sinkRetries = 3 # attempts after a failed write before the barcode is dropped
+this.sinkRetryDelay = 0.5 # in seconds, doubled for every further attempt
+this.sinkBlockTimeout = 1 # in seconds a barcode waits for room in an output's queue when its backpressure is 'block'
+this.sinkTimeout = 5 # in seconds, connect and write timeout of tcp, fifo and http outputs
+
+# where scanner ingest and serial output run
+#	'inprocess'	in the webapp; gunicorn must run a single worker (-w 1)
+#	'daemon'	in the ingest daemon (python -m OmronVTInterfaceModule.ovtimdaemon, see services/karlbox-ingest.service),
+#				which every gunicorn worker connects to, so gunicorn can run several workers
+this.ingestMode = os.environ.get('KARLBOX_INGEST_MODE', 'inprocess')
+this.ingestSocketPath = os.environ.get('KARLBOX_INGEST_SOCKET', '/tmp/karlbox-ingest.sock') # Unix domain socket of the ingest daemon
+this.ingestCallTimeout = 5 # in seconds, longest time a web worker waits for the ingest daemon to answer
+this.ingestClientQueueSize = 10000 # messages the ingest daemon queues for a slow web worker before dropping the oldest
+
+# start scanner ingest and the serial output for the active profile's scanners when the process owning them starts
+# (the webapp in 'inprocess' mode, the ingest daemon in 'daemon' mode) instead of when the kiosk's page asks for them;
+# the phases of the start are logged with the seconds since the process started and since the system booted (see ovtimstartup)
+# (KARLBOX_AUTOSTART=0 turns it off)
+this.autoStart = os.environ.get('KARLBOX_AUTOSTART', '1') != '0'
+this.startupReadyTimeout = 600 # in seconds, the scanners and serial port still missing after this long are logged
+
+# Socket.IO transports used by the pages; with several gunicorn workers a polling session would hit a different worker
+# with every request, so only websockets are used in daemon mode
+this.socketioTransports = ['websocket'] if this.ingestMode == 'daemon' else ['polling', 'websocket']
 
-this.currentBarcode = '' # global
-this.currentBarcodeTimestamp = 0
+# static assets: 'built' serves the fingerprinted, precompressed assets of static/dist if they were built (see ovtimassetbuild),
+# 'source' the files in static/ as they are (KARLBOX_ASSETS overrides it)
+this.assetMode = os.environ.get('KARLBOX_ASSETS', 'built')
+
+# scanner ingest engine settings
+this.scannerConnectTimeout = 5 # in seconds
+this.scannerBackoffBase = 0.5 # in seconds, delay before reconnecting; doubled after every failed attempt
+this.scannerBackoffMax = 10 # in seconds, longest delay between connect attempts
+this.scannerBackoffJitter = 0.5 # delays are shortened by a random fraction up to this, so scanners do not reconnect in lockstep
+this.scannerConnectAttempts = 0 # give up after this many failed attempts in a row (0 keeps trying)
+this.scannerKeepalive = (5, 2, 3) # TCP keepalive (idle, interval, count) in seconds; a dead scanner is noticed after about idle + interval * count seconds
+this.scannerIdleTimeout = 0 # in seconds, reconnect when a scanner sent nothing for this long (0 disables; for scanners set up to send a heartbeat or no-read message)
+this.scannerLingerTime = 60 # in seconds, a scanner connection is kept this long after its last subscriber left
+this.notificationWindow = 0.05 # in seconds, notifications of one scanner within this window are sent to the browsers as one batch
+
+# scanner reachability probes (index page and Event_probeAllScanners)
+this.probeWorkers = 16 # probes running at the same time
+this.probeTimeout = 5 # in seconds
+this.probeCacheTime = 10 # in seconds, results are reused for this long
+
+# scanner discovery (UDP broadcast on every local subnet, used by the Auto buttons of the manage scanners page)
+this.discoveryInterval = 15 # in seconds, between broadcasts
+this.discoveryForgetTime = 300 # in seconds, scanners which did not reply for this long are removed from the inventory
+this.discoveryWaitTime = 3 # in seconds, how long an Auto button waits for a reply when no scanner was found yet
+this.discoveryExtraAddresses = [] # broadcast addresses used in addition to the ones of the local interfaces (e.g. '192.168.188.255')
+
+# scanner positions in a profile; each position has the fields in ovtimvalidator.SCANNER_FIELDS (e.g. 'bs' + 'ip')
+# profiles can declare more positions with a "positions" list
+this.scannerPositions = ['bs', 'ts']
 
 # TODO probably remove this
 # config options in ini file
-this.possibleIniValues = ['bsmodel', 'bsname', 'bsmac', 'bscommtype', 'bsip', 'bsport', 'bsbaud', 'bsbytesize', 'bsstopbit', 'bsparity', 'tsmodel', 'tsname', 'tsmac', 'tscommtype', 'tsip', 'tsport', 'tsbaud', 'tsbytesize', 'tsstopbit', 'tsparity']
+this.possibleIniValues = ['bsmodel', 'bsname', 'bsmac', 'bscommtype', 'bsip', 'bsport', 'bsbaud', 'bsbytesize', 'bsstopbit', 'bsparity', 'bsframing', 'tsmodel', 'tsname', 'tsmac', 'tscommtype', 'tsip', 'tsport', 'tsbaud', 'tsbytesize', 'tsstopbit', 'tsparity', 'tsframing', 'historydepth', 'rules', 'dedupwindow', 'dedupkey', 'outputs']
 
 # TODO probably not use this for 1.0 release with plans for later release after better integration
 # model names
 this.possibleModelValues = ['microhawk mv', 'microhawk mv-20', 'microhawk mv-30', 'microhawk mv-40', 'microhawk mv-45', 'microhawk id-20', 'microhawk id-30', 'microhawk id-40', 'microhawk id-45', 'id-45', 'f420', 'f420-f', 'f430', 'f430-f']
-
-this.testLAN = {} # used to track temporary data between threads
-
-
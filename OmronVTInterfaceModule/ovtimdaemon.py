@@ -0,0 +1,360 @@
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+from collections import deque
+
+import OmronVTInterfaceModule.ovtimconfig as ovtimconfig
+from OmronVTInterfaceModule.ovtimdiscovery import DiscoveryService
+from OmronVTInterfaceModule.ovtimfunctions import initLogging, readConfig
+from OmronVTInterfaceModule.ovtimhistory import HistoryRegistry
+from OmronVTInterfaceModule.ovtimingestclient import encodeMessage
+from OmronVTInterfaceModule.ovtimjournal import BarcodeJournal
+from OmronVTInterfaceModule.ovtimlogging import logCompressor, logPipeline
+from OmronVTInterfaceModule.ovtimmetrics import metrics
+from OmronVTInterfaceModule.ovtimpipeline import ScannerPipeline
+from OmronVTInterfaceModule.ovtimstartup import AutoStarter, StartupTimer
+from OmronVTInterfaceModule.ovtimstore import ProfileStore
+
+# scanner ingest daemon: owns the scanner connections, the barcode handling and the serial output in a process of its own,
+# so any number of gunicorn workers can serve pages and Socket.IO clients without stalling on scanner or serial I/O
+# Usage:
+#	python -m OmronVTInterfaceModule.ovtimdaemon [--socket /tmp/karlbox-ingest.sock]		(see services/karlbox-ingest.service)
+#	KARLBOX_INGEST_MODE=daemon gunicorn ... -w 3 "OmronVTInterfaceModule:app"
+#
+# the web workers connect to the daemon's Unix domain socket; messages are json objects, one per line
+#	worker -> daemon:
+#		{'op': 'addScanner', 'ip', 'port', 'framing', 'serial'}	(each worker holds its own scanners, the daemon closes a
+#		{'op': 'removeScanner', 'ip', 'port', 'delay'}			 connection once no worker holds it any more)
+#		{'op': 'setHistoryDepth', 'scanner', 'depth'}
+#		{'op': 'setProfile', 'profile'}							(the active profile, whenever it changed)
+#		{'op': 'startOutput'}
+#		{'op': 'startDiscovery'}								(the daemon is the only process listening for discovery replies)
+#		{'op': 'log', 'log', 'records'}							records [[created, levelno, message], ...] of the worker's 'webapp' or
+#																 'barcode' log; the daemon is the only process writing the log files
+#		{'op': 'call', 'id', 'name', 'args'}					name is 'states', 'history', 'histories', 'output', 'metrics', 'startup',
+#																 'logging', 'discovered' or 'discoverwait' (answered by a thread of its own)
+#	daemon -> worker:
+#		{'op': 'notify', 'ip', 'port', 'event', 'readTime', 'fields'}		every notification, to every worker
+#		{'op': 'reply', 'id', 'result'} or {'op': 'reply', 'id', 'error', 'errorType'}
+# the barcode journal is shared through its memory-mapped segments: workers open it read only and query it themselves
+# with ovtimconfig.autoStart the daemon starts the scanners and the serial output of the active profile itself when it starts
+# (see ovtimstartup); the scanners of the active profile sent by the workers are pinned from then on
+
+# starts function in a daemon thread (the daemon process does not run gevent)
+def spawnThread(function, *args):
+	thread = threading.Thread(target=function, args=args, daemon=True)
+	thread.start()
+	return thread
+
+# one web worker connected to the daemon
+# messages for the worker are queued and written by the session's own thread, so a slow worker never holds up the ingest loop;
+# when the queue is full the oldest message is dropped
+class DaemonSession(object):
+	def __init__(self, sock, maxQueued=10000):
+		self.sock = sock
+		self.maxQueued = maxQueued
+		self.queue = deque()
+		self.condition = threading.Condition()
+		self.running = True
+		self.scanners = set() # (ip, port) held by this worker
+		self.dropped = 0
+
+	def put(self, data):
+		with self.condition:
+			if not self.running:
+				return
+			if len(self.queue) >= self.maxQueued:
+				self.queue.popleft()
+				self.dropped += 1
+			self.queue.append(data)
+			self.condition.notify()
+
+	def close(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+	# writes every queued message with one sendall
+	def runWriter(self):
+		while True:
+			with self.condition:
+				while self.running and not self.queue:
+					self.condition.wait()
+				if not self.running:
+					break
+				data = b''.join(self.queue)
+				self.queue.clear()
+			try:
+				self.sock.sendall(data)
+			except OSError:
+				self.close()
+				break
+		self.sock.close()
+
+# serves the web workers on a Unix domain socket
+# publish() has the signature of NotificationFanout.publish and broadcasts the notification to every worker
+# Usage:
+#	daemon = IngestDaemon('/tmp/karlbox-ingest.sock', logger)
+#	pipeline = ScannerPipeline(daemon.publish, logger, barcodeLogger, journal, histories)
+#	daemon.serve(pipeline)			(blocks until stop() is called)
+class IngestDaemon(object):
+	def __init__(self, path, logger, maxQueued=10000, lingerTime=60):
+		self.path = path
+		self.logger = logger
+		self.maxQueued = maxQueued
+		self.lingerTime = lingerTime
+		self.pipeline = None
+		self.server = None
+		self.sessions = set()
+		self.holders = {} # (ip, port) -> set of sessions holding the scanner
+		self.pinned = set() # (ip, port) kept connected without a worker holding them
+		self.autoStart = None # AutoStarter of the active profile's scanners
+		self.startup = None # StartupTimer of the daemon
+		self.discovery = None # DiscoveryService, started by the first worker asking for it
+		self.forwardedLoggers = {} # log name -> logger writing the records forwarded by the workers ('webapp', 'barcode')
+		self.lock = threading.Lock()
+		self.stopEvent = threading.Event()
+
+	def publish(self, ip, port, event, readTime=None, **fields):
+		data = encodeMessage({'op': 'notify', 'ip': ip, 'port': port, 'event': event, 'readTime': readTime, 'fields': fields})
+		with self.lock:
+			sessions = list(self.sessions)
+		for session in sessions:
+			session.put(data)
+
+	def serve(self, pipeline):
+		self.pipeline = pipeline
+		pipeline.start(spawnThread)
+		try:
+			os.unlink(self.path) # left behind by a daemon which did not stop cleanly
+		except FileNotFoundError:
+			pass
+		self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.server.bind(self.path)
+		os.chmod(self.path, 0o660)
+		self.server.listen(16)
+		self.logger.info('Ingest daemon listening on %s', self.path)
+		if self.startup is not None:
+			self.startup.mark('listening')
+		spawnThread(self._accept)
+		self.stopEvent.wait()
+		self.server.close()
+		with self.lock:
+			sessions = list(self.sessions)
+		for session in sessions:
+			session.close()
+		try:
+			os.unlink(self.path)
+		except OSError:
+			pass
+		self.logger.info('Ingest daemon stopped')
+
+	def stop(self):
+		self.stopEvent.set()
+
+	def _accept(self):
+		while not self.stopEvent.is_set():
+			try:
+				sock, addr = self.server.accept()
+			except OSError:
+				return
+			session = DaemonSession(sock, self.maxQueued)
+			with self.lock:
+				self.sessions.add(session)
+			self.logger.info('Web worker connected to the ingest daemon (%s connected)', len(self.sessions))
+			spawnThread(session.runWriter)
+			spawnThread(self._read, session)
+
+	def _read(self, session):
+		try:
+			with session.sock.makefile('rb') as rfile:
+				for line in rfile:
+					try:
+						message = json.loads(line.decode('utf-8'))
+					except ValueError:
+						self.logger.warning('Ingest daemon received an invalid message: %r', line[:200])
+						continue
+					# a message missing a key or with a bad value must not end the session (and release the worker's scanners)
+					try:
+						self._handle(session, message)
+					except Exception as e:
+						self.logger.warning('Ingest daemon received an invalid message: %r (%s: %s)', line[:200], type(e).__name__, e)
+		except OSError:
+			pass
+		finally:
+			self._disconnect(session)
+
+	def _handle(self, session, message):
+		op = message.get('op')
+		if op == 'addScanner':
+			key = (str(message['ip']), int(message['port']))
+			with self.lock:
+				self.holders.setdefault(key, set()).add(session)
+				session.scanners.add(key)
+			self.pipeline.ingest.addScanner(key[0], key[1], message.get('framing', 'crlf'), message.get('serial'))
+		elif op == 'removeScanner':
+			key = (str(message['ip']), int(message['port']))
+			with self.lock:
+				session.scanners.discard(key)
+			self._release(session, key, message.get('delay', 0))
+		elif op == 'setHistoryDepth':
+			self.pipeline.setHistoryDepth(str(message['scanner']), int(message['depth']))
+		elif op == 'setProfile':
+			try:
+				if self.autoStart is not None:
+					self.autoStart.apply(message['profile'], spawnThread)
+				else:
+					self.pipeline.setProfile(message['profile'])
+			except ValueError as e:
+				self.logger.error('Ingest daemon received an invalid profile: %s', e)
+		elif op == 'startOutput':
+			spawnThread(self.pipeline.startOutput, spawnThread)
+		elif op == 'startDiscovery':
+			self.discovery.start(spawnThread)
+		elif op == 'log':
+			self._writeLog(message.get('log'), message.get('records') or [])
+		elif op == 'call' and message.get('name') == 'discoverwait':
+			# waits for discovery replies, without holding up the worker's other messages
+			spawnThread(lambda: session.put(encodeMessage(self._call(message))))
+		elif op == 'call':
+			session.put(encodeMessage(self._call(message)))
+		else:
+			self.logger.warning('Ingest daemon received an unknown message: %s', op)
+
+	# hand the records forwarded by a worker to the daemon's own logger of that log, keeping their time and level
+	def _writeLog(self, logname, records):
+		logger = self.forwardedLoggers.get(logname)
+		if logger is None:
+			self.logger.warning('Ingest daemon received records of an unknown log: %s', logname)
+			return
+		for created, levelno, text in records:
+			logger.handle(logging.makeLogRecord({'name': logger.name, 'levelno': levelno, 'levelname': logging.getLevelName(levelno), 'msg': text, 'created': created, 'msecs': (created % 1) * 1000}))
+
+	def _call(self, message):
+		reply = {'op': 'reply', 'id': message.get('id')}
+		name = message.get('name')
+		args = message.get('args') or {}
+		try:
+			if name == 'states':
+				reply['result'] = [[ip, port, state] for (ip, port), state in self.pipeline.ingest.getStates().items()]
+			elif name == 'history':
+				reply['result'] = self.pipeline.historyPage(str(args['scanner']), args.get('after'), args.get('before'), args.get('limit', 100))
+			elif name == 'histories':
+				reply['result'] = self.pipeline.historySummary()
+			elif name == 'output':
+				reply['result'] = self.pipeline.getOutputStats()
+			elif name == 'metrics':
+				reply['result'] = [[key[0], list(key[1]), value] for key, value in metrics.collect().items()]
+			elif name == 'startup':
+				reply['result'] = None if self.startup is None else self.startup.getStats()
+			elif name == 'logging':
+				reply['result'] = logPipeline.getStats()
+			elif name == 'discovered':
+				reply['result'] = self.discovery.getDevices()
+			elif name == 'discoverwait':
+				self.discovery.start(spawnThread)
+				reply['result'] = self.discovery.waitForDevices(float(args.get('wait', ovtimconfig.discoveryWaitTime)))
+			else:
+				raise ValueError('unknown call: ' + str(name))
+		except Exception as e:
+			if not isinstance(e, ValueError):
+				self.logger.exception('Ingest daemon call %s failed', name)
+			reply['error'] = str(e)
+			reply['errorType'] = type(e).__name__
+		return reply
+
+	# keep the scanner connected whether or not a worker holds it (see ovtimstartup.AutoStarter)
+	def pin(self, ip, port, framing='crlf', serialSettings=None):
+		key = (str(ip), int(port))
+		with self.lock:
+			self.pinned.add(key)
+		self.pipeline.ingest.addScanner(key[0], key[1], framing, serialSettings)
+
+	def unpin(self, ip, port):
+		key = (str(ip), int(port))
+		with self.lock:
+			if key not in self.pinned:
+				return
+			self.pinned.discard(key)
+			if key in self.holders:
+				return
+		self.pipeline.ingest.removeScanner(key[0], key[1], self.lingerTime)
+
+	# the worker no longer holds the scanner; the connection is closed after delay seconds if no other worker holds it
+	def _release(self, session, key, delay):
+		with self.lock:
+			holders = self.holders.get(key)
+			if holders is None or session not in holders:
+				return
+			holders.discard(session)
+			if holders:
+				return
+			del self.holders[key]
+			if key in self.pinned:
+				return
+		self.pipeline.ingest.removeScanner(key[0], key[1], delay)
+
+	def _disconnect(self, session):
+		session.close()
+		with self.lock:
+			self.sessions.discard(session)
+			scanners = list(session.scanners)
+			count = len(self.sessions)
+		for key in scanners:
+			self._release(session, key, self.lingerTime)
+		self.logger.info('Web worker disconnected from the ingest daemon (%s connected, %s message(s) dropped)', count, session.dropped)
+
+def main():
+	parser = argparse.ArgumentParser(description='Karlbox scanner ingest daemon')
+	parser.add_argument('--socket', default=ovtimconfig.ingestSocketPath, help='Unix domain socket the web workers connect to')
+	args = parser.parse_args()
+
+	# logs and journal are kept in the same places as the webapp's
+	packagePath = os.path.dirname(os.path.abspath(__file__))
+	logger = initLogging(packagePath, ovtimconfig.logConfigIngest)
+	barcodeLogger = initLogging(packagePath, ovtimconfig.logConfigBarcode)
+	webLogger = initLogging(packagePath, ovtimconfig.logConfigWebapp) # written for the web workers
+	logPipeline.reportLogger = logger
+	logCompressor.reportLogger = logger
+	startup = StartupTimer(logger, 'ingest daemon')
+	startup.mark('logging')
+	journal = BarcodeJournal(os.path.join(packagePath, ovtimconfig.journalDirectory), ovtimconfig.journalSegmentCapacity, ovtimconfig.journalRetentionDays)
+	histories = HistoryRegistry(ovtimconfig.barcodeHistoryDepth)
+	startup.mark('journal')
+
+	daemon = IngestDaemon(args.socket, logger, maxQueued=ovtimconfig.ingestClientQueueSize, lingerTime=ovtimconfig.scannerLingerTime)
+	pipeline = ScannerPipeline(daemon.publish, logger, barcodeLogger, journal, histories)
+	daemon.pipeline = pipeline
+	daemon.startup = startup
+	daemon.forwardedLoggers = {'webapp': webLogger, 'barcode': barcodeLogger}
+	daemon.discovery = DiscoveryService(logger, interval=ovtimconfig.discoveryInterval, forgetTime=ovtimconfig.discoveryForgetTime, extraAddresses=ovtimconfig.discoveryExtraAddresses)
+	signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+	signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+	if ovtimconfig.autoStart:
+		# the same profile store as the webapp's (see create_app)
+		profileStore = ProfileStore(os.path.join(packagePath, 'data', ovtimconfig.karlboxStoreFilePath), ovtimconfig.scannerPositions, ovtimconfig.storeHistoryDepth)
+		profileStore.importJson(os.path.join(packagePath, 'static', ovtimconfig.karlboxConfigFilePath))
+		configData = readConfig(logger, profileStore, ovtimconfig.possibleIniValues, ovtimconfig.possibleModelValues)
+		startup.mark('profiles')
+		daemon.autoStart = AutoStarter(pipeline, daemon, logger, startup, readyTimeout=ovtimconfig.startupReadyTimeout)
+		daemon.autoStart.apply(configData[1].get(configData[2], {}), spawnThread)
+		startup.mark('autostart')
+	try:
+		daemon.serve(pipeline)
+	finally:
+		pipeline.ingest.stop()
+		pipeline.output.stop()
+		pipeline.sinks.stop()
+		daemon.discovery.stop()
+		journal.close()
+
+if __name__ == '__main__':
+	main()
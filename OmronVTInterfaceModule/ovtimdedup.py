@@ -0,0 +1,85 @@
+from collections import deque
+
+# keys a barcode is deduplicated by: 'barcode' across every scanner of the cell, 'barcode+scanner' per scanner
+DEDUP_KEYS = ('barcode', 'barcode+scanner')
+
+# deduplication of the barcodes read by all scanners of a cell within a time window
+# every barcode passed on is remembered for window seconds (on the time.monotonic() clock); reading the same key again
+# within the window is a duplicate and starts the window again, so a board left in front of a scanner stays a duplicate
+# entries are kept in a dict (key -> [expiry, scanner, seq]) and a FIFO of (expiry, key): the window is fixed and the clock
+# monotonic, so expiries are appended in order; starting an entry's window again appends it once more and the item with the old
+# expiry is skipped when it comes up (compacting the FIFO once it holds more than twice as many items as there are entries),
+# which keeps adding, checking and expiring O(1) amortized
+# at most maxEntries barcodes are remembered, the ones that would expire first are forgotten first
+# Usage:
+#	dedup = DedupEngine(5.0, 'barcode')
+#	original = dedup.check('ABC123', '192.168.188.2:2001', time.monotonic())
+#	if original is None:
+#		dedup.add('ABC123', '192.168.188.2:2001', seq, time.monotonic())
+#	else:
+#		scanner, seq = original							(scanner and history sequence number of the first read)
+class DedupEngine(object):
+	def __init__(self, window=0, keyMode='barcode', maxEntries=100000):
+		if keyMode not in DEDUP_KEYS:
+			raise ValueError('unknown deduplication key: ' + str(keyMode))
+		self.window = float(window) # 0 disables the engine
+		self.keyMode = keyMode
+		self.maxEntries = int(maxEntries)
+		self.entries = {}
+		self.expiries = deque() # (expiry, key) in expiry order, including items of windows started again
+		self.evicted = 0 # entries forgotten before their window ended because maxEntries was reached
+
+	def _key(self, barcode, scanner):
+		if self.keyMode == 'barcode':
+			return barcode
+		return (barcode, scanner)
+
+	# returns tuple: (scanner, seq) of the first read if the barcode is a duplicate, None otherwise
+	def check(self, barcode, scanner, now):
+		if not self.window:
+			return None
+		self._expire(now)
+		key = self._key(barcode, scanner)
+		entry = self.entries.get(key)
+		if entry is None or entry[0] <= now:
+			return None
+		self._restart(key, entry, now + self.window)
+		return (entry[1], entry[2])
+
+	# remembers a barcode passed on; seq is its sequence number in the scanner's history
+	def add(self, barcode, scanner, seq, now):
+		if not self.window:
+			return
+		key = self._key(barcode, scanner)
+		expiry = now + self.window
+		entry = self.entries.get(key)
+		if entry is not None:
+			entry[1:] = [scanner, seq]
+			self._restart(key, entry, expiry)
+			return
+		self.entries[key] = [expiry, scanner, seq]
+		self.expiries.append((expiry, key))
+		while len(self.entries) > self.maxEntries:
+			expiry, key = self.expiries.popleft()
+			entry = self.entries.get(key)
+			if entry is not None and entry[0] == expiry:
+				del self.entries[key]
+				self.evicted += 1
+
+	def _restart(self, key, entry, expiry):
+		entry[0] = expiry
+		self.expiries.append((expiry, key))
+		if len(self.expiries) > 2 * len(self.entries) + 16:
+			entries = self.entries
+			self.expiries = deque(item for item in self.expiries if item[1] in entries and entries[item[1]][0] == item[0])
+
+	def _expire(self, now):
+		expiries = self.expiries
+		while expiries and expiries[0][0] <= now:
+			expiry, key = expiries.popleft()
+			entry = self.entries.get(key)
+			if entry is not None and entry[0] <= now:
+				del self.entries[key]
+
+	def __len__(self):
+		return len(self.entries)
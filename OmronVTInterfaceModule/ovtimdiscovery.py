@@ -0,0 +1,161 @@
+import socket
+import struct
+import threading
+import time
+
+DISCOVERY_PORT = 30717
+DISCOVERY_QUERY = b"<op,019,00,FF:FF:FF:FF:FF:FF,255.255.255.255,espmac,espip,0,0>"
+
+# linux ioctls used to list the broadcast address of every interface
+SIOCGIFFLAGS = 0x8913
+SIOCGIFBRDADDR = 0x8919
+IFF_UP = 0x1
+IFF_BROADCAST = 0x2
+IFF_LOOPBACK = 0x8
+
+# returns the IPv4 broadcast addresses of every interface which is up (sorted, without loopback)
+# returns ['255.255.255.255'] if they can not be determined (e.g. not on linux)
+def getBroadcastAddresses():
+	addresses = set()
+	try:
+		import fcntl
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		try:
+			for index, name in socket.if_nameindex():
+				request = struct.pack('256s', name.encode()[:15])
+				try:
+					flags = struct.unpack('H', fcntl.ioctl(sock.fileno(), SIOCGIFFLAGS, request)[16:18])[0]
+					if not flags & IFF_UP or flags & IFF_LOOPBACK or not flags & IFF_BROADCAST:
+						continue
+					addresses.add(socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFBRDADDR, request)[20:24]))
+				except OSError: # interface has no IPv4 address
+					continue
+		finally:
+			sock.close()
+	except (ImportError, OSError):
+		pass
+	return sorted(addresses) or ['255.255.255.255']
+
+# parses the reply of a MicroHAWK scanner to the discovery query
+# returns dict: {'mac', 'ip', 'tcp1', 'tcp2', 'name', 'model', 'serial', 'firmware', 'weblink'}, or None if data is not a reply (e.g. our own query)
+def parseReply(data):
+	try:
+		fields = data.decode(errors='replace').split(',')
+		if fields[6] == 'espip':
+			return None
+		return {'mac': fields[5], 'ip': fields[6], 'tcp1': fields[14], 'tcp2': fields[15], 'name': fields[17], 'model': fields[19].split('=')[1], 'serial': fields[22].split('=')[1], 'firmware': fields[23].split('=')[1], 'weblink': fields[24].split('=')[1]}
+	except IndexError:
+		return None
+
+# finds MicroHAWK scanners on every local subnet by broadcasting the discovery query every interval seconds
+# every reply updates an inventory keyed by MAC address; scanners which did not reply for forgetTime seconds are removed
+# Usage:
+#	discovery = DiscoveryService(app.logger, interval=15, forgetTime=300)
+#	discovery.start(socketio.start_background_task)
+#	discovery.getDevices()								(most recently seen first)
+#	discovery.waitForDevices(3)							(broadcasts now and waits up to 3 seconds if nothing was found yet)
+class DiscoveryService(object):
+	def __init__(self, logger, interval=15, forgetTime=300, extraAddresses=(), port=DISCOVERY_PORT):
+		self.logger = logger
+		self.interval = interval
+		self.forgetTime = forgetTime
+		self.extraAddresses = list(extraAddresses)
+		self.port = port
+		self.devices = {} # mac -> device dict (parseReply fields plus 'source', 'firstSeen', 'lastSeen')
+		self.condition = threading.Condition()
+		self.sock = None
+		self.running = False
+		self.broadcasts = 0
+		self.lastBroadcast = 0
+
+	# open the socket and start the worker once, using the given function to spawn it (e.g. socketio.start_background_task)
+	def start(self, spawn):
+		with self.condition:
+			if self.running:
+				return False
+			try:
+				sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+				sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+				sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+				sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+				sock.bind(('', self.port))
+			except OSError as e:
+				self.logger.error('ScannerDiscovery- Unable to listen on UDP port %s: %s', self.port, e)
+				return False
+			self.sock = sock
+			self.running = True
+		spawn(self.run)
+		return True
+
+	def stop(self):
+		with self.condition:
+			self.running = False
+
+	# send the discovery query to every broadcast address now (unless it was sent less than a second ago)
+	def refresh(self):
+		if self.sock is None or time.monotonic() - self.lastBroadcast < 1:
+			return
+		self.lastBroadcast = time.monotonic()
+		self.broadcasts += 1
+		for address in getBroadcastAddresses() + [x for x in self.extraAddresses if x]:
+			try:
+				self.sock.sendto(DISCOVERY_QUERY, (address, self.port))
+			except OSError as e:
+				self.logger.debug('ScannerDiscovery- Unable to send query to %s: %s', address, e)
+
+	# returns list of device dicts with their 'age' in seconds, most recently seen first
+	def getDevices(self):
+		now = time.time()
+		with self.condition:
+			devices = [dict(device, age=round(now - device['lastSeen'], 1)) for device in self.devices.values()]
+		return sorted(devices, key=lambda device: device['age'])
+
+	# returns getDevices(), broadcasting and waiting up to timeout seconds for a reply if no device was found yet
+	def waitForDevices(self, timeout):
+		if not self.devices:
+			self.refresh()
+			with self.condition:
+				self.condition.wait_for(lambda: self.devices or not self.running, timeout)
+		return self.getDevices()
+
+	def run(self):
+		self.logger.info('ScannerDiscovery- Listening for scanners on UDP port %s', self.port)
+		nextBroadcast = 0
+		while self.running:
+			if time.monotonic() >= nextBroadcast:
+				self.refresh()
+				self._forget()
+				nextBroadcast = time.monotonic() + self.interval
+			try:
+				self.sock.settimeout(max(0.1, min(1, nextBroadcast - time.monotonic())))
+				data, addr = self.sock.recvfrom(1024)
+			except socket.timeout:
+				continue
+			except OSError as e:
+				self.logger.debug('ScannerDiscovery- Error while listening for replies: %s', e)
+				time.sleep(1)
+				continue
+			device = parseReply(data)
+			if device is not None:
+				self._update(device, addr[0])
+		self.sock.close()
+		self.sock = None
+
+	def _update(self, device, source):
+		now = time.time()
+		with self.condition:
+			known = self.devices.get(device['mac'])
+			device['source'] = source
+			device['firstSeen'] = now if known is None else known['firstSeen']
+			device['lastSeen'] = now
+			self.devices[device['mac']] = device
+			self.condition.notify_all()
+		if known is None or known['ip'] != device['ip']:
+			self.logger.info('ScannerDiscovery- Found device: mac: %s, ip: %s, tcp1: %s, tcp2: %s, name: %s, model: %s, serial: %s, firmware: %s', device['mac'], device['ip'], device['tcp1'], device['tcp2'], device['name'], device['model'], device['serial'], device['firmware'])
+
+	def _forget(self):
+		limit = time.time() - self.forgetTime
+		with self.condition:
+			for mac in [mac for mac, device in self.devices.items() if device['lastSeen'] < limit]:
+				self.logger.info('ScannerDiscovery- Device %s (%s) did not reply for %s seconds, removed', mac, self.devices[mac]['ip'], self.forgetTime)
+				del self.devices[mac]
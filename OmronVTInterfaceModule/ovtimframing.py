@@ -0,0 +1,161 @@
+import os
+
+STX = 0x02
+ETX = 0x03
+
+# framing modes supported by the scanners' output format settings
+# 	'crlf'		frames terminated by <CR><LF> (scanner default)
+#	'stxetx'	frames wrapped in <STX> ... <ETX>; anything outside a frame is discarded
+#	'fixed:N'	fixed-length frames of N bytes with no delimiter
+# returns tuple: (mode, frameLength)
+# raises ValueError if the spec is not valid
+def parseFraming(spec):
+	spec = str(spec).strip().lower()
+	if spec in ('', 'crlf'):
+		return ('crlf', 0)
+	if spec == 'stxetx':
+		return ('stxetx', 0)
+	if spec.startswith('fixed:'):
+		frameLength = int(spec.split(':', 1)[1])
+		if frameLength < 1:
+			raise ValueError('fixed frame length must be at least 1')
+		return ('fixed', frameLength)
+	raise ValueError('unknown framing: ' + spec)
+
+# streaming frame parser with a preallocated receive buffer
+# data is read straight into the buffer (recv_into/readv), and every complete frame is split out in one pass
+# Usage:
+#	reader = FrameReader('crlf')
+#	if reader.recvFrom(sock) == 0: (peer closed the connection)
+#	for frame in reader.frames(): ...
+class FrameReader(object):
+	def __init__(self, framing='crlf', bufferSize=8192, terminator=b'\r\n'):
+		self.mode, self.frameLength = parseFraming(framing)
+		if self.frameLength > bufferSize:
+			bufferSize = self.frameLength
+		self.terminator = terminator
+		self.buffer = bytearray(bufferSize)
+		self.view = memoryview(self.buffer)
+		self.end = 0 # number of valid bytes in the buffer
+		self.pending = [] # frames split out by feed to make room, returned by the next frames() call
+		self.overflows = 0 # number of times an oversized frame was discarded
+		self.discarding = False # True after an overflow until the terminator of the discarded frame was read ('crlf')
+
+	# read from a socket into the free part of the buffer
+	# returns number of bytes read (0 means the peer closed the connection)
+	def recvFrom(self, sock):
+		self._makeRoom()
+		count = sock.recv_into(self.view[self.end:])
+		self.end += count
+		return count
+
+	# read from a file descriptor (e.g. a serial port) into the free part of the buffer
+	def readFrom(self, fd):
+		self._makeRoom()
+		count = os.readv(fd, [self.view[self.end:]])
+		self.end += count
+		return count
+
+	# feed bytes which were read elsewhere
+	# data larger than the free part of the buffer is taken in pieces, splitting out the complete frames whenever the buffer is full
+	def feed(self, data):
+		data = memoryview(data)
+		self._makeRoom()
+		while len(data) > len(self.buffer) - self.end:
+			taken = len(self.buffer) - self.end
+			self.view[self.end:] = data[:taken]
+			self.end += taken
+			data = data[taken:]
+			self.pending.extend(self._split())
+			self._makeRoom()
+		self.view[self.end:self.end + len(data)] = data
+		self.end += len(data)
+
+	# returns list of every complete frame in the buffer (as bytes, without delimiters) and keeps any partial frame
+	def frames(self):
+		frames = self._split()
+		if self.pending:
+			frames = self.pending + frames
+			self.pending = []
+		return frames
+
+	def reset(self):
+		self.end = 0
+		self.pending = []
+		self.discarding = False
+
+	def _split(self):
+		if self.mode == 'crlf':
+			frames, consumed = self._splitDelimited()
+		elif self.mode == 'stxetx':
+			frames, consumed = self._splitStxEtx()
+		else:
+			frames, consumed = self._splitFixed()
+		self._compact(consumed)
+		return frames
+
+	def _splitDelimited(self):
+		frames = []
+		buf = self.buffer
+		terminator = self.terminator
+		start = 0
+		if self.discarding:
+			# the rest of an oversized frame is dropped up to and including its terminator
+			stop = buf.find(terminator, 0, self.end)
+			if stop == -1:
+				return frames, self.end - self._partialTerminator()
+			self.discarding = False
+			start = stop + len(terminator)
+		while True:
+			stop = buf.find(terminator, start, self.end)
+			if stop == -1:
+				return frames, start
+			if stop > start:
+				frames.append(bytes(self.view[start:stop]))
+			start = stop + len(terminator)
+
+	def _splitStxEtx(self):
+		frames = []
+		buf = self.buffer
+		start = 0
+		while True:
+			begin = buf.find(STX, start, self.end)
+			if begin == -1:
+				return frames, self.end # nothing but noise left
+			stop = buf.find(ETX, begin + 1, self.end)
+			if stop == -1:
+				return frames, begin
+			frames.append(bytes(self.view[begin + 1:stop]))
+			start = stop + 1
+
+	def _splitFixed(self):
+		count = self.end // self.frameLength
+		frames = [bytes(self.view[i * self.frameLength:(i + 1) * self.frameLength]) for i in range(count)]
+		return frames, count * self.frameLength
+
+	# move the partial frame (if any) to the start of the buffer
+	def _compact(self, consumed):
+		if consumed == 0:
+			return
+		remaining = self.end - consumed
+		if remaining:
+			self.view[:remaining] = self.view[consumed:self.end]
+		self.end = remaining
+
+	# returns number of bytes at the end of the buffer which are the start of the terminator (e.g. a <CR> waiting for its <LF>)
+	def _partialTerminator(self):
+		for length in range(min(len(self.terminator) - 1, self.end), 0, -1):
+			if self.buffer[self.end - length:self.end] == self.terminator[:length]:
+				return length
+		return 0
+
+	# a full buffer with no complete frame can never make progress, so drop its contents
+	# ('crlf' keeps a partial terminator and drops the rest of the frame once it is read, so it is not taken for a barcode)
+	def _makeRoom(self):
+		if self.end == len(self.buffer):
+			self.overflows += 1
+			if self.mode == 'crlf':
+				self.discarding = True
+				self._compact(self.end - self._partialTerminator())
+			else:
+				self.end = 0
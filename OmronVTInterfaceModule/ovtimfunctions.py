@@ -5,53 +5,127 @@ import json
 import os
 import logging
 import logging.handlers
-import ipaddress
-from telnetlib import Telnet
 import threading
-import socket
+import select
 
+import OmronVTInterfaceModule.ovtimconfig as ovtimconfig
+from OmronVTInterfaceModule.ovtimlogging import CompressingRotatingFileHandler, ForwardingHandler, logCompressor, logPipeline
+from OmronVTInterfaceModule.ovtimmetrics import metrics
+from OmronVTInterfaceModule.ovtimvalidator import getValidator
+
+# serial transport to the inspection machine
+# writes are non-blocking; send() waits for the output queue to actually drain instead of sleeping a fixed time
+# Usage:
+#	tm = TimeManager('/dev/ttyTHS2')
+#	tm.send(b'barcode\r\n')				write and wait until the bytes have left the UART
+#	tm.request(b'barcode\r\n', b'\x06')	write and wait for the inspection machine to acknowledge
 class TimeManager(object):
-	def __init__(self, port, baudrate=9600):
-		self.ser = serial.Serial(port, baudrate=baudrate, bytesize=8, stopbits=1, parity='N')
-		time.sleep(3)
+	def __init__(self, port, baudrate=9600, bytesize=8, stopbits=1, parity='N', writeTimeout=5):
+		self.ser = serial.Serial(port, baudrate=baudrate, bytesize=bytesize, stopbits=stopbits, parity=parity, timeout=0, write_timeout=0)
 		self.ser.reset_input_buffer()
 		self.ser.reset_output_buffer()
+		self.writeTimeout = writeTimeout
+		# time it takes one byte (start bit + data bits + parity bit + stop bits) to leave the UART
+		self.byteTime = (1 + bytesize + stopbits + (0 if parity == 'N' else 1)) / float(baudrate)
+		try:
+			self.fd = self.ser.fileno()
+		except (AttributeError, serial.SerialException):
+			self.fd = None # no file descriptor (e.g. Windows), fall back to blocking calls
 
 	def send(self, tx):
-		tx = bytearray(tx)
-		#print(tx)
+		tx = bytes(tx)
+		start = clk()
 		try:
-			self.ser.write(tx)
-			time.sleep(2)
-			self.ser.flush()
-			time.sleep(2)
+			self.write(tx)
+			self.drain()
+			metrics.observe('karlbox_serial_write_seconds', clk() - start)
+			metrics.inc('karlbox_serial_written_bytes_total', (), len(tx))
 		except serial.SerialException as e:
+			metrics.inc('karlbox_serial_errors_total')
 			if e.args == (5, "WriteFile", "Access is denied."):
 				raise IOError(serial.SerialException.errno.ENOENT, "Serial port disappeared.", self.ser.portstr)
 			else:
 				raise
 
-	def receive(self):
+	# write all bytes without blocking the caller on a full output buffer
+	def write(self, tx):
+		view = memoryview(tx)
+		deadline = clk() + self.writeTimeout
+		while len(view):
+			written = self.ser.write(view) or 0
+			view = view[written:]
+			if not len(view):
+				break
+			remaining = deadline - clk()
+			if remaining <= 0:
+				raise serial.SerialTimeoutException('Write timeout')
+			if self.fd is None:
+				time.sleep(min(remaining, self.byteTime * len(view)))
+			else:
+				select.select([], [self.fd], [], remaining)
+
+	# wait until the output queue is empty (the last byte has been handed to the UART)
+	def drain(self, timeout=None):
+		if timeout is None:
+			timeout = self.writeTimeout
+		deadline = clk() + timeout
+		while True:
+			try:
+				waiting = self.ser.out_waiting
+			except (AttributeError, NotImplementedError, OSError, serial.SerialException):
+				self.ser.flush() # tcdrain
+				return
+			if waiting == 0:
+				return
+			remaining = deadline - clk()
+			if remaining <= 0:
+				raise serial.SerialTimeoutException('Output did not drain within ' + str(timeout) + ' seconds')
+			# sleep for roughly the time the queued bytes need to go out
+			time.sleep(min(remaining, max(waiting * self.byteTime, 1e-3)))
+
+	# wait for incoming data until terminator is received
+	# returns bytearray of everything read (including the terminator)
+	def receive(self, terminator=b'\x00', timeout=5):
 		rx = bytearray()
-		delay = 10e-3 # s
-		timeout = 5 # s
 		end_time = clk() + timeout
-		while True:
+		while terminator not in rx:
 			time_remaining = end_time - clk()
-			if time_remaining < 0:
-				break
-			rx += self.ser.read(self.ser.inWaiting())
-			if 0 in rx:
-				break
-			time.sleep(delay)
-		if time_remaining <= 0:
-			raise IOError(serial.SerialTimeoutException, "Communication timed out.")
+			if time_remaining <= 0:
+				raise IOError(serial.SerialTimeoutException, "Communication timed out.")
+			if self.fd is None:
+				self.ser.timeout = time_remaining
+				rx += self.ser.read(max(1, self.ser.in_waiting))
+				continue
+			readable, _, _ = select.select([self.fd], [], [], time_remaining)
+			if readable:
+				rx += self.ser.read(max(1, self.ser.in_waiting))
 		return rx
 
+	# request/ack mode: send tx and wait for the inspection machine to acknowledge it
+	# returns bytearray containing the response
+	def request(self, tx, ack=b'\x06', timeout=2):
+		self.ser.reset_input_buffer()
+		self.send(tx)
+		return self.receive(terminator=ack, timeout=timeout)
+
+	def close(self):
+		self.ser.close()
+
 # initialize logging
+# records are written asynchronously by ovtimlogging.logPipeline; the log rotates at midnight and whenever it grows past
+# logmaxbytes, and finished segments are compressed (keeping logrotatecount of them, logmaxtotalbytes at most) by ovtimlogging.logCompressor
+# forwarded logs are written by the ingest daemon instead (daemon mode, see ovtimlogging.ForwardingHandler); the handler's send
+# is set once the connection to the daemon exists, the records logged until then are kept
 # returns configured logger object
 # Usage: app.logger = initLogging(app.instance_path, ovtimconfig.logConfigWebapp)
-def initLogging(appInstancePath, configDict):
+def initLogging(appInstancePath, configDict, forwarded=False):
+	if forwarded:
+		configDict['loghandler'] = ForwardingHandler(configDict['logname'], configDict['basefilename'])
+		logger = logging.getLogger(configDict['logname'])
+		logger.addHandler(logPipeline.queueHandler(configDict['loghandler']))
+		logger.setLevel(configDict['loglevel'])
+		return logger
+
 	# create log directory if it doesnt exist
 	logDirectoryPath = os.path.join(appInstancePath, configDict['logdirectory'])
 	if not os.path.isdir(logDirectoryPath):
@@ -59,23 +133,104 @@ def initLogging(appInstancePath, configDict):
 
 	# initialize handler, formatter, and log level
 	logFilepath = os.path.join(logDirectoryPath, configDict['basefilename'])
-	configDict['loghandler'] = logging.handlers.TimedRotatingFileHandler(filename=logFilepath, when='midnight', backupCount=configDict['logrotatecount'])
+	configDict['loghandler'] = CompressingRotatingFileHandler(logFilepath, maxBytes=configDict['logmaxbytes'], backupCount=configDict['logrotatecount'], maxTotalBytes=configDict['logmaxtotalbytes'], compressor=logCompressor)
 	configDict['logformatter'] = logging.Formatter(configDict['logmsgformat'], datefmt=configDict['logdateformat'])
 	configDict['loghandler'].setFormatter(configDict['logformatter'])
 	logger = logging.getLogger(configDict['logname'])
-	logger.addHandler(configDict['loghandler'])
+	# the file handler is driven by the logging pipeline's background listener; the logger itself only enqueues records
+	logger.addHandler(logPipeline.queueHandler(configDict['loghandler']))
 	logger.setLevel(configDict['loglevel'])
-	logger.critical('Logging started for ' + str(configDict['logname']))
+	logger.critical('Logging started for %s', configDict['logname'])
 	return logger
 
-# read and parse config file
+# copy the known values of one profile and validate them
+# a profile may list its own scanner positions (e.g. "positions": ["bs", "ts", "s3"]), otherwise ovtimconfig.scannerPositions are used
+# returns tuple: (dict containing the profile values, returncode) using the readConfig returncode values
+def validateProfile(weblogger, profile, possibleIniValues, possibleModelValues):
+	positions = profile.get('positions', ovtimconfig.scannerPositions)
+	if not isinstance(positions, list) or not all(isinstance(x, str) and x.isalnum() for x in positions):
+		weblogger.warning('Config file: invalid positions for profile %s: %s', profile.get('profilename'), positions)
+		positions = ovtimconfig.scannerPositions
+	return getValidator(positions, possibleModelValues, possibleIniValues).validate(weblogger, profile)
+
+# cache of the parsed and validated config, keyed on the file's mtime, inode and size (or the ProfileStore's data version)
+# profiles are revalidated individually, only when their contents changed
+class ConfigCache(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.fileKey = None
+		self.result = None # tuple: (readConfig tuple, json string)
+		self.profiles = {} # profile json -> (dict containing the profile values, returncode)
+
+	# drop the cached file so that the next read parses it again (validated profiles are kept)
+	def invalidate(self):
+		with self.lock:
+			self.fileKey = None
+			self.result = None
+
+	# configSource is the path of a json config file or a ProfileStore
+	# returns tuple: (readConfig tuple, json string)
+	def read(self, weblogger, configSource, possibleIniValues, possibleModelValues):
+		if isinstance(configSource, str):
+			stat = os.stat(configSource)
+			fileKey = (configSource, stat.st_mtime_ns, stat.st_ino, stat.st_size)
+		else:
+			fileKey = configSource.cacheKey()
+		with self.lock:
+			if self.fileKey == fileKey:
+				metrics.inc('karlbox_config_reads_total', ('hit',))
+				return self.result
+			start = clk()
+			if isinstance(configSource, str):
+				with open(configSource, 'r') as cfile:
+					karlboxConfig = json.load(cfile)
+			else:
+				karlboxConfig = configSource.loadConfig()
+			weblogger.debug('Config file: (re)loading %s', fileKey[0])
+			profiles = {}
+			configTuple = parseConfig(weblogger, karlboxConfig, possibleIniValues, possibleModelValues, _ProfileCache(self.profiles, profiles))
+			self.profiles = profiles # only keep profiles which are still in the file
+			self.result = (configTuple, json.dumps(karlboxConfig))
+			self.fileKey = fileKey
+			metrics.inc('karlbox_config_reads_total', ('load',))
+			metrics.observe('karlbox_config_load_seconds', clk() - start)
+			return self.result
+
+# validates profiles for one ConfigCache.read, reusing the results of unchanged profiles
+class _ProfileCache(object):
+	def __init__(self, previous, current):
+		self.previous = previous
+		self.current = current
+
+	def validate(self, weblogger, profile, possibleIniValues, possibleModelValues):
+		profileKey = json.dumps(profile, sort_keys=True)
+		if profileKey in self.previous:
+			result = self.previous[profileKey]
+		else:
+			result = validateProfile(weblogger, profile, possibleIniValues, possibleModelValues)
+		self.current[profileKey] = result
+		return result
+
+configCache = ConfigCache()
+
+# read and parse config from a json config file or a ProfileStore
+# the parsed result is cached until the config changes (see ConfigCache)
 # returns tuple: (returncode, dict containing all profiles, name of active profile, active profile has bottom side = 1 else 0, active profile has top side = 1 else 0)
 # returncode values:
 # 	0	no error
 #	1	warning but all values could be parsed correctly (example no active profile)
 #	2	error which prevents at least 1 profile from being parsed. (example no IP set) dictProfiles and activeprofiles will still return values
 #	3	error which prevents the config file from being parsed (no profiles, both top and bottom sides have errors, etc)
-def readConfig(weblogger, karlboxConfigFilePath, possibleIniValues, possibleModelValues):
+def readConfig(weblogger, configSource, possibleIniValues, possibleModelValues):
+	return configCache.read(weblogger, configSource, possibleIniValues, possibleModelValues)[0]
+
+# returns the config contents as a json string (cached like readConfig)
+def readConfigJson(weblogger, configSource, possibleIniValues, possibleModelValues):
+	return configCache.read(weblogger, configSource, possibleIniValues, possibleModelValues)[1]
+
+# parse an already loaded config file (dict)
+# returns the readConfig tuple; profiles are validated through profileCache when given
+def parseConfig(weblogger, karlboxConfig, possibleIniValues, possibleModelValues, profileCache=None):
 
 	dictProfiles = {}
 	returnCode = 0
@@ -84,8 +239,6 @@ def readConfig(weblogger, karlboxConfigFilePath, possibleIniValues, possibleMode
 	topEnabled = 0
 	#returnTuple = ((returnCode, dictProfiles, activeProfile, bottomEnabled, topEnabled))
 
-	karlboxConfig = json.load(open(karlboxConfigFilePath, 'r'))
-
 	# check for existence of main section and if active profile is set
 	try:
 		if len(karlboxConfig['profiles']) <= 1:
@@ -96,7 +249,7 @@ def readConfig(weblogger, karlboxConfigFilePath, possibleIniValues, possibleMode
 			if 'activeProfile' in karlboxConfig['main']:
 				if len([x for x in karlboxConfig['profiles'] if x['profilename'] == karlboxConfig['main']['activeProfile']]) > 0:
 					activeProfile = karlboxConfig['main']['activeProfile']
-					weblogger.debug('Config file: active profile: ' + str(activeProfile))
+					weblogger.debug('Config file: active profile: %s', activeProfile)
 				else:
 					weblogger.warning('Config file: active profile not in config file')
 					returnCode = 1
@@ -108,300 +261,70 @@ def readConfig(weblogger, karlboxConfigFilePath, possibleIniValues, possibleMode
 			returnCode = 3
 			return ((returnCode, dictProfiles, activeProfile, bottomEnabled, topEnabled))
 	except Exception as e:
-		weblogger.error('Config file: error reading config- general exception reading sections: ' + str(e))
+		weblogger.error('Config file: error reading config- general exception reading sections: %s', e)
 		returnCode = 3
 		return ((returnCode, dictProfiles, activeProfile, bottomEnabled, topEnabled))
 	
 	# store all profiles
+	validate = validateProfile if profileCache is None else profileCache.validate
 	for profile in karlboxConfig["profiles"]:
-		profilename = profile['profilename']
 		try:
-			dictProfiles[profilename] = {}
-			for key in possibleIniValues:
-				if key in profile.keys():
-					dictProfiles[profilename][key] = profile[key]
-				else:
-					dictProfiles[profilename][key] = ''
+			profilename = profile['profilename']
+			dictProfiles[profilename], profileReturnCode = validate(weblogger, profile, possibleIniValues, possibleModelValues)
 		except Exception as e:
-			weblogger.error('Config file: general exception reading profile values: ' + str(e))
+			weblogger.error('Config file: general exception reading profile values: %s', e)
 			returnCode = 2
 			continue
- 
-		# check for existence of and validate values
-		# bottom scanner
-		dictProfiles[profilename]['bsenabled'] = 1
-		if str(dictProfiles[profilename]['bscommtype']).lower() != 'rs232': # if commtype is not rs 232, it should be ethernet or "unknown" (default to ethernet)
-			# check for valid IP
-			dictProfiles[profilename]['bscommtype'] = 'ethernet'
-			try:
-				ip = ipaddress.ip_address(dictProfiles[profilename]['bsip'])
-			except Exception as e:
-				weblogger.warning('Config file: invalid bsip for ethernet commType: ' + str(dictProfiles[profilename]['bsip']) + ' (error msg): ' + str(e))
-				dictProfiles[profilename]['bsenabled'] = 0
-				returnCode = 2
-
-			# check for valid port
-			try:
-				port = int(dictProfiles[profilename]['bsport'])
-				if 1 <= port <= 65535:
-					pass
-				else:
-					raise Exception
-			except Exception:
-				weblogger.warning('Config file: invalid bsport for ethernet commType: ' + str(dictProfiles[profilename]['bsport']))
-				dictProfiles[profilename]['bsenabled'] = 0
-				returnCode = 2
-		else: # commtype is rs232
-			# (attempt to) check for valid port
-			try:
-				if not str(dictProfiles[profilename]['bsport']).lower().startswith('com') and str(dictProfiles[profilename]['bsport']).lower().find('tty') == -1:
-					# port doesnt start with com or contain tty in the value
-					weblogger.warning('Config file: invalid bsport for serial commType: ' + str(dictProfiles[profilename]['bsport']))
-					dictProfiles[profilename]['bsenabled'] = 0
-					returnCode = 2
-			except Exception as e:
-				weblogger.warning('Config file: invalid bsport for serial commType: ' + str(dictProfiles[profilename]['bsport']) + '(error msg): ' + str(e))
-				dictProfiles[profilename]['bsenabled'] = 0
-				returnCode = 2
-			
-			# check for valid baud rate
-			try:
-				if int(dictProfiles[profilename]['bsbaud']) not in serial.Serial.BAUDRATES:
-					weblogger.warning('Config file: invalid bsbaud for serial commType: ' + str(dictProfiles[profilename]['bsbaud']))
-					dictProfiles[profilename]['bsenabled'] = 0
-					returnCode = 2
-			except Exception as e:
-				weblogger.warning('Config file: invalid bsbaud for serial commType: ' + str(dictProfiles[profilename]['bsbaud']) + '(error msg): ' + str(e))
-				dictProfiles[profilename]['bsenabled'] = 0
-				returnCode = 2
-			
-			# check for valid byte size
-			try:
-				if int(dictProfiles[profilename]['bsbytesize']) not in serial.Serial.BYTESIZES:
-					weblogger.warning('Config file: invalid bsbytesize for serial commType: ' + str(dictProfiles[profilename]['bsbytesize']))
-					dictProfiles[profilename]['bsenabled'] = 0
-					returnCode = 2
-			except Exception as e:
-				weblogger.warning('Config file: invalid bsbytesize for serial commType: ' + str(dictProfiles[profilename]['bsbytesize']) + '(error msg): ' + str(e))
-				dictProfiles[profilename]['bsenabled'] = 0
-				returnCode = 2
-			
-			# check for valid stop bit
-			try:
-				if int(dictProfiles[profilename]['bsstopbit']) not in serial.Serial.STOPBITS:
-					weblogger.warning('Config file: invalid bsstopbit for serial commType: ' + str(dictProfiles[profilename]['bsstopbit']))
-					dictProfiles[profilename]['bsenabled'] = 0
-					returnCode = 2
-			except Exception as e:
-				weblogger.warning('Config file: invalid bsstopbit for serial commType: ' + str(dictProfiles[profilename]['bsstopbit']) + '(error msg): ' + str(e))
-				dictProfiles[profilename]['bsenabled'] = 0
-				returnCode = 2
-			
-			# check for valid parity
-			try:
-				if str(dictProfiles[profilename]['bsparity']) not in serial.Serial.PARITIES:
-					weblogger.warning('Config file: invalid bsparity for serial commType: ' + str(dictProfiles[profilename]['bsparity']))
-					dictProfiles[profilename]['bsenabled'] = 0
-					returnCode = 2
-			except Exception as e:
-				weblogger.warning('Config file: invalid bsparity for serial commType: ' + str(dictProfiles[profilename]['bsparity']) + '(error msg): ' + str(e))
-				dictProfiles[profilename]['bsenabled'] = 0
-				returnCode = 2
-		# check for valid model number
-		try:
-			if str(dictProfiles[profilename]['bsmodel']).lower() not in possibleModelValues:
-				dictProfiles[profilename]['bsmodel'] = 'Other Scanner'
-		except Exception:
-			dictProfiles[profilename]['bsmodel'] = 'Other Scanner'
-
-		# top scanner
-		dictProfiles[profilename]['tsenabled'] = 1
-		if str(dictProfiles[profilename]['tscommtype']).lower() != 'rs232':
-			dictProfiles[profilename]['tscommtype'] = 'ethernet'
-			# check for valid IP
-			try:
-				ip = ipaddress.ip_address(dictProfiles[profilename]['tsip'])
-			except Exception as e:
-				weblogger.warning('Config file: invalid tsip for ethernet commType: ' + str(dictProfiles[profilename]['tsip']) + ' (error msg): ' + str(e))
-				dictProfiles[profilename]['tsenabled'] = 0
-				returnCode = 2
-
-			# check for valid port
-			try:
-				port = int(dictProfiles[profilename]['tsport'])
-				if 1 <= port <= 65535:
-					pass
-				else:
-					raise Exception
-			except Exception:
-				weblogger.warning('Config file: invalid tsport for ethernet commType: ' + str(dictProfiles[profilename]['tsport']))
-				dictProfiles[profilename]['tsenabled'] = 0
-				returnCode = 2
-		else:
-			# (attempt to) check for valid port
-			try:
-				if not str(dictProfiles[profilename]['tsport']).lower().startswith('com') and str(dictProfiles[profilename]['tsport']).lower().find('tty') == -1:
-					# port doesnt start with com or contain tty in the value
-					weblogger.warning('Config file: invalid tsport for serial commType: ' + str(dictProfiles[profilename]['tsport']))
-					dictProfiles[profilename]['tsenabled'] = 0
-					returnCode = 2
-			except Exception as e:
-				weblogger.warning('Config file: invalid tsport for serial commType: ' + str(dictProfiles[profilename]['tsport']) + '(error msg): ' + str(e))
-				dictProfiles[profilename]['tsenabled'] = 0
-				returnCode = 2
-			
-			# check for valid baud rate
-			try:
-				if int(dictProfiles[profilename]['tsbaud']) not in serial.Serial.BAUDRATES:
-					weblogger.warning('Config file: invalid tsbaud for serial commType: ' + str(dictProfiles[profilename]['tsbaud']))
-					dictProfiles[profilename]['tsenabled'] = 0
-					returnCode = 2
-			except Exception as e:
-				weblogger.warning('Config file: invalid tsbaud for serial commType: ' + str(dictProfiles[profilename]['tsbaud']) + '(error msg): ' + str(e))
-				dictProfiles[profilename]['tsenabled'] = 0
-				returnCode = 2
-			
-			# check for valid byte size
-			try:
-				if int(dictProfiles[profilename]['tsbytesize']) not in serial.Serial.BYTESIZES:
-					weblogger.warning('Config file: invalid tsbytesize for serial commType: ' + str(dictProfiles[profilename]['tsbytesize']))
-					dictProfiles[profilename]['tsenabled'] = 0
-					returnCode = 2
-			except Exception as e:
-				weblogger.warning('Config file: invalid tsbytesize for serial commType: ' + str(dictProfiles[profilename]['tsbytesize']) + '(error msg): ' + str(e))
-				dictProfiles[profilename]['tsenabled'] = 0
-				returnCode = 2
-			
-			# check for valid stop bit
-			try:
-				if int(dictProfiles[profilename]['tsstopbit']) not in serial.Serial.STOPBITS:
-					weblogger.warning('Config file: invalid tsstopbit for serial commType: ' + str(dictProfiles[profilename]['tsstopbit']))
-					dictProfiles[profilename]['tsenabled'] = 0
-					returnCode = 2
-			except Exception as e:
-				weblogger.warning('Config file: invalid tsstopbit for serial commType: ' + str(dictProfiles[profilename]['tsstopbit']) + '(error msg): ' + str(e))
-				dictProfiles[profilename]['tsenabled'] = 0
-				returnCode = 2
-			
-			# check for valid parity
-			try:
-				if str(dictProfiles[profilename]['tsparity']) not in serial.Serial.PARITIES:
-					weblogger.warning('Config file: invalid tsparity for serial commType: ' + str(dictProfiles[profilename]['tsparity']))
-					dictProfiles[profilename]['tsenabled'] = 0
-					returnCode = 2
-			except Exception as e:
-				weblogger.warning('Config file: invalid tsparity for serial commType: ' + str(dictProfiles[profilename]['tsparity']) + '(error msg): ' + str(e))
-				dictProfiles[profilename]['tsenabled'] = 0
-				returnCode = 2
-		# check for valid model number
-		try:
-			if str(dictProfiles[profilename]['tsmodel']).lower() not in possibleModelValues:
-				dictProfiles[profilename]['tsmodel'] = 'Other Scanner'
-		except Exception:
-			dictProfiles[profilename]['tsmodel'] = 'Other Scanner'
+		returnCode = max(returnCode, profileReturnCode)
 		# check if there is an active profile and if not, set it to first available profile that does not have errors
 		if activeProfile == '':
-			weblogger.debug('Config file: No active profile set; setting to first found valid profile: ' + str(profilename))
+			weblogger.debug('Config file: No active profile set; setting to first found valid profile: %s', profilename)
 			activeProfile = profilename
 		if profilename == activeProfile:
-			bottomEnabled = dictProfiles[profilename]['bsenabled']
-			topEnabled = dictProfiles[profilename]['tsenabled']
+			bottomEnabled = dictProfiles[profilename].get('bsenabled', 0)
+			topEnabled = dictProfiles[profilename].get('tsenabled', 0)
 	return ((returnCode, dictProfiles, activeProfile, bottomEnabled, topEnabled))
 
-def testTelnetConn(deviceIP, devicePort, testLAN, weblogger):
-	try:
-		tnclient = Telnet(str(deviceIP), int(devicePort), 5) #timeout is 5 seconds
-		tnclient.close()
-		testLAN[threading.current_thread().name] = 1
-	except socket.timeout:
-		pass
-	except Exception as e:
-		weblogger.debug('Scanner (' + str(deviceIP) + ':' + str(devicePort) + ') not connected via LAN- encountered error while connecting: ' + str(e))
-		testLAN[threading.current_thread().name] = 0
-
-def ethernetAutoDetect(side, testLAN, weblogger, socketio):
-	devicesFound = {}
-	broadcastIP = '192.168.188.255'
-	
-	def listenerHandler(listener):
-		weblogger.debug('ScannerAutoDetect- Listener started')
-		while testLAN[threading.current_thread().name] == 0:
-			if time.time() - searchTimeoutTimer > 10:
-				#app.logger.debug('ScannerAutoDetect- Timeout reached for finding new devices')
-				return
-			try:
-				data, addr = listener.recvfrom(1024)
-				deviceParameters = data.decode().split(',')
-				if deviceParameters[6] != 'espip':
-					devicesFound["deviceMac"] = deviceParameters[5]
-					#if deviceMac not in devicesFound:
-					devicesFound["deviceIP"] = deviceParameters[6]
-					devicesFound["deviceTCP1"] = deviceParameters[14]
-					devicesFound["deviceTCP2"] = deviceParameters[15]
-					devicesFound["deviceUserName"] = deviceParameters[17]
-					devicesFound["deviceModel"] = str(deviceParameters[19]).split('=')[1]
-					devicesFound["deviceSerial"] = str(deviceParameters[22]).split('=')[1]
-					devicesFound["deviceFirmware"] = str(deviceParameters[23]).split('=')[1]
-					devicesFound["deviceWeblink"] = str(deviceParameters[24]).split('=')[1]
-					weblogger.debug('ScannerAutoDetect- Found new device: deviceMac: {}, deviceIP: {}, deviceTCP1: {}, deviceTCP2: {}, deviceUserName: {}, deviceModel: {}, deviceSerial: {}, deviceFirmware: {}, deviceWeblink: {}'.format(devicesFound["deviceMac"], devicesFound["deviceIP"], devicesFound["deviceTCP1"], devicesFound["deviceTCP2"], devicesFound["deviceUserName"], devicesFound["deviceModel"], devicesFound["deviceSerial"], devicesFound["deviceFirmware"], devicesFound["deviceWeblink"]))
-					testLAN[threading.current_thread().name] = 1
-					return
-					#devicesFound.append(deviceMac) # add to devices list
-					#searchTimeoutTimer = time.time() # reset timer to continue scanning for other devices
-				time.sleep(1)
-			except Exception as e:
-				weblogger.debug('ScannerAutoDetect- Thread ' + str(threading.current_thread().name) + ' encountered error while listening for broadcast message: ' + str(e))
-				time.sleep(1)
-				pass
+# returns the barcode history depth configured in the given profile (defaults to ovtimconfig.barcodeHistoryDepth)
+def getHistoryDepth(dictProfile):
+	return int(dictProfile.get('historydepth') or ovtimconfig.barcodeHistoryDepth)
 
-	weblogger.info('ScannerAutoDetect- Trying to auto-detect compatible microhawk device connected via ethernet...')
-	weblogger.debug('ScannerAutoDetect- Creating socket connections')
-	server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-	server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-	server.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-	listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-	listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-	listener.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-	#server.settimeout(10)
-	server.settimeout(0)
-	listener.settimeout(0)
+# returns tuple: (window in seconds, key mode) of the barcode deduplication configured in the given profile
+# (defaults to ovtimconfig.dedupWindow and ovtimconfig.dedupKey)
+def getDedupSettings(dictProfile):
+	return (float(dictProfile.get('dedupwindow') or ovtimconfig.dedupWindow), dictProfile.get('dedupkey') or ovtimconfig.dedupKey)
 
-	weblogger.debug('ScannerAutoDetect- Binding sockets')
-	listener.bind(("<broadcast>", 30717))
-	server.bind(("", 30717))
-	
-	weblogger.debug('ScannerAutoDetect- Setting up listener thread')
-	searchTimeoutTimer = time.time()
-	t = threading.Thread(target=listenerHandler, args=(listener, ))
-	t.setDaemon(True)
-	testLAN[t.name] = 0
-	t.start()
+# returns dict: {(ip, port): [[profile name, position], ...]} for every enabled ethernet scanner in the given (validated) profiles
+def getEthernetScanners(dictProfiles):
+	scanners = {}
+	for profilename, dictProfile in dictProfiles.items():
+		for position in dictProfile.get('positions', ovtimconfig.scannerPositions):
+			if dictProfile.get(position + 'enabled') == 1 and dictProfile.get(position + 'commtype') == 'ethernet':
+				key = (str(dictProfile[position + 'ip']).strip(), int(dictProfile[position + 'port']))
+				scanners.setdefault(key, []).append([profilename, position])
+	return scanners
 
-	startTimer = time.time()
-	message = b"<op,019,00,FF:FF:FF:FF:FF:FF,255.255.255.255,espmac,espip,0,0>"
-	server.sendto(message, (broadcastIP, 30717))
-	weblogger.debug("ScannerAutoDetect- Broadcast message sent")
-	attempts = 1
-	while testLAN[t.name] == 0:
-		if time.time() - startTimer > 5: # timeout 5 seconds
-			if attempts > 2:
-				weblogger.info('ScannerAutoDetect- Search finished, no compatible devices found')
-				socketio.emit('Event_detectScannerInfoResult', {'result':'failure', 'side':side, 'ip':str(-1), 'tcp1':str(-1), 'name': '', 'model': '', 'mac':''})
-				testLAN[t.name] = 0
-				return
-			else:
-				attempts += 1
-				startTimer = time.time()
-				weblogger.debug('ScannerAutoDetect- No response in 5 seconds, resending broadcast (attempt ' + str(attempts) + ')')
-				server.sendto(message, (broadcastIP, 30717))
+# returns dict: {(ip, port): (framing, serial settings)} of the enabled scanners of the given (validated) profile
+# ethernet scanners are their (ip, tcp port); rs232 scanners are (serial port, 0) with the settings
+# {'baudrate', 'bytesize', 'stopbits', 'parity'} the ingest engine opens the serial port with (None for ethernet scanners)
+def getScannerEndpoints(dictProfile):
+	endpoints = {}
+	for position in dictProfile.get('positions', ovtimconfig.scannerPositions):
+		if dictProfile.get(position + 'enabled') != 1:
+			continue
+		framing = dictProfile.get(position + 'framing', '') or 'crlf'
+		if dictProfile.get(position + 'commtype') == 'rs232':
+			stopbits = float(dictProfile[position + 'stopbit'])
+			serialSettings = {'baudrate': int(dictProfile[position + 'baud']), 'bytesize': int(dictProfile[position + 'bytesize']), 'stopbits': int(stopbits) if stopbits.is_integer() else stopbits, 'parity': str(dictProfile[position + 'parity'])}
+			endpoints[(str(dictProfile[position + 'port']).strip(), 0)] = (framing, serialSettings)
+		else:
+			endpoints[(str(dictProfile[position + 'ip']).strip(), int(dictProfile[position + 'port']))] = (framing, None)
+	return endpoints
 
-	#app.logger.debug('ScannerAutoDetect- Search finished, found device')
-	#app.logger.debug(devicesFound)
-	if "deviceIP" in devicesFound.keys():
-		weblogger.info('ScannerAutoDetect- Compatible Device Found: ' + str(devicesFound["deviceIP"]))
-		socketio.emit('Event_detectScannerInfoResult', {'result':'success', 'side':side, 'ip':str(devicesFound["deviceIP"]), 'tcp1':str(devicesFound["deviceTCP1"]), 'name': str(devicesFound["deviceUserName"]), 'model': str(devicesFound["deviceModel"]), 'mac':str(devicesFound["deviceMac"])})
-		return
-	else:
-		weblogger.info('ScannerAutoDetect- No compatible devices found')
-		socketio.emit('Event_detectScannerInfoResult', {'result':'failure', 'side':side, 'ip':str(-1), 'tcp1':str(-1), 'name': '', 'model': '', 'mac':''})
-		return
\ No newline at end of file
+# returns tuple: (framing, serial settings) of the scanner at ip:port in the given profile (see getScannerEndpoints)
+# unknown scanners are ethernet scanners with crlf framing
+def getScannerSettings(dictProfile, ip, port):
+	try:
+		return getScannerEndpoints(dictProfile).get((str(ip), int(port)), ('crlf', None))
+	except ValueError:
+		return ('crlf', None)
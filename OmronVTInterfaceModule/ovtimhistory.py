@@ -0,0 +1,158 @@
+import threading
+import time
+from array import array
+from datetime import datetime
+
+MAX_PAGE_SIZE = 1000
+
+# ring buffer with the most recent barcodes read by one scanner
+# entries are stored in preallocated parallel arrays (raw timestamps, read counts, barcodes) and numbered with a sequence number
+# which keeps increasing, so a client can page through the history and backfill from the last sequence number it has seen
+# Usage:
+#	history = BarcodeHistory(1000)
+#	seq = history.append('ABC123')
+#	history.touchLast()								(the same barcode was read again)
+#	history.touch(seq)								(an older barcode was read again, see ovtimdedup)
+#	history.page(after=seq)							entries newer than seq
+#	history.page(before=seq, limit=50)					entries older than seq (newest page when before is None)
+class BarcodeHistory(object):
+	__slots__ = ('depth', 'nextSeq', 'firstSeq', 'barcodes', 'timestamps', 'counts', 'lock')
+
+	def __init__(self, depth=1000):
+		self.depth = int(depth)
+		self.nextSeq = 1 # sequence number of the next entry; entry seq is stored at index (seq - 1) % depth
+		self.firstSeq = 1 # oldest entry kept by the last resize
+		self.barcodes = [None] * self.depth
+		self.timestamps = array('d', bytes(8 * self.depth)) # time.time() of the latest read
+		self.counts = array('I', bytes(4 * self.depth)) # number of reads of the same barcode
+		self.lock = threading.Lock()
+
+	# add a barcode; returns its sequence number
+	def append(self, barcode, timestamp=None):
+		with self.lock:
+			seq = self.nextSeq
+			index = (seq - 1) % self.depth
+			self.barcodes[index] = barcode
+			self.timestamps[index] = time.time() if timestamp is None else timestamp
+			self.counts[index] = 1
+			self.nextSeq = seq + 1
+			return seq
+
+	# update the timestamp and read count of the newest entry; returns its sequence number (0 if the history is empty)
+	def touchLast(self, timestamp=None):
+		with self.lock:
+			seq = self.nextSeq - 1
+			if seq == 0:
+				return 0
+			index = (seq - 1) % self.depth
+			self.timestamps[index] = time.time() if timestamp is None else timestamp
+			self.counts[index] += 1
+			return seq
+
+	# update the timestamp and read count of an entry; returns its read count (0 if it is no longer in the history)
+	def touch(self, seq, timestamp=None):
+		with self.lock:
+			if seq < self.oldestSeq() or seq >= self.nextSeq:
+				return 0
+			index = (seq - 1) % self.depth
+			self.timestamps[index] = time.time() if timestamp is None else timestamp
+			self.counts[index] += 1
+			return self.counts[index]
+
+	# returns the newest barcode, or None if the history is empty
+	def lastBarcode(self):
+		seq = self.nextSeq - 1
+		return self.barcodes[(seq - 1) % self.depth] if seq else None
+
+	# returns the read count of an entry (0 if it is not in the history)
+	def getCount(self, seq):
+		if seq < self.oldestSeq() or seq >= self.nextSeq:
+			return 0
+		return self.counts[(seq - 1) % self.depth]
+
+	def oldestSeq(self):
+		return max(self.firstSeq, self.nextSeq - self.depth)
+
+	# returns one serialized entry, or None if it is no longer (or not yet) in the history
+	def getEntry(self, seq):
+		with self.lock:
+			if seq < self.oldestSeq() or seq >= self.nextSeq:
+				return None
+			return self._serialize(seq)
+
+	# returns dict: {'entries': [entry, ...] oldest first, 'oldest': oldest seq kept, 'newest': newest seq, 'more': bool, 'truncated': bool}
+	# after: entries newer than after (oldest first); 'more' is True if there are newer entries than the ones returned
+	#	'truncated' is True if entries after the cursor were already overwritten
+	# before: the limit entries older than before (the newest entries if both are None); 'more' is True if there are older entries
+	def page(self, after=None, before=None, limit=100):
+		limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+		with self.lock:
+			oldest = self.oldestSeq()
+			truncated = False
+			if after is not None:
+				first = int(after) + 1
+				if first < oldest:
+					truncated = oldest > 1
+					first = oldest
+				last = min(first + limit, self.nextSeq)
+				more = last < self.nextSeq
+			else:
+				last = self.nextSeq if before is None else max(oldest, min(int(before), self.nextSeq))
+				first = max(oldest, last - limit)
+				more = first > oldest
+			entries = [self._serialize(seq) for seq in range(first, last)]
+			return {'entries': entries, 'oldest': oldest, 'newest': self.nextSeq - 1, 'more': more, 'truncated': truncated}
+
+	# change the depth, keeping the newest entries
+	def resize(self, depth):
+		depth = int(depth)
+		with self.lock:
+			if depth == self.depth:
+				return
+			seqs = range(max(self.oldestSeq(), self.nextSeq - depth), self.nextSeq)
+			barcodes = [None] * depth
+			timestamps = array('d', bytes(8 * depth))
+			counts = array('I', bytes(4 * depth))
+			for seq in seqs:
+				index, newIndex = (seq - 1) % self.depth, (seq - 1) % depth
+				barcodes[newIndex] = self.barcodes[index]
+				timestamps[newIndex] = self.timestamps[index]
+				counts[newIndex] = self.counts[index]
+			self.depth, self.barcodes, self.timestamps, self.counts = depth, barcodes, timestamps, counts
+			self.firstSeq = seqs.start
+
+	# entries are only formatted here, when they are sent to a client
+	def _serialize(self, seq):
+		index = (seq - 1) % self.depth
+		timestamp = self.timestamps[index]
+		return {'seq': seq, 'barcode': self.barcodes[index], 'time': timestamp, 'timestamp': datetime.fromtimestamp(timestamp).strftime('%m/%d/%Y %H:%M:%S'), 'count': self.counts[index]}
+
+# barcode histories of every scanner, keyed by 'ip:port'
+# Usage:
+#	histories = HistoryRegistry(ovtimconfig.barcodeHistoryDepth)
+#	histories.get('192.168.188.2:2001', depth=5000)	(creates the history or changes its depth)
+class HistoryRegistry(object):
+	def __init__(self, defaultDepth=1000):
+		self.defaultDepth = defaultDepth
+		self.histories = {}
+		self.lock = threading.Lock()
+
+	# returns the history of a scanner, creating it if needed; depth defaults to defaultDepth for new histories
+	def get(self, scanner, depth=None):
+		history = self.histories.get(scanner)
+		if history is None:
+			with self.lock:
+				history = self.histories.get(scanner)
+				if history is None:
+					history = self.histories[scanner] = BarcodeHistory(depth or self.defaultDepth)
+					return history
+		if depth and depth != history.depth:
+			history.resize(depth)
+		return history
+
+	def find(self, scanner):
+		return self.histories.get(scanner)
+
+	# returns list of dicts: {'scanner', 'depth', 'oldest', 'newest'}
+	def summary(self):
+		return [{'scanner': scanner, 'depth': history.depth, 'oldest': history.oldestSeq(), 'newest': history.nextSeq - 1} for scanner, history in sorted(self.histories.items())]
@@ -0,0 +1,112 @@
+import threading
+
+# Socket.IO room which receives the notifications of one scanner
+# subscribers which asked for msgpack encoded notifications use their own room (e.g. 'scanner:192.168.188.2:2001:msgpack')
+def roomName(ip, port, encoding='json'):
+	if encoding == 'json':
+		return 'scanner:%s:%s' % (ip, port)
+	return 'scanner:%s:%s:%s' % (ip, port, encoding)
+
+# keeps exactly one ingest engine connection per scanner endpoint, shared by every browser subscribed to it
+# subscribers are Socket.IO session ids; when the last one leaves, the connection is closed after lingerTime seconds
+# (so a kiosk refresh does not reconnect to the scanner)
+# Usage:
+#	hub = ScannerHub(scannerIngest, app.logger, lingerTime=60)
+#	join_room(hub.subscribe(request.sid, ip, port, framing))			(encoding='msgpack' returns the msgpack room)
+#	join_room(hub.subscribe(request.sid, '/dev/ttyUSB0', 0, framing, serialSettings=settings))	(rs232 scanner)
+#	hub.disconnect(request.sid)								(in the Socket.IO disconnect handler)
+#	hub.pin(ip, port, framing)								(kept connected without subscribers, see ovtimstartup)
+class ScannerHub(object):
+	def __init__(self, engine, logger, lingerTime=60):
+		self.engine = engine
+		self.logger = logger
+		self.lingerTime = lingerTime
+		self.subscribers = {} # (ip, port) -> {session id: encoding}
+		self.sessions = {} # session id -> set of (ip, port)
+		self.pinned = set() # (ip, port) kept connected without subscribers
+		self.lock = threading.Lock()
+
+	# add a subscriber to a scanner endpoint and make sure the engine is connected to it
+	# (serialSettings for rs232 scanners, see IngestEngine.addScanner)
+	# returns the name of the room the subscriber should join
+	def subscribe(self, sid, ip, port, framing='crlf', encoding='json', serialSettings=None):
+		key = (str(ip), int(port))
+		with self.lock:
+			subscribers = self.subscribers.setdefault(key, {})
+			isNew = sid not in subscribers
+			subscribers[sid] = encoding
+			self.sessions.setdefault(sid, set()).add(key)
+			count = len(subscribers)
+		if isNew:
+			self.logger.debug('Scanner (%s:%s) subscribed by %s (%s subscriber(s))', key[0], key[1], sid, count)
+		# also re-adds endpoints the engine gave up on, so a page reload retries the connection
+		self.engine.addScanner(key[0], key[1], framing, serialSettings)
+		return roomName(key[0], key[1], encoding)
+
+	# remove a subscriber from a scanner endpoint; returns the name of the room it was in
+	def unsubscribe(self, sid, ip, port):
+		key = (str(ip), int(port))
+		with self.lock:
+			encoding = self._remove(sid, key) or 'json'
+			endpoints = self.sessions.get(sid)
+			if endpoints is not None:
+				endpoints.discard(key)
+				if not endpoints:
+					del self.sessions[sid]
+		return roomName(key[0], key[1], encoding)
+
+	# remove a subscriber from every scanner endpoint it subscribed to
+	def disconnect(self, sid):
+		with self.lock:
+			for key in self.sessions.pop(sid, ()):
+				self._remove(sid, key)
+
+	# keep the engine connected to a scanner endpoint whether or not it has subscribers
+	def pin(self, ip, port, framing='crlf', serialSettings=None):
+		key = (str(ip), int(port))
+		with self.lock:
+			self.pinned.add(key)
+		self.engine.addScanner(key[0], key[1], framing, serialSettings)
+
+	# the scanner endpoint's connection is closed after lingerTime seconds once it has no subscribers
+	def unpin(self, ip, port):
+		key = (str(ip), int(port))
+		with self.lock:
+			if key not in self.pinned:
+				return
+			self.pinned.discard(key)
+			if key in self.subscribers:
+				return
+		self.engine.removeScanner(key[0], key[1], self.lingerTime)
+
+	# returns number of subscribers of a scanner endpoint, only counting the given encoding if it is not None
+	def getSubscriberCount(self, ip, port, encoding=None):
+		with self.lock:
+			subscribers = self.subscribers.get((str(ip), int(port)), {})
+			if encoding is None:
+				return len(subscribers)
+			return sum(1 for x in subscribers.values() if x == encoding)
+
+	# returns list of dicts: {'ip', 'port', 'subscribers', 'pinned', 'state'} for every endpoint with subscribers or a connection
+	def summary(self):
+		states = self.engine.getStates()
+		with self.lock:
+			counts = {key: len(sids) for key, sids in self.subscribers.items()}
+			pinned = set(self.pinned)
+		return [{'ip': key[0], 'port': key[1], 'subscribers': counts.get(key, 0), 'pinned': key in pinned, 'state': states.get(key, 'closed')} for key in sorted(set(counts) | set(states) | pinned)]
+
+	# must be called with the lock held
+	# returns the encoding the subscriber used, or None if it was not subscribed
+	def _remove(self, sid, key):
+		subscribers = self.subscribers.get(key)
+		if subscribers is None or sid not in subscribers:
+			return None
+		encoding = subscribers.pop(sid)
+		if subscribers:
+			return encoding
+		del self.subscribers[key]
+		if key in self.pinned:
+			return encoding
+		self.logger.debug('Scanner (%s:%s) has no subscribers, closing its connection in %s seconds', key[0], key[1], self.lingerTime)
+		self.engine.removeScanner(key[0], key[1], self.lingerTime)
+		return encoding
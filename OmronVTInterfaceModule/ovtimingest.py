@@ -0,0 +1,352 @@
+import selectors
+import socket
+import threading
+import time
+import errno
+import random
+from collections import deque
+
+import serial
+
+from OmronVTInterfaceModule.ovtimframing import FrameReader
+from OmronVTInterfaceModule.ovtimmetrics import metrics
+
+# enable TCP keepalive so a scanner which disappeared (power loss, unplugged cable) is noticed after about idle + interval * count seconds
+# the options which are not available on this platform are skipped
+def setKeepalive(sock, idle=5, interval=2, count=3):
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+	for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+		if hasattr(socket, name):
+			sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+# one connection to a scanner endpoint held by the ingest engine: a LAN scanner (ip:port) or an rs232 scanner (serial port:0,
+# with serialSettings {'baudrate', 'bytesize', 'stopbits', 'parity'})
+# state is one of: 'connecting', 'connected', 'waiting' (for a retry), 'closed'
+class ScannerConnection(object):
+	def __init__(self, ip, port, framing='crlf', serialSettings=None):
+		self.ip = str(ip)
+		self.port = int(port)
+		self.framing = framing
+		self.serialSettings = serialSettings
+		self.kind = 'LAN' if serialSettings is None else 'serial'
+		self.key = (self.ip, self.port)
+		self.metricLabels = ('%s:%s' % self.key,)
+		self.sock = None # socket, or serial.Serial of an rs232 scanner
+		self.state = 'closed'
+		self.attemptNo = 0
+		self.deadline = 0 # connect timeout (while connecting) or retry time (while waiting)
+		self.retryDelay = 0 # delay before the pending retry, in seconds
+		self.lastRead = 0 # monotonic time data was last received (or the connection was established)
+		self.lostAt = 0 # monotonic time the connection was lost or the first attempt failed (0 while it is up)
+		self.closeAt = 0 # time a delayed removeScanner closes the connection (0 if none is pending)
+		self.reader = FrameReader(framing)
+
+# single event loop that holds every scanner socket and serial port and hands out each frame as soon as it arrives
+# serial ports are opened non-blocking with the profile's settings and read from the same selector as the sockets,
+# so any mix of LAN and rs232 scanners is serviced by one thread
+# every connection is supervised: when it is lost (reset, error, keepalive timeout, or no data for idleTimeout seconds) or a
+# connect attempt fails (for a serial port: it could not be opened, or it disappeared), the engine reconnects after a delay which doubles with every failed attempt (backoffBase up to backoffMax),
+# shortened by a random fraction up to backoffJitter; it only gives up after maxAttempts failed attempts in a row (0 never gives up)
+# callbacks are invoked from the loop thread (an exception they raise is logged and the loop keeps serving the other scanners):
+#	onFrame(conn, frame)			frame is the raw bytes of one barcode without its framing bytes
+#	onEvent(conn, event, detail)	event is one of:
+#		'connected'			first connection established
+#		'reconnected'		connection established after it was lost or attempts failed; detail is the downtime in seconds
+#		'connectretry'		connect attempt failed, retrying after conn.retryDelay seconds
+#		'connectfailed'		connect attempt failed and maxAttempts was reached
+#		'reset', 'error', 'idle'	connection lost (closed by the scanner, socket error, watchdog), reconnecting after conn.retryDelay seconds
+# Usage:
+#	engine = IngestEngine(onFrame, onEvent, app.logger)
+#	engine.start(socketio.start_background_task)
+#	engine.addScanner('192.168.188.2', 2001)
+#	engine.addScanner('/dev/ttyUSB0', 0, 'crlf', {'baudrate': 115200, 'bytesize': 8, 'stopbits': 1, 'parity': 'N'})
+class IngestEngine(object):
+	def __init__(self, onFrame, onEvent, logger, connectTimeout=5, backoffBase=0.5, backoffMax=10, backoffJitter=0.5, maxAttempts=0, keepalive=(5, 2, 3), idleTimeout=0):
+		self.onFrame = onFrame
+		self.onEvent = onEvent
+		self.logger = logger
+		self.connectTimeout = connectTimeout
+		self.backoffBase = backoffBase
+		self.backoffMax = backoffMax
+		self.backoffJitter = backoffJitter
+		self.maxAttempts = maxAttempts
+		self.keepalive = keepalive # (idle, interval, count) in seconds, None disables keepalive
+		self.idleTimeout = idleTimeout # seconds without data after which a connection is considered dead (0 disables the watchdog)
+		self.connections = {}
+		self.selector = selectors.DefaultSelector()
+		self.pending = deque() # commands queued by other threads, run inside the loop
+		self.running = False
+		self.startLock = threading.Lock()
+		self.wakeReader, self.wakeWriter = socket.socketpair()
+		self.wakeReader.setblocking(False)
+		self.wakeWriter.setblocking(False)
+		self.selector.register(self.wakeReader, selectors.EVENT_READ, None)
+
+	# start the loop once, using the given function to spawn it (e.g. socketio.start_background_task)
+	def start(self, spawn):
+		with self.startLock:
+			if self.running:
+				return
+			self.running = True
+		spawn(self.run)
+
+	def stop(self):
+		self.running = False
+		self._wake()
+
+	# thread-safe: connect to a scanner unless a connection to that endpoint already exists
+	# framing is a spec understood by ovtimframing.parseFraming ('crlf', 'stxetx', 'fixed:N')
+	# serialSettings makes it an rs232 scanner: ip is the serial port and port is 0 (see ovtimfunctions.getScannerEndpoints)
+	# a delayed removal pending for the endpoint is cancelled
+	def addScanner(self, ip, port, framing='crlf', serialSettings=None):
+		self.pending.append((self._addScanner, (str(ip), int(port), framing, serialSettings)))
+		self._wake()
+
+	# thread-safe: close and forget a scanner connection, after delay seconds unless addScanner is called again in the meantime
+	def removeScanner(self, ip, port, delay=0):
+		self.pending.append((self._removeScanner, (str(ip), int(port), delay)))
+		self._wake()
+
+	# returns dict: {(ip, port): state} of every connection held by the engine
+	def getStates(self):
+		return {key: conn.state for key, conn in list(self.connections.items())}
+
+	def _wake(self):
+		try:
+			self.wakeWriter.send(b'\0')
+		except (BlockingIOError, OSError):
+			pass # wakeup already pending
+
+	def run(self):
+		self.logger.info('Scanner ingest engine started')
+		while self.running:
+			events = self.selector.select(self._nextTimeout())
+			for key, mask in events:
+				if key.data is None:
+					self._drainWakeup()
+					continue
+				conn = key.data
+				if conn.state == 'connecting':
+					self._finishConnect(conn)
+				elif mask & selectors.EVENT_READ:
+					self._read(conn)
+			self._runPending()
+			self._runTimers()
+		for conn in list(self.connections.values()):
+			self._close(conn)
+		self.logger.info('Scanner ingest engine stopped')
+
+	def _nextTimeout(self):
+		if self.pending:
+			return 0
+		deadlines = [conn.deadline for conn in self.connections.values() if conn.state in ('connecting', 'waiting')]
+		deadlines.extend(conn.closeAt for conn in self.connections.values() if conn.closeAt)
+		if self.idleTimeout:
+			deadlines.extend(conn.lastRead + self.idleTimeout for conn in self.connections.values() if conn.state == 'connected')
+		if not deadlines:
+			return None
+		return max(0, min(deadlines) - time.monotonic())
+
+	def _drainWakeup(self):
+		try:
+			while self.wakeReader.recv(512):
+				pass
+		except (BlockingIOError, OSError):
+			pass
+
+	def _runPending(self):
+		while self.pending:
+			func, args = self.pending.popleft()
+			try:
+				func(*args)
+			except Exception:
+				self.logger.exception('Scanner ingest engine failed to run %s%s', func.__name__, args)
+
+	def _runTimers(self):
+		now = time.monotonic()
+		for conn in list(self.connections.values()):
+			if conn.closeAt and conn.closeAt <= now:
+				self.logger.info('Closing %s connection with scanner (%s:%s), it has no subscribers left', conn.kind, conn.ip, conn.port)
+				self._drop(conn)
+				continue
+			if conn.state == 'connected':
+				if self.idleTimeout and now - conn.lastRead >= self.idleTimeout:
+					self._lost(conn, 'idle', 'no data received for %s seconds' % self.idleTimeout)
+				continue
+			if conn.deadline > now:
+				continue
+			if conn.state == 'connecting':
+				self._connectFailed(conn, 'timed out')
+			elif conn.state == 'waiting':
+				self._connect(conn)
+
+	def _addScanner(self, ip, port, framing, serialSettings):
+		conn = self.connections.get((ip, port))
+		if conn is not None:
+			conn.closeAt = 0
+			return
+		try:
+			conn = ScannerConnection(ip, port, framing, serialSettings)
+		except ValueError as e:
+			self.logger.warning('Invalid framing for scanner (%s:%s): %s. Falling back to crlf', ip, port, e)
+			conn = ScannerConnection(ip, port, serialSettings=serialSettings)
+		self.connections[conn.key] = conn
+		self._connect(conn)
+
+	def _removeScanner(self, ip, port, delay):
+		if delay:
+			conn = self.connections.get((ip, port))
+			if conn is not None:
+				conn.closeAt = time.monotonic() + delay
+			return
+		conn = self.connections.pop((ip, port), None)
+		if conn is not None:
+			self._close(conn)
+
+	# returns the delay before the next connect attempt, after attemptNo attempts failed in a row
+	def _backoff(self, attemptNo):
+		delay = min(self.backoffMax, self.backoffBase * 2 ** max(0, attemptNo - 1))
+		return delay * (1 - random.uniform(0, self.backoffJitter))
+
+	# start a non-blocking connect; completion is picked up by the selector
+	def _connect(self, conn):
+		conn.attemptNo += 1
+		if conn.serialSettings is not None:
+			self._openSerial(conn)
+			return
+		self.logger.info('Establishing LAN connection with scanner to receive data: %s:%s (this is attempt #%s%s)', conn.ip, conn.port, conn.attemptNo, ' of %s' % self.maxAttempts if self.maxAttempts else '')
+		try:
+			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			sock.setblocking(False)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			if self.keepalive:
+				setKeepalive(sock, *self.keepalive)
+			result = sock.connect_ex((conn.ip, conn.port))
+		except OSError as e:
+			self._connectFailed(conn, str(e))
+			return
+		if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+			sock.close()
+			self._connectFailed(conn, errno.errorcode.get(result, str(result)))
+			return
+		conn.sock = sock
+		conn.state = 'connecting'
+		conn.deadline = time.monotonic() + self.connectTimeout
+		self.selector.register(sock, selectors.EVENT_WRITE, conn)
+
+	# open an rs232 scanner's serial port (pyserial opens it non-blocking); it is read from the selector like a socket
+	def _openSerial(self, conn):
+		self.logger.info('Opening serial port %s to receive data from scanner (this is attempt #%s%s)', conn.ip, conn.attemptNo, ' of %s' % self.maxAttempts if self.maxAttempts else '')
+		try:
+			port = serial.Serial(conn.ip, timeout=0, **conn.serialSettings)
+		except (serial.SerialException, OSError, ValueError) as e:
+			self._connectFailed(conn, str(e))
+			return
+		port.reset_input_buffer() # drop a partial frame sent before the port was opened
+		conn.sock = port
+		self.selector.register(port, selectors.EVENT_READ, conn)
+		self._connected(conn)
+
+	def _finishConnect(self, conn):
+		error = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+		if error != 0:
+			self._connectFailed(conn, errno.errorcode.get(error, str(error)))
+			return
+		self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+		self._connected(conn)
+
+	def _connected(self, conn):
+		conn.state = 'connected'
+		conn.attemptNo = 0
+		conn.deadline = 0
+		conn.lastRead = time.monotonic()
+		if conn.lostAt:
+			downtime = conn.lastRead - conn.lostAt
+			conn.lostAt = 0
+			self.logger.info('%s connection re-established with scanner: %s:%s (down for %.1f seconds)', conn.kind, conn.ip, conn.port, downtime)
+			self._event(conn, 'reconnected', round(downtime, 1))
+		else:
+			self.logger.info('%s connection established with scanner: %s:%s', conn.kind, conn.ip, conn.port)
+			self._event(conn, 'connected', '')
+
+	def _connectFailed(self, conn, reason):
+		self._closeSocket(conn)
+		if not conn.lostAt:
+			conn.lostAt = time.monotonic()
+		if self.maxAttempts and conn.attemptNo >= self.maxAttempts:
+			self.logger.error('Failed to establish %s connection with scanner (%s:%s) because of error: %s. Giving up (this was attempt #%s of %s)', conn.kind, conn.ip, conn.port, reason, conn.attemptNo, self.maxAttempts)
+			self.connections.pop(conn.key, None)
+			conn.state = 'closed'
+			self._event(conn, 'connectfailed', reason)
+			return
+		self._retry(conn, self._backoff(conn.attemptNo))
+		self.logger.error('Failed to establish %s connection with scanner (%s:%s) because of error: %s. Retrying in %.1f seconds (this was attempt #%s%s)', conn.kind, conn.ip, conn.port, reason, conn.retryDelay, conn.attemptNo, ' of %s' % self.maxAttempts if self.maxAttempts else '')
+		self._event(conn, 'connectretry', reason)
+
+	# the connection was lost: close the socket and reconnect after a short delay
+	def _lost(self, conn, event, reason):
+		self._closeSocket(conn)
+		conn.reader.reset()
+		conn.lostAt = time.monotonic()
+		conn.attemptNo = 0
+		self._retry(conn, self._backoff(1))
+		self.logger.warning('%s connection lost with scanner (%s:%s): %s. Reconnecting in %.1f seconds', conn.kind, conn.ip, conn.port, reason, conn.retryDelay)
+		self._event(conn, event, reason)
+
+	def _retry(self, conn, delay):
+		conn.state = 'waiting'
+		conn.retryDelay = delay
+		conn.deadline = time.monotonic() + delay
+
+	# read whatever is available and pass along every complete frame in the buffer
+	# (a serial port is read straight from its file descriptor; reading nothing although it was readable means it disappeared)
+	def _read(self, conn):
+		try:
+			if conn.serialSettings is None:
+				count = conn.reader.recvFrom(conn.sock)
+			else:
+				count = conn.reader.readFrom(conn.sock.fileno())
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError as e:
+			self._lost(conn, 'error', str(e))
+			return
+		if count == 0:
+			self._lost(conn, 'reset', 'connection closed by the scanner' if conn.serialSettings is None else 'serial port disconnected')
+			return
+		conn.lastRead = time.monotonic()
+		metrics.inc('karlbox_scanner_received_bytes_total', conn.metricLabels, count)
+		for frame in conn.reader.frames():
+			self._frame(conn, frame)
+
+	# the callbacks run in the loop serving every scanner: an exception is logged and the loop keeps going
+	def _frame(self, conn, frame):
+		try:
+			self.onFrame(conn, frame)
+		except Exception:
+			self.logger.exception('Failed to process a barcode from scanner (%s:%s)', conn.ip, conn.port)
+
+	def _event(self, conn, event, detail):
+		try:
+			self.onEvent(conn, event, detail)
+		except Exception:
+			self.logger.exception('Failed to process the %s event of scanner (%s:%s)', event, conn.ip, conn.port)
+
+	def _drop(self, conn):
+		self.connections.pop(conn.key, None)
+		self._close(conn)
+
+	def _close(self, conn):
+		self._closeSocket(conn)
+		conn.state = 'closed'
+		conn.reader.reset()
+
+	def _closeSocket(self, conn):
+		if conn.sock is None:
+			return
+		try:
+			self.selector.unregister(conn.sock)
+		except (KeyError, ValueError):
+			pass
+		conn.sock.close()
+		conn.sock = None
@@ -0,0 +1,227 @@
+import itertools
+import json
+import socket
+import threading
+import time
+
+# one message of the ingest daemon protocol (see ovtimdaemon): a json object on one line
+def encodeMessage(message):
+	return (json.dumps(message, separators=(',', ':')) + '\n').encode('utf-8')
+
+# connection of a web worker to the ingest daemon
+# has the interface of ScannerPipeline (and of the IngestEngine, as .ingest) so the webapp uses it the same way in both ingest modes;
+# notifications from the daemon are handed to publish (NotificationFanout.publish)
+# the connection is re-established when the daemon restarts, and the worker's scanners are added again
+# calls raise ConnectionError when the daemon cannot be reached, TimeoutError when it does not answer,
+# and ValueError when the daemon rejected the arguments
+# Usage:
+#	client = DaemonClient('/tmp/karlbox-ingest.sock', scannerNotifier.publish, app.logger)
+#	client.start(socketio.start_background_task)
+#	client.ingest.addScanner('192.168.188.2', 2001)
+#	client.historyPage('192.168.188.2:2001', after=5)
+class DaemonClient(object):
+	def __init__(self, path, publish, logger, timeout=5, retryDelay=1):
+		self.path = path
+		self.publish = publish
+		self.logger = logger
+		self.timeout = timeout
+		self.retryDelay = retryDelay
+		self.ingest = self
+		self.discovery = DaemonDiscovery(self)
+		self.sock = None
+		self.sendLock = threading.Lock()
+		self.connected = threading.Event()
+		self.running = False
+		self.scanners = {} # (ip, port) -> (framing, serial settings), added again after a reconnect
+		self.depths = {} # scanner -> history depth
+		self.profile = None # active profile sent last
+		self.outputRequested = False
+		self.pending = {} # call id -> [threading.Event, reply]
+		self.ids = itertools.count(1)
+
+	# start the connection once, using the given function to spawn its reader (e.g. socketio.start_background_task)
+	def start(self, spawn):
+		with self.sendLock:
+			if self.running:
+				return False
+			self.running = True
+		spawn(self.run)
+		return True
+
+	def stop(self):
+		self.running = False
+		sock = self.sock
+		if sock is not None:
+			try:
+				sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+
+	def run(self):
+		isFirst = True
+		while self.running:
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				sock.connect(self.path)
+			except OSError as e:
+				sock.close()
+				if isFirst:
+					self.logger.warning('Ingest daemon not reachable on %s (%s), retrying every %s second(s)', self.path, e, self.retryDelay)
+					isFirst = False
+				time.sleep(self.retryDelay)
+				continue
+			isFirst = True
+			with self.sendLock:
+				self.sock = sock
+				messages = [{'op': 'addScanner', 'ip': key[0], 'port': key[1], 'framing': framing, 'serial': serialSettings} for key, (framing, serialSettings) in self.scanners.items()]
+				messages += [{'op': 'setHistoryDepth', 'scanner': scanner, 'depth': depth} for scanner, depth in self.depths.items()]
+				if self.profile is not None:
+					messages.append({'op': 'setProfile', 'profile': self.profile})
+				if self.outputRequested:
+					messages.append({'op': 'startOutput'})
+				try:
+					sock.sendall(b''.join(encodeMessage(x) for x in messages))
+				except OSError:
+					pass
+			self.connected.set()
+			self.logger.info('Connected to the ingest daemon on %s', self.path)
+			try:
+				with sock.makefile('rb') as rfile:
+					for line in rfile:
+						self._dispatch(json.loads(line.decode('utf-8')))
+			except (OSError, ValueError) as e:
+				self.logger.error('Connection to the ingest daemon failed: %s', e)
+			self.connected.clear()
+			with self.sendLock:
+				self.sock = None
+			sock.close()
+			for waiter in list(self.pending.values()):
+				waiter[0].set() # no reply, the caller raises ConnectionError
+			if self.running:
+				self.logger.error('Lost the connection to the ingest daemon, reconnecting')
+				time.sleep(self.retryDelay)
+
+	def _dispatch(self, message):
+		op = message.get('op')
+		if op == 'notify':
+			self.publish(message['ip'], message['port'], message['event'], readTime=message.get('readTime'), **message['fields'])
+		elif op == 'reply':
+			waiter = self.pending.get(message.get('id'))
+			if waiter is not None:
+				waiter[1] = message
+				waiter[0].set()
+
+	# returns False if the daemon is not connected (the message is not sent)
+	def _send(self, message):
+		with self.sendLock:
+			if self.sock is None:
+				return False
+			try:
+				self.sock.sendall(encodeMessage(message))
+				return True
+			except OSError:
+				return False
+
+	# returns the result of a call answered by the daemon (within timeout seconds, self.timeout unless given)
+	def call(self, name, timeout=None, **args):
+		timeout = self.timeout if timeout is None else timeout
+		if not self.connected.wait(self.timeout):
+			raise ConnectionError('ingest daemon not reachable on ' + self.path)
+		callId = next(self.ids)
+		waiter = self.pending[callId] = [threading.Event(), None]
+		try:
+			if not self._send({'op': 'call', 'id': callId, 'name': name, 'args': args}):
+				raise ConnectionError('ingest daemon not reachable on ' + self.path)
+			if not waiter[0].wait(timeout):
+				raise TimeoutError('ingest daemon did not answer ' + name)
+		finally:
+			del self.pending[callId]
+		reply = waiter[1]
+		if reply is None:
+			raise ConnectionError('lost the connection to the ingest daemon')
+		if 'error' in reply:
+			if reply.get('errorType') == 'ValueError':
+				raise ValueError(reply['error'])
+			raise RuntimeError('ingest daemon call %s failed: %s' % (name, reply['error']))
+		return reply['result']
+
+	# IngestEngine interface (used by ScannerHub)
+	def addScanner(self, ip, port, framing='crlf', serialSettings=None):
+		key = (str(ip), int(port))
+		self.scanners[key] = (framing, serialSettings)
+		self._send({'op': 'addScanner', 'ip': key[0], 'port': key[1], 'framing': framing, 'serial': serialSettings})
+
+	def removeScanner(self, ip, port, delay=0):
+		key = (str(ip), int(port))
+		self.scanners.pop(key, None)
+		self._send({'op': 'removeScanner', 'ip': key[0], 'port': key[1], 'delay': delay})
+
+	# returns dict: {(ip, port): state}
+	def getStates(self):
+		return {(ip, port): state for ip, port, state in self.call('states')}
+
+	# ScannerPipeline interface
+	def setHistoryDepth(self, scanner, depth):
+		self.depths[scanner] = depth
+		self._send({'op': 'setHistoryDepth', 'scanner': scanner, 'depth': depth})
+
+	# the profile is only sent when it changed
+	def setProfile(self, dictProfile):
+		if dictProfile == self.profile:
+			return
+		self.profile = dictProfile
+		self._send({'op': 'setProfile', 'profile': dictProfile})
+
+	def historyPage(self, scanner, after=None, before=None, limit=100):
+		return self.call('history', scanner=scanner, after=after, before=before, limit=limit)
+
+	def historySummary(self):
+		return self.call('histories')
+
+	def getOutputStats(self):
+		return self.call('output')
+
+	# returns dict: {(name, label values): value} of the metrics counted by the daemon
+	def collectMetrics(self):
+		return {(name, tuple(labels)): value for name, labels, value in self.call('metrics')}
+
+	# returns the daemon's startup phases (see ovtimstartup.StartupTimer.getStats)
+	def getStartupStats(self):
+		return self.call('startup')
+
+	# returns the statistics of the daemon's logging pipeline (see ovtimlogging.LogPipeline.getStats)
+	def getLoggingStats(self):
+		return self.call('logging')
+
+	# send records of the worker's webapp or barcode log to the daemon, which writes them (see ovtimlogging.ForwardingHandler)
+	# returns False if the daemon is not connected
+	def sendLog(self, logname, records):
+		return self._send({'op': 'log', 'log': logname, 'records': records})
+
+	# the daemon connects to the serial port in the background; the request is repeated after a reconnect
+	def startOutput(self, spawn):
+		self.outputRequested = True
+		if not self._send({'op': 'startOutput'}):
+			self.logger.error('Ingest daemon not reachable, barcode output starts once it is connected')
+
+# scanner discovery of the ingest daemon, with the interface of ovtimdiscovery.DiscoveryService
+# the daemon is the only process listening for discovery replies: with several workers bound to the discovery port the replies
+# would be spread over the workers, each seeing part of the inventory
+# getDevices and waitForDevices raise ConnectionError or TimeoutError like the calls of DaemonClient
+# Usage:
+#	scannerDiscovery = client.discovery
+#	scannerDiscovery.start(socketio.start_background_task)
+#	scannerDiscovery.waitForDevices(3)
+class DaemonDiscovery(object):
+	def __init__(self, client):
+		self.client = client
+
+	# starts the daemon's discovery service (a no-op once it runs); spawn is not used, the service runs in the daemon
+	def start(self, spawn):
+		return self.client._send({'op': 'startDiscovery'})
+
+	def getDevices(self):
+		return self.client.call('discovered')
+
+	def waitForDevices(self, timeout):
+		return self.client.call('discoverwait', timeout=self.client.timeout + timeout, wait=timeout)
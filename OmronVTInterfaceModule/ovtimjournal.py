@@ -0,0 +1,303 @@
+import bisect
+import datetime
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+# record flags
+FLAG_DUPLICATE = 0x01 # same barcode as the previous read of this scanner
+FLAG_TOOSOON = 0x02 # read before the scanner time limit elapsed (not passed on)
+FLAG_REJECTED = 0x04 # rejected by the profile's rules
+FLAG_NAMES = ((FLAG_DUPLICATE, 'duplicate'), (FLAG_TOOSOON, 'toosoon'), (FLAG_REJECTED, 'rejected'))
+
+# segment file layout:
+#	header (64 bytes):	magic, version, record size, capacity, record count, sorted flag, first wall time, last wall time
+#	records:			capacity * RECORD.size bytes, preallocated and memory-mapped
+# each segment has a heap file with the barcode strings and a sparse index file with the wall time of every INDEX_STRIDE-th record
+HEADER = struct.Struct('<4sHHIIIqq32x')
+RECORD = struct.Struct('<qqIHHQI4x') # wall ns, monotonic ns, scanner id, (reserved), flags, heap offset, barcode length
+INDEX = struct.Struct('<qI') # wall ns, record number
+MAGIC = b'KBJ1'
+VERSION = 1
+INDEX_STRIDE = 256
+SEGMENT_NAME = re.compile(r'^segment-(\d{8})\.rec$')
+
+# one journal segment (records + heap + sparse index)
+class JournalSegment(object):
+	# mode: 'r' read only, 'a' append to an existing segment, 'x' create a new segment
+	def __init__(self, directory, number, mode='r', capacity=65536):
+		self.number = number
+		self.basePath = os.path.join(directory, 'segment-%08d' % number)
+		self.recordPath = self.basePath + '.rec'
+		self.writable = mode != 'r'
+		if mode == 'x':
+			with open(self.recordPath, 'xb') as rfile:
+				rfile.truncate(HEADER.size + capacity * RECORD.size)
+				rfile.write(HEADER.pack(MAGIC, VERSION, RECORD.size, capacity, 0, 1, 0, 0))
+		self.recordFile = None
+		self.map = None
+		self.heapFile = None
+		self.indexFile = None
+		# whatever was opened is closed again if a file is missing or not a segment (e.g. removed by retention meanwhile)
+		try:
+			self.recordFile = open(self.recordPath, 'r+b' if self.writable else 'rb')
+			self.map = mmap.mmap(self.recordFile.fileno(), 0, access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ)
+			if len(self.map) < HEADER.size:
+				raise ValueError('not a barcode journal segment: ' + self.recordPath)
+			magic, version, recordSize, self.capacity, count, isSorted, firstWall, lastWall = HEADER.unpack_from(self.map, 0)
+			if magic != MAGIC or version != VERSION or recordSize != RECORD.size:
+				raise ValueError('not a barcode journal segment: ' + self.recordPath)
+			self.heapFile = open(self.basePath + '.heap', 'a+b' if self.writable else 'rb')
+			if self.writable:
+				self.indexFile = open(self.basePath + '.idx', 'ab')
+			self.heapSize = os.path.getsize(self.basePath + '.heap')
+		except BaseException:
+			self.close()
+			raise
+
+	# header values are read from the map every time, so readers see records appended by the writer
+	def header(self):
+		return HEADER.unpack_from(self.map, 0)
+
+	def count(self):
+		return self.header()[4]
+
+	def isFull(self):
+		return self.count() >= self.capacity
+
+	# append one record; must only be called on the writable (newest) segment
+	def append(self, wallNs, monoNs, scannerId, flags, barcode):
+		magic, version, recordSize, capacity, count, isSorted, firstWall, lastWall = self.header()
+		data = barcode.encode('utf-8')
+		self.heapFile.write(data)
+		self.heapFile.flush()
+		RECORD.pack_into(self.map, HEADER.size + count * RECORD.size, wallNs, monoNs, scannerId, 0, flags, self.heapSize, len(data))
+		self.heapSize += len(data)
+		if count % INDEX_STRIDE == 0:
+			self.indexFile.write(INDEX.pack(wallNs, count))
+			self.indexFile.flush()
+		if count and wallNs < lastWall:
+			isSorted = 0 # wall clock stepped backwards; queries fall back to a scan of this segment
+		# the count is written last, so a record is only visible once it is complete
+		HEADER.pack_into(self.map, 0, magic, version, recordSize, capacity, count + 1, isSorted, firstWall if count else wallNs, max(wallNs, lastWall))
+
+	def readRecord(self, recordNo):
+		return RECORD.unpack_from(self.map, HEADER.size + recordNo * RECORD.size)
+
+	def readBarcode(self, offset, length):
+		return os.pread(self.heapFile.fileno(), length, offset).decode('utf-8', errors='replace')
+
+	# returns number of the first record with wall time >= wallNs (records must be sorted)
+	def findFirst(self, wallNs, count):
+		low, high = 0, count
+		# narrow the search to one index stride using the sparse index
+		index = self.readIndex()
+		if index:
+			position = bisect.bisect_left([entry[0] for entry in index], wallNs)
+			if position > 0:
+				low = index[position - 1][1]
+			if position < len(index):
+				high = min(high, index[position][1] + 1)
+		while low < high:
+			middle = (low + high) // 2
+			if RECORD.unpack_from(self.map, HEADER.size + middle * RECORD.size)[0] < wallNs:
+				low = middle + 1
+			else:
+				high = middle
+		return low
+
+	def readIndex(self):
+		with open(self.basePath + '.idx', 'rb') as ifile:
+			data = ifile.read()
+		return [INDEX.unpack_from(data, i) for i in range(0, len(data) - len(data) % INDEX.size, INDEX.size)]
+
+	def flush(self):
+		if self.writable:
+			self.map.flush()
+
+	def close(self):
+		if self.map is not None:
+			self.map.close()
+		if self.recordFile is not None:
+			self.recordFile.close()
+		if self.heapFile is not None:
+			self.heapFile.close()
+		if self.indexFile is not None:
+			self.indexFile.close()
+
+# append-only barcode journal made of memory-mapped segments of fixed-layout records
+# Usage:
+#	journal = BarcodeJournal('/path/to/log/journal')
+#	journal.append('ABC123', '192.168.188.2:2001', FLAG_DUPLICATE)
+#	for entry in journal.query(startNs, endNs, scanner='192.168.188.2'): ...
+# readOnly opens a journal written by another process (the ingest daemon) for queries only; its segments are mapped read only
+# and the scanner names are reloaded when the writer added one
+class BarcodeJournal(object):
+	def __init__(self, directory, segmentCapacity=65536, retentionDays=90, readOnly=False):
+		self.directory = directory
+		self.segmentCapacity = segmentCapacity
+		self.retentionDays = retentionDays
+		self.readOnly = readOnly
+		self.lock = threading.Lock()
+		os.makedirs(directory, exist_ok=True)
+		self.scannerPath = os.path.join(directory, 'scanners.txt')
+		self.scannerIds = {} # scanner name (ip:port) -> id
+		self.scannerNames = [] # id -> scanner name
+		self.scannerFileSize = 0
+		self._loadScanners()
+		numbers = self._segmentNumbers()
+		if readOnly:
+			self.active = None
+		elif numbers:
+			self.active = JournalSegment(directory, numbers[-1], 'a')
+		else:
+			self.active = JournalSegment(directory, 1, 'x', segmentCapacity)
+
+	# append one barcode read; scanner is a name such as '192.168.188.2:2001'
+	def append(self, barcode, scanner, flags=0, wallNs=None, monoNs=None):
+		if wallNs is None:
+			wallNs = time.time_ns()
+		if monoNs is None:
+			monoNs = time.monotonic_ns()
+		if self.readOnly:
+			raise ValueError('barcode journal is read only: ' + self.directory)
+		with self.lock:
+			if self.active.isFull():
+				self._roll()
+			self.active.append(wallNs, monoNs, self._scannerId(scanner), flags, barcode)
+
+	# yields dicts: {'wall': wall time ns, 'mono': monotonic ns, 'scanner': name, 'flags': int, 'barcode': str} in journal order
+	# scanner matches an exact name ('192.168.188.2:2001') or every port of an ip ('192.168.188.2')
+	def query(self, startNs, endNs, scanner=None, limit=None):
+		scannerIds = None
+		if scanner is not None:
+			scannerIds = frozenset(sid for sid, name in enumerate(self._scannerNamesSnapshot()) if name == scanner or name.rsplit(':', 1)[0] == scanner)
+			if not scannerIds:
+				return
+		found = 0
+		for number in self._segmentNumbers():
+			segment = self._openForRead(number)
+			if segment is None:
+				continue
+			try:
+				magic, version, recordSize, capacity, count, isSorted, firstWall, lastWall = segment.header()
+				if count == 0 or lastWall < startNs or (isSorted and firstWall >= endNs):
+					continue
+				recordNo = segment.findFirst(startNs, count) if isSorted else 0
+				names = self._scannerNamesSnapshot()
+				while recordNo < count:
+					wallNs, monoNs, scannerId, reserved, flags, offset, length = segment.readRecord(recordNo)
+					recordNo += 1
+					if wallNs >= endNs:
+						if isSorted:
+							break
+						continue
+					if wallNs < startNs or (scannerIds is not None and scannerId not in scannerIds):
+						continue
+					yield {'wall': wallNs, 'mono': monoNs, 'scanner': names[scannerId] if scannerId < len(names) else str(scannerId), 'flags': flags, 'barcode': segment.readBarcode(offset, length)}
+					found += 1
+					if limit is not None and found >= limit:
+						return
+			finally:
+				if segment is not self.active:
+					segment.close()
+
+	def flush(self):
+		with self.lock:
+			if self.active is not None:
+				self.active.flush()
+
+	def close(self):
+		with self.lock:
+			if self.active is not None:
+				self.active.flush()
+				self.active.close()
+
+	def _openForRead(self, number):
+		if self.active is not None and number == self.active.number:
+			return self.active
+		try:
+			return JournalSegment(self.directory, number)
+		except (OSError, ValueError):
+			return None # removed by retention or not a valid segment
+
+	# close the full segment, start a new one and remove segments older than the retention period
+	def _roll(self):
+		self.active.flush()
+		self.active.close()
+		self.active = JournalSegment(self.directory, self.active.number + 1, 'x', self.segmentCapacity)
+		if not self.retentionDays:
+			return
+		cutoff = time.time_ns() - int(self.retentionDays * 86400e9)
+		for number in self._segmentNumbers()[:-1]:
+			segment = self._openForRead(number)
+			if segment is None:
+				continue
+			lastWall = segment.header()[7]
+			segment.close()
+			if lastWall >= cutoff:
+				break
+			for extension in ('.rec', '.heap', '.idx'):
+				try:
+					os.remove(os.path.join(self.directory, 'segment-%08d%s' % (number, extension)))
+				except OSError:
+					pass
+
+	def _segmentNumbers(self):
+		return sorted(int(match.group(1)) for match in (SEGMENT_NAME.match(name) for name in os.listdir(self.directory)) if match)
+
+	def _loadScanners(self):
+		if not os.path.exists(self.scannerPath):
+			return
+		scannerIds = {}
+		scannerNames = []
+		with open(self.scannerPath, 'r') as sfile:
+			data = sfile.read()
+		data = data[:data.rfind('\n') + 1] # a name without its newline is still being written
+		for name in data.splitlines():
+			scannerIds[name] = len(scannerNames)
+			scannerNames.append(name)
+		self.scannerFileSize = len(data.encode('utf-8'))
+		self.scannerIds = scannerIds
+		self.scannerNames = scannerNames
+
+	def _scannerId(self, scanner):
+		scannerId = self.scannerIds.get(scanner)
+		if scannerId is None:
+			with open(self.scannerPath, 'a') as sfile:
+				sfile.write(scanner + '\n')
+			scannerId = self.scannerIds[scanner] = len(self.scannerNames)
+			self.scannerNames.append(scanner)
+		return scannerId
+
+	def _scannerNamesSnapshot(self):
+		if self.readOnly:
+			with self.lock:
+				try:
+					if os.path.getsize(self.scannerPath) != self.scannerFileSize:
+						self._loadScanners()
+				except OSError:
+					pass
+		return list(self.scannerNames)
+
+# returns list of flag names, e.g. ['duplicate']
+def flagNames(flags):
+	return [name for flag, name in FLAG_NAMES if flags & flag]
+
+# converts a query time to wall clock ns: seconds since the epoch ('1760364000.5') or local ISO 8601 time ('2026-10-13T14:00:00')
+# raises ValueError for anything else, including times which are not finite or out of range ('inf', '1e300')
+def parseTime(value):
+	try:
+		seconds = float(value)
+	except ValueError:
+		try:
+			seconds = datetime.datetime.fromisoformat(value).timestamp()
+		except (OverflowError, OSError) as e:
+			raise ValueError('time out of range: %s (%s)' % (value, e))
+	if not math.isfinite(seconds * 1e9):
+		raise ValueError('time out of range: ' + str(value))
+	return int(seconds * 1e9)
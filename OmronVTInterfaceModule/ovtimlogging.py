@@ -0,0 +1,439 @@
+import atexit
+import collections
+import datetime
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+
+import OmronVTInterfaceModule.ovtimconfig as ovtimconfig
+from OmronVTInterfaceModule.ovtimmetrics import metrics
+
+# runs function(*args) and returns its result; when gevent patched threading (gunicorn's gevent workers) the logging threads are
+# greenlets, so the function runs on a native thread of gevent's threadpool instead: gzip and fsync would otherwise stall every
+# request and Socket.IO client of the worker while they run
+def runBlocking(function, *args):
+	monkey = sys.modules.get('gevent.monkey')
+	if monkey is not None and monkey.is_module_patched('threading'):
+		return sys.modules['gevent'].get_hub().threadpool.apply(function, args)
+	return function(*args)
+
+# queue handler which never blocks the caller
+# records are queued unformatted (formatting happens in the listener) and dropped (and counted) when the queue is full
+class PipelineQueueHandler(logging.handlers.QueueHandler):
+	def __init__(self, pipeline, target):
+		logging.handlers.QueueHandler.__init__(self, pipeline.queue)
+		self.pipeline = pipeline
+		self.target = target
+
+	def prepare(self, record):
+		return (self.target, record)
+
+	def enqueue(self, item):
+		try:
+			self.queue.put_nowait(item)
+		except queue.Full:
+			self.pipeline.dropped += 1
+
+# returns the seconds since the epoch of the midnight following t (local time)
+def nextMidnight(t):
+	day = datetime.date.fromtimestamp(t) + datetime.timedelta(days=1)
+	return time.mktime(day.timetuple())
+
+# log file which starts a new segment at midnight and whenever it grows past maxBytes (0 only rotates at midnight)
+# finished segments are named <file>.<YYYY-MM-DD>[.<n>] and handed to compressor (a LogCompressor), which gzips them
+# and keeps at most backupCount of them, taking up at most maxTotalBytes together (0 disables the limit)
+# the file is written in binary through a large buffer; the logging pipeline calls writeRecord for every record and
+# flush and sync once per batch, so the flash sees a few large writes instead of one per record
+# only one process may write a log file (in daemon mode the web workers forward their records, see ForwardingHandler);
+# should the file still be moved by someone else, the handler reopens it (checked once per batch) instead of writing to the moved file
+# Usage:
+#	handler = CompressingRotatingFileHandler('log/webapp/webapp.log', maxBytes=8388608, backupCount=30, maxTotalBytes=67108864, compressor=logCompressor)
+#	logger.addHandler(logPipeline.queueHandler(handler))
+class CompressingRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+	def __init__(self, filename, maxBytes=0, backupCount=30, maxTotalBytes=0, compressor=None, encoding='utf-8', bufferSize=65536):
+		self.bufferSize = bufferSize
+		logging.handlers.BaseRotatingHandler.__init__(self, filename, 'ab', encoding=encoding)
+		self.maxBytes = maxBytes
+		self.backupCount = backupCount
+		self.maxTotalBytes = maxTotalBytes
+		self.compressor = compressor
+		self.checkFile = False # set by flush: the next write checks that the file was not moved
+		self.segmentPattern = re.compile(re.escape(os.path.basename(self.baseFilename)) + r'\.(\d{4}-\d{2}-\d{2})(?:\.(\d+))?(\.gz)?$')
+		# a file left from an earlier day is rotated with the date it was last written on
+		started = os.stat(self.baseFilename).st_mtime if self.size else time.time()
+		self.day = time.strftime('%Y-%m-%d', time.localtime(started))
+		self.rolloverAt = nextMidnight(started)
+		if self.compressor is not None:
+			self.compressor.submit(self) # segments left uncompressed (or over the limits) by an earlier run
+
+	def _open(self):
+		stream = open(self.baseFilename, 'ab', buffering=self.bufferSize)
+		self.size = os.fstat(stream.fileno()).st_size
+		return stream
+
+	# returns True if the open file is no longer the one at baseFilename
+	def _fileMoved(self):
+		try:
+			current = os.stat(self.baseFilename)
+		except FileNotFoundError:
+			return True
+		opened = os.fstat(self.stream.fileno())
+		return (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino)
+
+	def shouldRollover(self, record):
+		return record.created >= self.rolloverAt or (self.maxBytes > 0 and self.size >= self.maxBytes)
+
+	# move the current file aside as a finished segment and start a new one
+	# (a file which was moved already is only reopened)
+	def doRollover(self):
+		moved = False
+		if self.stream is not None:
+			moved = self._fileMoved()
+			self.stream.close()
+			self.stream = None
+		if self.size and not moved and os.path.exists(self.baseFilename):
+			segment = '%s.%s' % (self.baseFilename, self.day)
+			number = 0
+			while os.path.exists(segment) or os.path.exists(segment + '.gz'):
+				number += 1
+				segment = '%s.%s.%d' % (self.baseFilename, self.day, number)
+			os.rename(self.baseFilename, segment)
+		now = time.time()
+		if now >= self.rolloverAt:
+			self.day = time.strftime('%Y-%m-%d', time.localtime(now))
+			self.rolloverAt = nextMidnight(now)
+		self.stream = self._open()
+		if self.compressor is not None:
+			self.compressor.submit(self)
+
+	# write a record without flushing it; returns the number of bytes written
+	def writeRecord(self, record):
+		if self.shouldRollover(record):
+			self.doRollover()
+		if self.stream is None:
+			self.stream = self._open()
+		elif self.checkFile:
+			self.checkFile = False
+			if self._fileMoved():
+				self.stream.close()
+				self.stream = self._open()
+		data = (self.format(record) + self.terminator).encode(self.encoding or 'utf-8', 'replace')
+		self.stream.write(data)
+		self.size += len(data)
+		return len(data)
+
+	def flush(self):
+		logging.handlers.BaseRotatingHandler.flush(self)
+		self.checkFile = True
+
+	# force what was flushed to the file onto the storage
+	def sync(self):
+		if self.stream is not None:
+			os.fsync(self.stream.fileno())
+
+	# flush and sync the batch written since the last commit (run through runBlocking by the logging pipeline)
+	def commit(self):
+		self.flush()
+		self.sync()
+
+	# used when a record reaches the handler without the logging pipeline
+	def emit(self, record):
+		try:
+			self.writeRecord(record)
+			self.flush()
+		except Exception:
+			self.handleError(record)
+
+	# returns list: paths of the finished segments (compressed or not), oldest first
+	def getSegments(self):
+		directory = os.path.dirname(self.baseFilename)
+		segments = []
+		for name in os.listdir(directory):
+			match = self.segmentPattern.match(name)
+			if match:
+				segments.append(((match.group(1), int(match.group(2) or 0)), os.path.join(directory, name)))
+		return [path for key, path in sorted(segments)]
+
+# handler of a web worker for a log which the ingest daemon writes (daemon mode): several gunicorn workers rotating the same
+# file would lose records, so the workers send their records to the daemon, the only process writing the file (see ovtimdaemon)
+# records are collected by writeRecord and sent with one message per batch of the logging pipeline (flush); while the daemon
+# cannot be reached the newest maxPending records are kept, older ones are dropped (and counted)
+# Usage:
+#	handler = ForwardingHandler('webapp', 'webapp.log')
+#	handler.send = daemonClient.sendLog				(send(logname, records) returns False if the records were not sent)
+class ForwardingHandler(logging.Handler):
+	def __init__(self, logname, basefilename, send=None, maxPending=10000):
+		logging.Handler.__init__(self)
+		self.logname = logname
+		self.baseFilename = basefilename # file written by the daemon, names the log in the statistics
+		self.send = send
+		self.pending = collections.deque()
+		self.maxPending = maxPending
+		self.dropped = 0
+
+	# queue a record as [created, levelno, message] (the daemon formats it like its own records); returns None, the bytes
+	# written are counted by the daemon
+	def writeRecord(self, record):
+		message = record.getMessage()
+		if record.exc_info:
+			message += '\n' + (self.formatter or logging.Formatter()).formatException(record.exc_info)
+		with self.lock:
+			if len(self.pending) >= self.maxPending:
+				self.pending.popleft()
+				self.dropped += 1
+			self.pending.append([record.created, record.levelno, message])
+		return None
+
+	def flush(self):
+		with self.lock:
+			if not self.pending or self.send is None:
+				return
+			if self.send(self.logname, list(self.pending)):
+				self.pending.clear()
+
+	def emit(self, record):
+		try:
+			self.writeRecord(record)
+			self.flush()
+		except Exception:
+			self.handleError(record)
+
+# compresses the segments finished by CompressingRotatingFileHandlers and enforces their count and total size limits
+# in a thread of its own, so the logging pipeline never waits for gzip; segments are synced before the original is removed
+# (under gevent the compression itself runs on a native thread, see runBlocking)
+# Usage:
+#	logCompressor.submit(handler)
+#	logCompressor.getStats()
+class LogCompressor(object):
+	def __init__(self, level=6):
+		self.level = level
+		self.queue = queue.Queue()
+		self.compressed = 0 # segments compressed
+		self.bytesIn = 0 # size of the segments before compression
+		self.bytesOut = 0 # size of the compressed segments
+		self.removed = 0 # segments removed to stay within the limits
+		self.removedBytes = 0
+		self.reportLogger = None # logger which receives compression errors
+		self.thread = None
+		self.startLock = threading.Lock()
+
+	# thread-safe: compress the finished segments of handler and remove the oldest ones over its limits
+	def submit(self, handler):
+		self.start()
+		self.queue.put(handler)
+
+	def start(self):
+		with self.startLock:
+			if self.thread is not None:
+				return
+			self.thread = threading.Thread(target=self.run, name='LogCompressor')
+			self.thread.daemon = True
+			self.thread.start()
+
+	# returns dict with the compression counters and the current size of the segments on disk
+	def getStats(self):
+		return {'compressed': self.compressed, 'bytesin': self.bytesIn, 'bytesout': self.bytesOut, 'removed': self.removed, 'removedbytes': self.removedBytes, 'pending': self.queue.qsize()}
+
+	# waits until every submitted handler was processed (used by the benchmark)
+	def join(self):
+		self.queue.join()
+
+	def run(self):
+		while True:
+			handler = self.queue.get()
+			try:
+				for path in handler.getSegments():
+					if not path.endswith('.gz'):
+						runBlocking(self._compress, path)
+				runBlocking(self._prune, handler)
+			except OSError as e:
+				if self.reportLogger is not None:
+					self.reportLogger.error('Failed to compress the rotated logs of %s: %s', handler.baseFilename, e)
+			finally:
+				self.queue.task_done()
+
+	def _compress(self, path):
+		temporary = '%s.gz.tmp%d' % (path, os.getpid())
+		try:
+			with open(path, 'rb') as source, open(temporary, 'wb') as target:
+				with gzip.GzipFile(os.path.basename(path), 'wb', self.level, target, os.stat(path).st_mtime) as compressed:
+					shutil.copyfileobj(source, compressed, 1048576)
+				target.flush()
+				os.fsync(target.fileno())
+			shutil.copystat(path, temporary)
+			os.replace(temporary, path + '.gz')
+			self.bytesIn += os.path.getsize(path)
+			self.bytesOut += os.path.getsize(path + '.gz')
+			os.remove(path)
+			self.compressed += 1
+		except FileNotFoundError:
+			pass # compressed by another process writing to the same log
+		finally:
+			if os.path.exists(temporary):
+				os.remove(temporary)
+
+	# keep the newest backupCount segments which fit into maxTotalBytes together
+	def _prune(self, handler):
+		segments = [(path, os.path.getsize(path)) for path in handler.getSegments()]
+		total = sum(size for path, size in segments)
+		while segments and ((handler.backupCount and len(segments) > handler.backupCount) or (handler.maxTotalBytes and total > handler.maxTotalBytes)):
+			path, size = segments.pop(0)
+			os.remove(path)
+			total -= size
+			self.removed += 1
+			self.removedBytes += size
+
+# asynchronous logging pipeline
+# loggers only enqueue records; a background listener batches them, formats them and writes each batch with a single flush
+# a batch collects records for up to commitInterval seconds (or until batchSize records, or a record at commitLevel or above)
+# and is synced to the storage afterwards (on a native thread under gevent, see runBlocking), so the flash sees one write per log file every few seconds rather than one per record
+# bytes written per hour (of the last statsHours hours) are reported by getStats
+# Usage:
+#	logger.addHandler(logPipeline.queueHandler(CompressingRotatingFileHandler(...)))
+#	logPipeline.getStats()
+class LogPipeline(object):
+	def __init__(self, maxQueued=10000, batchSize=256, flushInterval=1.0, commitInterval=0, commitLevel=logging.ERROR, statsHours=24):
+		self.queue = queue.Queue(maxQueued)
+		self.batchSize = batchSize
+		self.flushInterval = flushInterval
+		self.commitInterval = commitInterval
+		self.commitLevel = commitLevel
+		self.dropped = 0 # records dropped because the queue was full
+		self.written = 0 # records written to their handlers
+		self.batches = 0 # number of flushes
+		self.fsyncs = 0 # number of syncs of a log file
+		self.bytesWritten = {} # log file name -> bytes written
+		self.hours = collections.deque(maxlen=statsHours) # [hour (seconds since the epoch), bytes, records, fsyncs]
+		self.reportedDropped = 0
+		self.reportLogger = None # logger which receives the 'records dropped' warnings
+		self.thread = None
+		self.startLock = threading.Lock()
+		self.stopEvent = threading.Event()
+
+	# returns a queue handler which hands its records to target (a logging.Handler) in the listener thread
+	def queueHandler(self, target):
+		self.start()
+		return PipelineQueueHandler(self, target)
+
+	def start(self):
+		with self.startLock:
+			if self.thread is not None:
+				return
+			self.thread = threading.Thread(target=self.run, name='LogPipeline')
+			self.thread.daemon = True
+			self.thread.start()
+			atexit.register(self.stop)
+
+	# stop the listener after writing everything that is still queued
+	def stop(self, timeout=5):
+		self.stopEvent.set()
+		try:
+			self.queue.put_nowait(None) # ends a batch which is still collecting records
+		except queue.Full:
+			pass
+		if self.thread is not None:
+			self.thread.join(timeout)
+
+	# returns dict with the current queue depth and counters; 'hourly' lists the bytes, records and fsyncs of each hour
+	# (the current one last) and 'bytesperhour' is the mean of the complete hours
+	def getStats(self):
+		hours = [list(x) for x in self.hours]
+		complete = [x[1] for x in hours[:-1]]
+		return {'queued': self.queue.qsize(), 'maxqueued': self.queue.maxsize, 'dropped': self.dropped, 'written': self.written, 'batches': self.batches, 'fsyncs': self.fsyncs,
+			'bytes': dict(self.bytesWritten), 'bytesperhour': sum(complete) // len(complete) if complete else None,
+			'hourly': [{'hour': time.strftime('%Y-%m-%d %H:00', time.localtime(x[0])), 'bytes': x[1], 'records': x[2], 'fsyncs': x[3]} for x in hours],
+			'compression': logCompressor.getStats()}
+
+	def run(self):
+		while not (self.stopEvent.is_set() and self.queue.empty()):
+			batch = self._nextBatch()
+			if batch:
+				self._write(batch)
+			self._reportDropped()
+
+	# wait up to flushInterval for the first record, then collect records for up to commitInterval seconds
+	# (None is queued by stop and ends the batch)
+	def _nextBatch(self):
+		batch = []
+		try:
+			item = self.queue.get(timeout=self.flushInterval)
+			deadline = time.monotonic() + self.commitInterval
+			while item is not None:
+				batch.append(item)
+				if len(batch) >= self.batchSize or item[1].levelno >= self.commitLevel:
+					break
+				timeout = 0 if self.stopEvent.is_set() else deadline - time.monotonic()
+				item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+		except queue.Empty:
+			pass
+		return batch
+
+	def _write(self, batch):
+		touched = {}
+		written = 0
+		fsyncs = 0
+		for target, record in batch:
+			if record.levelno < target.level:
+				continue
+			try:
+				if target.filter(record):
+					count = self._writeRecord(target, record)
+					if count:
+						name = os.path.basename(target.baseFilename)
+						self.bytesWritten[name] = self.bytesWritten.get(name, 0) + count
+						metrics.inc('karlbox_log_written_bytes_total', (name,), count)
+						written += count
+					touched[id(target)] = target
+					self.written += 1
+			except Exception:
+				target.handleError(record)
+		for target in touched.values():
+			try:
+				if hasattr(target, 'commit'):
+					runBlocking(target.commit)
+					fsyncs += 1
+				else:
+					target.flush()
+			except Exception:
+				pass
+		self.batches += 1
+		self.fsyncs += fsyncs
+		metrics.inc('karlbox_log_fsyncs_total', (), fsyncs)
+		hour = time.time() // 3600 * 3600
+		if not self.hours or self.hours[-1][0] != hour:
+			self.hours.append([hour, 0, 0, 0])
+		self.hours[-1][1] += written
+		self.hours[-1][2] += len(batch)
+		self.hours[-1][3] += fsyncs
+
+	# write a record without the per-record flush done by StreamHandler.emit
+	# returns the number of bytes written if the handler knows it (CompressingRotatingFileHandler), otherwise None
+	def _writeRecord(self, target, record):
+		if hasattr(target, 'writeRecord'):
+			return target.writeRecord(record)
+		if isinstance(target, logging.handlers.BaseRotatingHandler):
+			if target.shouldRollover(record):
+				target.doRollover()
+		stream = getattr(target, 'stream', None)
+		if stream is None:
+			target.emit(record) # handler without a stream (or a delayed one), let it write the record itself
+			return
+		stream.write(target.format(record) + target.terminator)
+
+	# drops are reported through the pipeline itself, at most once per listener pass
+	def _reportDropped(self):
+		if self.dropped == self.reportedDropped or self.reportLogger is None:
+			return
+		count = self.dropped - self.reportedDropped
+		self.reportedDropped = self.dropped
+		self.reportLogger.warning('Logging queue full: %d record(s) dropped (%d total)', count, self.dropped)
+
+logCompressor = LogCompressor(ovtimconfig.logCompressLevel)
+logPipeline = LogPipeline(ovtimconfig.logQueueSize, ovtimconfig.logBatchSize, ovtimconfig.logFlushInterval, ovtimconfig.logCommitInterval, logging.getLevelName(ovtimconfig.logCommitLevel), ovtimconfig.logStatsHours)
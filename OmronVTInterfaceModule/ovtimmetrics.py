@@ -0,0 +1,186 @@
+import bisect
+import sys
+import threading
+import weakref
+
+# default histogram buckets (in seconds) for latencies
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# values written by one OS thread
+# counters are numbers, histograms are lists: [count of each bucket..., count of +Inf bucket, sum]
+class _Shard(object):
+	__slots__ = ('values', '__weakref__')
+
+	def __init__(self):
+		self.values = {} # (name, label values) -> counter value or histogram list
+
+# metrics collected by the webapp, rendered in the Prometheus text format for /metrics
+# every thread writes to its own shard without taking a lock; the shards are only summed up when the metrics are rendered
+# (the values of threads which ended are folded into one retired dict)
+# shards belong to OS threads even when gevent patched threading: the greenlets of a thread share its shard (they cannot switch
+# in the middle of an update), instead of every greenlet adding a shard which is only retired once it was collected
+# gauges are read from callbacks when rendering
+# Usage:
+#	metrics.counter('karlbox_scanner_reads_total', 'Frames read from scanners', ('scanner',))
+#	metrics.histogram('karlbox_serial_write_seconds', 'Time to write one barcode to the serial port')
+#	metrics.gauge('karlbox_output_queue_length', 'Barcodes waiting to be sent', lambda: [((), len(queue))])
+#	metrics.inc('karlbox_scanner_reads_total', ('192.168.188.2:2001',))
+#	metrics.observe('karlbox_serial_write_seconds', 0.0012)
+#	metrics.render()
+class MetricsRegistry(object):
+	def __init__(self):
+		self.families = {} # name -> (type, help, label names, buckets or gauge callback)
+		self.local = _osThreadLocal()
+		self.shards = [] # (weak reference to the shard, its values)
+		self.retired = {} # values of shards whose thread ended
+		self.lock = threading.Lock()
+
+	def counter(self, name, help, labelNames=()):
+		self.families[name] = ('counter', help, tuple(labelNames), None)
+
+	def histogram(self, name, help, labelNames=(), buckets=LATENCY_BUCKETS):
+		self.families[name] = ('histogram', help, tuple(labelNames), tuple(sorted(buckets)))
+
+	# callback returns an iterable of (label values, value)
+	# kind 'counter' exports a total which is counted elsewhere
+	def gauge(self, name, help, callback, labelNames=(), kind='gauge'):
+		self.families[name] = (kind, help, tuple(labelNames), callback)
+
+	def inc(self, name, labels=(), value=1):
+		try:
+			values = self.local.shard.values
+		except AttributeError:
+			values = self._newShard().values
+		key = (name, labels)
+		values[key] = values.get(key, 0) + value
+
+	def observe(self, name, value, labels=()):
+		try:
+			values = self.local.shard.values
+		except AttributeError:
+			values = self._newShard().values
+		key = (name, labels)
+		histogram = values.get(key)
+		buckets = self.families[name][3]
+		if histogram is None:
+			histogram = values[key] = [0] * (len(buckets) + 2)
+		histogram[bisect.bisect_left(buckets, value)] += 1
+		histogram[-1] += value
+
+	# returns dict: {(name, label values): value} summed over every shard
+	# extra values (e.g. counted by the ingest daemon, in the same layout) are added to the totals
+	def collect(self, extra=None):
+		with self.lock:
+			self._retireDead()
+			total = self._merge({}, self.retired)
+			shards = list(self.shards)
+		for ref, values in shards:
+			self._merge(total, dict(values))
+		if extra:
+			self._merge(total, extra)
+		return total
+
+	# returns the metrics in the Prometheus text exposition format
+	def render(self, extra=None):
+		values = self.collect(extra)
+		byName = {}
+		for (name, labels), value in values.items():
+			byName.setdefault(name, []).append((labels, value))
+		lines = []
+		for name, (kind, help, labelNames, extra) in sorted(self.families.items()):
+			lines.append('# HELP %s %s' % (name, help))
+			lines.append('# TYPE %s %s' % (name, kind))
+			if callable(extra):
+				try:
+					samples = list(extra())
+				except Exception as e:
+					lines.append('# %s callback failed: %s' % (name, str(e).replace('\n', ' ')))
+					continue
+				for labels, value in sorted(samples):
+					lines.append('%s%s %s' % (name, _formatLabels(labelNames, labels), _formatValue(value)))
+				continue
+			for labels, value in sorted(byName.get(name, ()), key=lambda x: x[0]):
+				if kind == 'counter':
+					lines.append('%s%s %s' % (name, _formatLabels(labelNames, labels), _formatValue(value)))
+					continue
+				cumulative = 0
+				for bound, count in zip(extra + ('+Inf',), value):
+					cumulative += count
+					lines.append('%s_bucket%s %s' % (name, _formatLabels(labelNames + ('le',), labels + (_formatValue(bound),)), cumulative))
+				lines.append('%s_sum%s %s' % (name, _formatLabels(labelNames, labels), _formatValue(value[-1])))
+				lines.append('%s_count%s %s' % (name, _formatLabels(labelNames, labels), cumulative))
+		return '\n'.join(lines) + '\n'
+
+	def _newShard(self):
+		shard = self.local.shard = _Shard()
+		with self.lock:
+			if len(self.shards) >= 64:
+				self._retireDead()
+			self.shards.append((weakref.ref(shard), shard.values))
+		return shard
+
+	# must be called with the lock held
+	def _retireDead(self):
+		alive = []
+		for ref, values in self.shards:
+			if ref() is None:
+				self._merge(self.retired, values)
+			else:
+				alive.append((ref, values))
+		self.shards = alive
+
+	@staticmethod
+	def _merge(total, values):
+		for key, value in values.items():
+			current = total.get(key)
+			if current is None:
+				total[key] = list(value) if isinstance(value, list) else value
+			elif isinstance(value, list):
+				for i, x in enumerate(value):
+					current[i] += x
+			else:
+				total[key] = current + value
+		return total
+
+# threading.local of the OS thread; gevent's patched threading.local is local to each greenlet
+def _osThreadLocal():
+	monkey = sys.modules.get('gevent.monkey')
+	if monkey is not None and monkey.is_module_patched('threading'):
+		return monkey.get_original('threading', 'local')()
+	return threading.local()
+
+def _formatLabels(names, values):
+	if not names:
+		return ''
+	return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in zip(names, values)) + '}'
+
+def _formatValue(value):
+	if isinstance(value, float):
+		return repr(value)
+	return str(value)
+
+metrics = MetricsRegistry()
+
+# metrics of the scanner pipeline
+metrics.counter('karlbox_scanner_reads_total', 'Barcodes read from a scanner', ('scanner',))
+metrics.counter('karlbox_scanner_duplicates_total', 'Barcodes read again within the deduplication window (or repeating the previous barcode of the scanner)', ('scanner',))
+metrics.counter('karlbox_scanner_toosoon_total', 'Barcodes ignored because the scanner time limit had not elapsed', ('scanner',))
+metrics.counter('karlbox_scanner_connection_events_total', 'Scanner connection state changes (connected, reconnected, connectretry, connectfailed, reset, error, idle)', ('scanner', 'event'))
+metrics.counter('karlbox_scanner_received_bytes_total', 'Bytes received from a scanner socket', ('scanner',))
+metrics.counter('karlbox_scanner_rejected_total', 'Barcodes rejected by the rules of the active profile', ('scanner',))
+metrics.counter('karlbox_scanner_subscriptions_total', 'Browser subscriptions to a scanner', ('scanner',))
+metrics.histogram('karlbox_read_to_emit_seconds', 'Time from reading a barcode to sending its notification to the browsers', ('scanner',))
+metrics.histogram('karlbox_read_to_serial_seconds', 'Time from reading a barcode to writing it to the inspection machine')
+metrics.histogram('karlbox_serial_write_seconds', 'Time to write and drain one barcode on the serial port')
+metrics.counter('karlbox_serial_written_bytes_total', 'Bytes written to the inspection machine')
+metrics.counter('karlbox_serial_errors_total', 'Failed writes to the inspection machine')
+metrics.counter('karlbox_serial_connect_attempts_total', 'Attempts to open the serial port to the inspection machine', ('result',))
+metrics.histogram('karlbox_read_to_sink_seconds', 'Time from reading a barcode to writing it to an output of the active profile', ('sink',))
+metrics.counter('karlbox_sink_written_bytes_total', 'Bytes written to an output of the active profile', ('sink',))
+metrics.counter('karlbox_sink_errors_total', 'Failed writes to an output of the active profile (each is retried, see ovtimsinks)', ('sink',))
+
+# metrics of the logging pipeline
+metrics.counter('karlbox_log_written_bytes_total', 'Bytes written to a log file', ('file',))
+metrics.counter('karlbox_log_fsyncs_total', 'Log files synced to the storage')
+metrics.counter('karlbox_config_reads_total', 'Config reads, answered from the cache (hit) or by loading the config (load)', ('result',))
+metrics.histogram('karlbox_config_load_seconds', 'Time to load and validate the config')
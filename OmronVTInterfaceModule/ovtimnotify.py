@@ -0,0 +1,117 @@
+import threading
+import time
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+from OmronVTInterfaceModule.ovtimhub import roomName
+from OmronVTInterfaceModule.ovtimmetrics import metrics
+
+# returns the encodings this server can send
+def getEncodings():
+	return ('json', 'msgpack') if msgpack is not None else ('json',)
+
+# collects scanner notifications and sends them in batches, at most one event per room every window seconds
+# notifications are compact dicts which the page turns into messages, e.g.
+#	{'event': 'barcode', 'time': 1760364000.123, 'barcode': 'ABC123', 'seq': 5, 'count': 1}
+#	{'event': 'connectretry', 'time': ..., 'attempt': 1, 'attempts': 0, 'delay': 0.4, 'detail': 'ECONNREFUSED'}
+# a batch is emitted as 'Event_scannerNotifications' {'ip': ip, 'port': port, 'events': [notification, ...]} to the scanner's room
+# (ip and port are None for notifications sent to every client), and msgpack encoded as 'Event_scannerNotificationsPacked'
+# to the scanner's msgpack room when it has subscribers and msgpack is installed
+# repeated reads of the same barcode within one window are merged into a single notification with the latest time and count
+# Usage:
+#	notifier = NotificationFanout(socketio, scannerHub, window=0.05)
+#	notifier.start(socketio.start_background_task)
+#	notifier.publish(ip, port, 'barcode', barcode='ABC123', seq=5, count=1, readTime=time.monotonic())
+#	notifier.publish(None, None, 'sent', barcode='ABC123')
+class NotificationFanout(object):
+	def __init__(self, socketio, hub=None, window=0.05):
+		self.socketio = socketio
+		self.hub = hub
+		self.window = window
+		self.batches = {} # (ip, port) -> list of notifications
+		self.seqIndex = {} # (ip, port, seq) -> notification in the current batch
+		self.readTimes = {} # (ip, port) -> monotonic read times of the barcodes in the current batch (for karlbox_read_to_emit_seconds)
+		self.condition = threading.Condition()
+		self.running = False
+		self.emitted = 0 # number of batches emitted
+		self.published = 0 # number of notifications published
+		self.merged = 0 # notifications merged into one already queued
+
+	# start the worker once, using the given function to spawn it (e.g. socketio.start_background_task)
+	def start(self, spawn):
+		with self.condition:
+			if self.running:
+				return False
+			self.running = True
+		spawn(self.run)
+		return True
+
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+
+	# queue a notification for the scanner at ip:port (None, None for every client)
+	# readTime is the time.monotonic() the barcode was read, used to measure the time until it is sent to the browsers
+	def publish(self, ip, port, event, readTime=None, **fields):
+		fields['event'] = event
+		fields['time'] = round(time.time(), 3)
+		key = (ip, None if port is None else int(port))
+		with self.condition:
+			self.published += 1
+			if readTime is not None:
+				self.readTimes.setdefault(key, []).append(readTime)
+			seq = fields.get('seq')
+			if event == 'duplicate' and seq is not None:
+				queued = self.seqIndex.get(key + (seq,))
+				if queued is not None:
+					queued['time'] = fields['time']
+					queued['count'] = fields.get('count', queued.get('count', 1))
+					self.merged += 1
+					return
+			batch = self.batches.get(key)
+			if batch is None:
+				batch = self.batches[key] = []
+			batch.append(fields)
+			if seq is not None:
+				self.seqIndex[key + (seq,)] = fields
+			if len(self.batches) == 1 and len(batch) == 1:
+				self.condition.notify()
+
+	# returns dict with the number of notifications published and merged, and of batches emitted
+	def getStats(self):
+		return {'published': self.published, 'merged': self.merged, 'emitted': self.emitted, 'window': self.window, 'encodings': list(getEncodings())}
+
+	def run(self):
+		while True:
+			with self.condition:
+				while self.running and not self.batches:
+					self.condition.wait()
+				if not self.running:
+					break
+			# let the burst complete, then send everything collected so far
+			time.sleep(self.window)
+			with self.condition:
+				batches, self.batches, self.seqIndex = self.batches, {}, {}
+				readTimes, self.readTimes = self.readTimes, {}
+			for key, events in batches.items():
+				self._emit(key, events)
+				if key in readTimes:
+					now = time.monotonic()
+					labels = ('%s:%s' % key,)
+					for readTime in readTimes[key]:
+						metrics.observe('karlbox_read_to_emit_seconds', now - readTime, labels)
+
+	def _emit(self, key, events):
+		ip, port = key
+		payload = {'ip': ip, 'port': port, 'events': events}
+		if ip is None:
+			self.socketio.emit('Event_scannerNotifications', payload)
+		else:
+			self.socketio.emit('Event_scannerNotifications', payload, to=roomName(ip, port))
+			if msgpack is not None and self.hub is not None and self.hub.getSubscriberCount(ip, port, 'msgpack'):
+				self.socketio.emit('Event_scannerNotificationsPacked', msgpack.packb(payload), to=roomName(ip, port, 'msgpack'))
+		self.emitted += 1
@@ -0,0 +1,159 @@
+import threading
+import time
+from collections import deque
+
+from OmronVTInterfaceModule.ovtimmetrics import metrics
+
+# re-send policies for the barcode output dispatcher
+#	'none'		every barcode is sent exactly once, as soon as it is read
+#	'repeat'	the last barcode is also re-sent every resendInterval seconds until resendWindow seconds after it was read
+RESEND_POLICIES = ('none', 'repeat')
+
+# what happens to a barcode put() while the queue is full
+#	'drop'		the oldest queued barcode is dropped
+#	'block'		the barcode waits up to blockTimeout seconds for the worker to make room, then the oldest queued barcode is dropped
+#				(it waits in an overflow buffer of up to maxQueued barcodes, put() itself never waits: it is called from the
+#				ingest loop, which a wedged output must not hold up)
+BACKPRESSURE_MODES = ('drop', 'block')
+
+# sends barcodes to the inspection machine from a bounded queue
+# the worker sleeps on a condition variable while idle and wakes up the moment a barcode is queued
+# send(barcode, isResend) is called from the worker; exceptions are logged and the barcode is dropped
+# close() (optional) is called from the worker once it stopped
+# the time from reading a barcode to sending it is observed in the latencyMetric histogram
+# Usage:
+#	dispatcher = BarcodeDispatcher(app.logger, resendPolicy='none')
+#	dispatcher.start(socketio.start_background_task, sendFunction)
+#	dispatcher.put(barcode)
+class BarcodeDispatcher(object):
+	def __init__(self, logger, maxQueued=64, resendPolicy='none', resendInterval=10, resendWindow=30, backpressure='drop', blockTimeout=1, name='inspection machine', latencyMetric='karlbox_read_to_serial_seconds', metricLabels=()):
+		if resendPolicy not in RESEND_POLICIES:
+			raise ValueError('unknown resend policy: ' + str(resendPolicy))
+		if backpressure not in BACKPRESSURE_MODES:
+			raise ValueError('unknown backpressure mode: ' + str(backpressure))
+		self.logger = logger
+		self.maxQueued = maxQueued
+		self.resendPolicy = resendPolicy
+		self.resendInterval = resendInterval
+		self.resendWindow = resendWindow
+		self.backpressure = backpressure
+		self.blockTimeout = blockTimeout
+		self.name = name
+		self.latencyMetric = latencyMetric
+		self.metricLabels = metricLabels
+		self.queue = deque()
+		self.overflow = deque() # (barcode, readTime, deadline) waiting for room in the queue ('block' backpressure)
+		self.condition = threading.Condition() # signalled when a barcode is queued
+		self.send = None
+		self.close = None
+		self.running = False
+		self.lastBarcode = None
+		self.lastReadTime = 0 # monotonic time the last barcode was read
+		self.lastSendTime = 0 # monotonic time the last barcode was sent
+		self.sentCount = 0
+		self.droppedCount = 0
+		self.failedCount = 0 # barcodes send() failed for
+		self.blockedCount = 0 # barcodes which had to wait for room in the queue
+
+	# start the worker once, using the given function to spawn it (e.g. socketio.start_background_task)
+	# returns False if the worker was already running
+	def start(self, spawn, send, close=None):
+		with self.condition:
+			if self.running:
+				return False
+			self.running = True
+			self.send = send
+			self.close = close
+		spawn(self.run)
+		return True
+
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.overflow.clear()
+			self.condition.notify()
+
+	# queue a barcode for output without waiting; if the queue is full the oldest queued barcode is dropped (see BACKPRESSURE_MODES)
+	def put(self, barcode):
+		now = time.monotonic()
+		with self.condition:
+			if self.backpressure == 'block' and self.running and (self.overflow or len(self.queue) >= self.maxQueued):
+				self.blockedCount += 1
+				self.overflow.append((barcode, now, now + self.blockTimeout))
+				self._admitOverflow(now)
+			else:
+				if len(self.queue) >= self.maxQueued:
+					self._dropOldest()
+				self.queue.append((barcode, now))
+			self.condition.notify()
+
+	# must be called with the condition held
+	# moves waiting barcodes into the queue while there is room, or once they waited blockTimeout seconds (or the overflow
+	# buffer is full), dropping the oldest queued barcode for them
+	def _admitOverflow(self, now):
+		while self.overflow:
+			barcode, readTime, deadline = self.overflow[0]
+			if len(self.queue) >= self.maxQueued:
+				if deadline > now and len(self.overflow) <= self.maxQueued:
+					return
+				self._dropOldest()
+			self.overflow.popleft()
+			self.queue.append((barcode, readTime))
+
+	def _dropOldest(self):
+		dropped = self.queue.popleft()
+		self.droppedCount += 1
+		self.logger.warning('Barcode output queue of %s full, dropped barcode: %s', self.name, dropped[0])
+
+	# returns dict: {'running', 'queued', 'waiting', 'sent', 'dropped', 'failed', 'blocked'}
+	def getStats(self):
+		return {'running': self.running, 'queued': len(self.queue), 'waiting': len(self.overflow), 'sent': self.sentCount, 'dropped': self.droppedCount, 'failed': self.failedCount, 'blocked': self.blockedCount}
+
+	def run(self):
+		self.logger.info('Barcode output dispatcher for %s started (resend policy: %s)', self.name, self.resendPolicy)
+		while True:
+			with self.condition:
+				item = self._waitForWork()
+				if item is None:
+					break
+			barcode, readTime, isResend = item
+			try:
+				self.send(barcode, isResend)
+				self.sentCount += 1
+				if not isResend:
+					metrics.observe(self.latencyMetric, time.monotonic() - readTime, self.metricLabels)
+			except Exception as e:
+				self.failedCount += 1
+				self.logger.error('Failed to send barcode (%s) to %s because %s', barcode, self.name, e)
+			self.lastSendTime = time.monotonic()
+		if self.close is not None:
+			self.close()
+		self.logger.info('Barcode output dispatcher for %s stopped', self.name)
+
+	# must be called with the condition held
+	# returns tuple: (barcode, readTime, isResend), or None when stopped
+	def _waitForWork(self):
+		while self.running:
+			if self.queue:
+				barcode, readTime = self.queue.popleft()
+				self._admitOverflow(time.monotonic())
+				self.lastBarcode = barcode
+				self.lastReadTime = readTime
+				return (barcode, readTime, False)
+			resendAt = self._nextResendTime()
+			if resendAt is None:
+				self.condition.wait()
+				continue
+			remaining = resendAt - time.monotonic()
+			if remaining <= 0:
+				return (self.lastBarcode, self.lastReadTime, True)
+			self.condition.wait(remaining)
+		return None
+
+	def _nextResendTime(self):
+		if self.resendPolicy != 'repeat' or self.lastBarcode is None:
+			return None
+		resendAt = self.lastSendTime + self.resendInterval
+		if resendAt - self.lastReadTime > self.resendWindow:
+			return None
+		return resendAt
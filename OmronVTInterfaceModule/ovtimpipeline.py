@@ -0,0 +1,249 @@
+import threading
+import time
+
+from markupsafe import escape
+
+import OmronVTInterfaceModule.ovtimconfig as ovtimconfig
+from OmronVTInterfaceModule.ovtimdedup import DedupEngine
+from OmronVTInterfaceModule.ovtimfunctions import TimeManager, getDedupSettings
+from OmronVTInterfaceModule.ovtimingest import IngestEngine
+from OmronVTInterfaceModule.ovtimjournal import FLAG_DUPLICATE, FLAG_REJECTED, FLAG_TOOSOON
+from OmronVTInterfaceModule.ovtimmetrics import metrics
+from OmronVTInterfaceModule.ovtimoutput import BarcodeDispatcher
+from OmronVTInterfaceModule.ovtimrules import RuleSet, getRuleSet
+from OmronVTInterfaceModule.ovtimsinks import SinkRouter
+
+# scanner ingest, barcode handling and serial output of one process
+# runs inside the webapp (ingestMode 'inprocess') or inside the ingest daemon (ingestMode 'daemon', see ovtimdaemon)
+# every notification for the browsers goes through publish(ip, port, event, readTime=None, **fields),
+# which is NotificationFanout.publish in the webapp and the daemon's broadcast to the web workers in the daemon
+# Usage:
+#	pipeline = ScannerPipeline(scannerNotifier.publish, app.logger, barcodeLogger, barcodeJournal, barcodeHistories)
+#	pipeline.setProfile(dictActiveProfile)							(again whenever the config is saved)
+#	pipeline.start(socketio.start_background_task)
+#	pipeline.ingest.addScanner('192.168.188.2', 2001)
+#	pipeline.startOutput(socketio.start_background_task)		(blocks while connecting to the serial port)
+class ScannerPipeline(object):
+	def __init__(self, publish, logger, barcodeLogger, journal, histories):
+		self.publish = publish
+		self.logger = logger
+		self.barcodeLogger = barcodeLogger
+		self.journal = journal
+		self.histories = histories
+		self.scannerData = {} # ip -> {'timer': time.time() of the last barcode passed on, 'timerMsgFlag': 1 once a 'too soon' read was logged}
+		self.ingest = IngestEngine(self.processBarcode, self.processScannerEvent, logger, connectTimeout=ovtimconfig.scannerConnectTimeout, backoffBase=ovtimconfig.scannerBackoffBase, backoffMax=ovtimconfig.scannerBackoffMax, backoffJitter=ovtimconfig.scannerBackoffJitter, maxAttempts=ovtimconfig.scannerConnectAttempts, keepalive=ovtimconfig.scannerKeepalive, idleTimeout=ovtimconfig.scannerIdleTimeout)
+		self.output = BarcodeDispatcher(logger, maxQueued=ovtimconfig.barcodeOutputQueueSize, resendPolicy=ovtimconfig.barcodeResendPolicy, resendInterval=ovtimconfig.barcodeSleepTime, resendWindow=ovtimconfig.barcodeOutputTimelimit)
+		self.outputLock = threading.Lock()
+		self.sinks = SinkRouter(logger) # additional outputs of the active profile
+		self.rules = RuleSet([]) # rules of the active profile, applied to every barcode before it is passed on
+		self.dedup = DedupEngine() # deduplication across the scanners of the cell, disabled until a profile sets a window
+
+	def start(self, spawn):
+		self.sinks.start(spawn)
+		return self.ingest.start(spawn)
+
+	# uses the outputs, rules and deduplication settings of the given (validated) profile from now on
+	def setProfile(self, dictProfile):
+		self.sinks.configure(dictProfile.get('outputs') or [])
+		rules = getRuleSet(dictProfile)
+		if rules is not self.rules:
+			self.rules = rules
+			self.logger.info('Barcode rules loaded (%s rule(s))', rules.count)
+		window, keyMode = getDedupSettings(dictProfile)
+		if (window, keyMode) != (self.dedup.window, self.dedup.keyMode):
+			# the barcodes remembered so far are forgotten
+			self.dedup = DedupEngine(window, keyMode, ovtimconfig.dedupMaxEntries)
+			self.logger.info('Barcode deduplication: %s', 'window %s s, key %s' % (window, keyMode) if window else 'previous barcode of the scanner')
+
+	# sets the number of barcodes kept for a scanner ('ip:port')
+	def setHistoryDepth(self, scanner, depth):
+		self.histories.get(scanner, depth)
+
+	# returns one page of a scanner's barcode history (see ovtimhistory.BarcodeHistory.page), or None if the scanner has no history
+	def historyPage(self, scanner, after=None, before=None, limit=100):
+		history = self.histories.find(scanner)
+		if history is None:
+			return None
+		return history.page(after, before, limit)
+
+	def historySummary(self):
+		return self.histories.summary()
+
+	# returns dict: {'running', 'queued', 'sent', 'dropped', 'outputs': [stats of each output, see ovtimsinks.SinkOutput.getStats]}
+	def getOutputStats(self):
+		return {'running': self.output.running, 'queued': len(self.output.queue), 'sent': self.output.sentCount, 'dropped': self.output.droppedCount, 'outputs': self.sinks.getStats()}
+
+	# metrics of this pipeline are counted in this process's registry already
+	def collectMetrics(self):
+		return {}
+
+	# barcode handling for every frame read by the ingest engine
+	def processBarcode(self, conn, rcvData):
+		ip = conn.ip
+		port = conn.port
+
+		### barcode handling logic:
+		# is this the first time seeing the scanner?
+		#   yes -> initialize variables, set initial timer to a value that ensures it will get read
+		# has it been at least 30 seconds since we last recorded a barcode from this scanner?
+		#   no -> Do not pass the barcode to the UI. Have we already logged it?
+		#       yes -> do nothing (do not log it)
+		#       no -> log a message saying the scanner scanned something before its time limit, and set a flag to prevent additional log messages
+		#   yes -> Clear any "too soon" scanner flags. Reset the 30 second timer. Is this the first barcode we've scanned?
+		#       yes -> append barcode+data to variable
+		#       no -> is the barcode the same as the previous scan?
+		#           yes -> update existing variable but dont append new one
+		#           no -> append barcode+data to variable
+
+		# convert raw barcode to a string with leading/trailing whitespace stripped and properly URL escaped
+		rcvData = rcvData.strip()
+		if len(rcvData) == 0:
+			return
+		readTime = time.monotonic()
+		rawBarcode = rcvData.decode('ascii', errors='replace')
+		scannerName = str(ip) + ':' + str(port)
+		metrics.inc('karlbox_scanner_reads_total', conn.metricLabels)
+
+		# the rules of the active profile reject the barcode, or decide what is passed on (barcode) and where it is sent (route)
+		# the journal keeps the barcode as it was read
+		rule, barcode = self.rules.evaluate(rawBarcode, scannerName)
+		if rule is not None and rule.action == 'reject':
+			self.barcodeLogger.info('Received barcode from scanner (%s:%s): %s | (The barcode was rejected by rule #%s of the profile)', ip, port, str(escape(rawBarcode)), rule.number)
+			self.journal.append(rawBarcode, scannerName, FLAG_REJECTED)
+			metrics.inc('karlbox_scanner_rejected_total', conn.metricLabels)
+			self.publish(ip, port, 'rejected', barcode=rawBarcode, rule=rule.number, readTime=readTime)
+			return
+		route = None if rule is None else rule.route
+		scannedBarcode = str(escape(barcode))
+
+		# the barcodes read by each scanner are kept in histories[ip:port]
+		scannerData = self.scannerData
+
+		if ip not in scannerData.keys():
+			scannerData[ip] = {'timer': time.time() - 1000, 'timerMsgFlag': 0}
+
+		if time.time() - scannerData[ip]['timer'] < ovtimconfig.scannerTimelimit:
+			if scannerData[ip]['timerMsgFlag'] == 0:
+				self.barcodeLogger.info('Received barcode from scanner (%s:%s), but scanner time limit hasnt been reached (%s seconds elapsed out of %s). Data will be ignored and future notifications are surpressed until the time limit has elapsed. (Barcode: %s)', ip, port, round(time.time() - scannerData[ip]['timer'], 1), ovtimconfig.scannerTimelimit, scannedBarcode)
+				scannerData[ip]['timerMsgFlag'] = 1
+			self.journal.append(rawBarcode, scannerName, FLAG_TOOSOON)
+			metrics.inc('karlbox_scanner_toosoon_total', conn.metricLabels)
+		else:
+			scannerData[ip]['timer'] = time.time()
+			scannerData[ip]['timerMsgFlag'] = 0
+
+			history = self.histories.get(scannerName)
+			dedup = self.dedup
+			if dedup.window:
+				# a barcode read again within the window (by any scanner of the cell, see ovtimdedup) is not sent again
+				original = dedup.check(barcode, scannerName, readTime)
+				if original is None:
+					seq = history.append(barcode)
+					dedup.add(barcode, scannerName, seq, readTime)
+					self.barcodeLogger.info('[1]Received barcode from scanner (%s:%s): %s', ip, port, scannedBarcode)
+					self.journal.append(rawBarcode, scannerName)
+					self._route(route, scannedBarcode)
+					self.publish(ip, port, 'barcode', barcode=barcode, seq=seq, count=1, readTime=readTime)
+				else:
+					originalScanner, seq = original
+					self.barcodeLogger.info('Received barcode from scanner (%s:%s): %s | (The barcode was already read by %s within the deduplication window)', ip, port, scannedBarcode, 'this scanner' if originalScanner == scannerName else originalScanner)
+					self.journal.append(rawBarcode, scannerName, FLAG_DUPLICATE)
+					metrics.inc('karlbox_scanner_duplicates_total', conn.metricLabels)
+					if originalScanner == scannerName:
+						self.publish(ip, port, 'duplicate', barcode=barcode, seq=seq, count=history.touch(seq), readTime=readTime)
+					else:
+						originalHistory = self.histories.find(originalScanner)
+						count = originalHistory.touch(seq) if originalHistory is not None else 0
+						self.publish(ip, port, 'duplicate', barcode=barcode, scanner=originalScanner, count=count, readTime=readTime)
+			elif history.lastBarcode() is not None:
+				if history.lastBarcode() == barcode:
+					seq = history.touchLast()
+					self.barcodeLogger.info('Received barcode from scanner (%s:%s): %s | (The barcode was a duplicate of the previously scanned barcode)', ip, port, scannedBarcode)
+					self.journal.append(rawBarcode, scannerName, FLAG_DUPLICATE)
+					metrics.inc('karlbox_scanner_duplicates_total', conn.metricLabels)
+					self._route(route, scannedBarcode)
+					self.publish(ip, port, 'duplicate', barcode=barcode, seq=seq, count=history.getCount(seq), readTime=readTime)
+				else:
+					seq = history.append(barcode)
+					self.barcodeLogger.info('[1]Received barcode from scanner (%s:%s): %s', ip, port, scannedBarcode)
+					self.journal.append(rawBarcode, scannerName)
+					self._route(route, scannedBarcode)
+					self.publish(ip, port, 'barcode', barcode=barcode, seq=seq, count=1, readTime=readTime)
+			else:
+				seq = history.append(barcode)
+				self.barcodeLogger.info('[2]Received barcode from scanner (%s:%s): %s', ip, port, scannedBarcode)
+				self.journal.append(rawBarcode, scannerName)
+				self._route(route, scannedBarcode)
+				self.publish(ip, port, 'barcode', barcode=barcode, seq=seq, count=1, readTime=readTime)
+
+	# passes an accepted barcode on to the outputs its rule routes it to (None: the inspection machine and every output of the profile)
+	def _route(self, route, barcode):
+		if route is None:
+			self.output.put(barcode)
+			if self.sinks.names:
+				self.sinks.put(self.sinks.names, barcode)
+			return
+		for name in route:
+			if name == 'serial':
+				self.output.put(barcode)
+			else:
+				self.sinks.put((name,), barcode)
+
+	# connection state changes reported by the ingest engine
+	def processScannerEvent(self, conn, event, detail):
+		ip = conn.ip
+		port = conn.port
+		metrics.inc('karlbox_scanner_connection_events_total', conn.metricLabels + (event,))
+		if event == 'connectretry':
+			self.publish(ip, port, 'connectretry', attempt=conn.attemptNo, attempts=self.ingest.maxAttempts, delay=round(conn.retryDelay, 1), detail=str(detail))
+		elif event == 'connectfailed':
+			self.publish(ip, port, 'connectfailed', attempt=conn.attemptNo, attempts=self.ingest.maxAttempts, detail=str(detail))
+		elif event in ('reset', 'error', 'idle'):
+			self.publish(ip, port, event, delay=round(conn.retryDelay, 1), detail=str(detail))
+		elif event == 'reconnected':
+			self.publish(ip, port, 'reconnected', downtime=detail)
+
+	# connects to the serial output device and starts the dispatcher which sends it every barcode as soon as it is read
+	# only one caller needs to start the output; later calls return right away
+	def startOutput(self, spawn):
+		if self.output.running or not self.outputLock.acquire(blocking=False):
+			self.logger.info('Barcode output already running')
+			return
+		try:
+			# initialize connection; failed attempts are retried after a delay doubling from serialBackoffBase up to serialBackoffMax
+			# (the serial adapter may only show up a few seconds after boot)
+			attemptNo = 1
+			attempts = ovtimconfig.serialConnectAttempts
+			delay = ovtimconfig.serialBackoffBase
+			serialPort = ovtimconfig.serialOutputPort
+			while True:
+				self.logger.info('Establishing serial connection with inspection machine to send barcode data on port %s (attempt #%s%s)', serialPort, attemptNo, ' of %s' % attempts if attempts else '')
+				try:
+					tm = TimeManager(serialPort, ovtimconfig.serialOutputBaudrate, ovtimconfig.serialOutputBytesize, ovtimconfig.serialOutputStopbits, ovtimconfig.serialOutputParity)
+					metrics.inc('karlbox_serial_connect_attempts_total', ('success',))
+					self.logger.info('Serial connection established on port %s', serialPort)
+					break
+				except Exception as e:
+					metrics.inc('karlbox_serial_connect_attempts_total', ('fail',))
+					if attempts and attemptNo >= attempts:
+						self.logger.error('Failed to establish serial connection to insection machine on port %s because of error: %s (attempt #%s of %s), giving up', serialPort, e, attemptNo, attempts)
+						self.publish(None, None, 'serialfailed', serialPort=serialPort, attempt=attemptNo, attempts=attempts, detail=str(e))
+						return
+					self.logger.error('Failed to establish serial connection to insection machine on port %s because of error: %s. Retrying in %s seconds (attempt #%s)', serialPort, e, delay, attemptNo)
+					self.publish(None, None, 'serialretry', serialPort=serialPort, attempt=attemptNo, attempts=attempts, delay=delay, detail=str(e))
+					attemptNo += 1
+					time.sleep(delay)
+					delay = min(delay * 2, ovtimconfig.serialBackoffMax)
+					continue
+
+			def send(barcode, isResend):
+				if ovtimconfig.serialAckMode:
+					tm.request(str(barcode.strip() + '\r\n').encode('utf-8'), ovtimconfig.serialAckBytes, ovtimconfig.serialAckTimeout)
+				else:
+					tm.send(str(barcode.strip() + '\r\n').encode('utf-8'))
+				self.publish(None, None, 'sent', barcode=str(barcode.strip()), resend=isResend)
+				self.barcodeLogger.info('Sent barcode to inspection machine: %s%s', barcode.strip(), ' (re-send)' if isResend else '')
+
+			self.output.start(spawn, send)
+		finally:
+			self.outputLock.release()
@@ -0,0 +1,76 @@
+import concurrent.futures
+import socket
+import threading
+import time
+
+# checks whether scanners accept TCP connections, using a bounded pool of workers
+# results are cached for ttl seconds and a probe already running for an endpoint is shared, so repeated page loads do not re-probe
+# result dict: {'ip': str, 'port': int, 'result': 'success' or 'fail', 'error': str, 'ms': connect time, 'cached': bool}
+# Usage:
+#	prober = ProbeService(app.logger, maxWorkers=16, timeout=5, ttl=10)
+#	prober.probe('192.168.188.2', 2001).add_done_callback(...)
+#	for result in prober.probeAll([('192.168.188.2', 2001), ('192.168.188.3', 2001)]): ...	(in order of completion)
+class ProbeService(object):
+	def __init__(self, logger, maxWorkers=16, timeout=5, ttl=10):
+		self.logger = logger
+		self.timeout = timeout
+		self.ttl = ttl
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix='ScannerProbe')
+		self.cache = {} # (ip, port) -> (result, expiry time)
+		self.running = {} # (ip, port) -> future of the probe in progress
+		self.lock = threading.Lock()
+
+	# returns a future which resolves to the result dict (already resolved if the result is cached)
+	def probe(self, ip, port):
+		key = (str(ip), int(port))
+		with self.lock:
+			cached = self.cache.get(key)
+			if cached is not None and cached[1] > time.monotonic():
+				future = concurrent.futures.Future()
+				future.set_result(dict(cached[0], cached=True))
+				return future
+			future = self.running.get(key)
+			if future is not None:
+				return future
+			future = self.running[key] = self.executor.submit(self._probe, key)
+		# outside the lock: the callback runs right away if the probe already finished
+		future.add_done_callback(lambda f, key=key: self._finished(key, f))
+		return future
+
+	# probe every endpoint at once; yields the result dicts as the probes complete
+	def probeAll(self, endpoints):
+		futures = [self.probe(ip, port) for ip, port in set((str(ip), int(port)) for ip, port in endpoints)]
+		for future in concurrent.futures.as_completed(futures):
+			yield future.result()
+
+	# forget cached results (of one endpoint, or all of them)
+	def invalidate(self, ip=None, port=None):
+		with self.lock:
+			if ip is None:
+				self.cache.clear()
+			else:
+				self.cache.pop((str(ip), int(port)), None)
+
+	def _probe(self, key):
+		start = time.monotonic()
+		try:
+			conn = socket.create_connection(key, self.timeout)
+			conn.close()
+			result = {'ip': key[0], 'port': key[1], 'result': 'success', 'error': ''}
+		except socket.timeout:
+			result = {'ip': key[0], 'port': key[1], 'result': 'fail', 'error': 'timed out after %s seconds' % self.timeout}
+		except OSError as e:
+			result = {'ip': key[0], 'port': key[1], 'result': 'fail', 'error': str(e)}
+		result['ms'] = round((time.monotonic() - start) * 1000, 1)
+		result['cached'] = False
+		if result['result'] == 'success':
+			self.logger.debug('Scanner (%s:%s) connected via LAN (%s ms)', key[0], key[1], result['ms'])
+		else:
+			self.logger.debug('Scanner (%s:%s) not connected via LAN- %s', key[0], key[1], result['error'])
+		return result
+
+	def _finished(self, key, future):
+		with self.lock:
+			self.running.pop(key, None)
+			if not future.cancelled() and future.exception() is None:
+				self.cache[key] = (future.result(), time.monotonic() + self.ttl)
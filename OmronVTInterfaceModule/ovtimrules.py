@@ -0,0 +1,248 @@
+import json
+import re
+
+# AIM symbology identifiers (ISO/IEC 15424) which scanners can be set up to send ahead of the data, e.g. ']d2' for Data Matrix
+SYMBOLOGIES = {'code39': 'A', 'code128': 'C', 'ean': 'E', 'upc': 'E', 'codabar': 'F', 'code93': 'G', 'itf': 'I', 'dotcode': 'J', 'pdf417': 'L', 'qr': 'Q', 'maxicode': 'U', 'datamatrix': 'd', 'databar': 'e', 'aztec': 'z'}
+AIM_ID = r'\][A-Za-z][0-9A-Za-z]'
+
+RULE_FIELDS = frozenset(('match', 'prefix', 'symbology', 'scanner', 'action', 'extract', 'addprefix', 'addsuffix', 'route'))
+RULE_ACTIONS = ('accept', 'reject')
+# 'serial' sends the barcode to the inspection machine, 'none' only shows, logs and journals it;
+# any other route is the name of one of the profile's outputs (see ovtimsinks)
+RULE_ROUTES = ('serial', 'none')
+
+# numbered backreferences and conditional groups refer to group numbers, which change when the rules are combined
+UNSUPPORTED_PATTERN = re.compile(r'(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(')
+NAMED_GROUP = re.compile(r'\(\?P([<=])([A-Za-z_]\w*)')
+
+# one compiled rule of a profile
+#	number		position of the rule in the profile's list, starting at 1
+#	action		'accept' or 'reject'
+#	route		tuple of the outputs the accepted barcode is sent to, or None for the profile's default outputs
+class Rule(object):
+	__slots__ = ('number', 'action', 'route', 'prefix', 'group', 'slice', 'addPrefix', 'addSuffix', 'transforms')
+
+	def __init__(self, number, definition):
+		self.number = number
+		self.action = definition.get('action', 'accept')
+		route = definition.get('route')
+		if route is None:
+			self.route = None
+		else:
+			self.route = tuple(x for x in ([route] if isinstance(route, str) else route) if x != 'none')
+		self.prefix = definition.get('prefix', '')
+		self.group = None # absolute group number in the combined pattern, set by the matcher
+		self.slice = None
+		self.addPrefix = str(definition.get('addprefix', ''))
+		self.addSuffix = str(definition.get('addsuffix', ''))
+		extract = definition.get('extract')
+		if isinstance(extract, str) and ':' in extract:
+			try:
+				self.slice = slice(*[int(x) if x.strip() else None for x in extract.split(':', 1)])
+			except ValueError:
+				raise ValueError('rule %s: invalid extract: %s' % (number, extract))
+		self.transforms = self.slice is not None or bool(self.addPrefix) or bool(self.addSuffix)
+
+	# returns the barcode passed on; data is the barcode without its symbology identifier (or the extracted group)
+	def apply(self, data):
+		if self.slice is not None:
+			data = data[self.slice]
+		if self.addPrefix or self.addSuffix:
+			return self.addPrefix + data + self.addSuffix
+		return data
+
+# checks one rule definition
+# returns the rule's pattern (without symbology identifier), or None for a prefix or catch-all rule
+def _checkDefinition(number, definition, outputs=()):
+	if not isinstance(definition, dict):
+		raise ValueError('rule %s: must be an object' % number)
+	unknown = set(definition) - RULE_FIELDS
+	if unknown:
+		raise ValueError('rule %s: unknown field(s): %s' % (number, ', '.join(sorted(unknown))))
+	if definition.get('action', 'accept') not in RULE_ACTIONS:
+		raise ValueError('rule %s: unknown action: %s' % (number, definition.get('action')))
+	route = definition.get('route', 'serial')
+	for name in ([route] if isinstance(route, str) else route if isinstance(route, list) else [None]):
+		if name not in RULE_ROUTES and name not in outputs:
+			raise ValueError('rule %s: unknown route: %s' % (number, name))
+	for name in definition.get('symbology') or ():
+		if name not in SYMBOLOGIES:
+			raise ValueError('rule %s: unknown symbology: %s' % (number, name))
+	if 'match' in definition and 'prefix' in definition:
+		raise ValueError('rule %s: use either match or prefix' % number)
+	if not isinstance(definition.get('prefix', ''), str):
+		raise ValueError('rule %s: prefix must be a string' % number)
+	extract = definition.get('extract')
+	if extract is not None and not (isinstance(extract, int) or isinstance(extract, str)):
+		raise ValueError('rule %s: extract must be a group number, group name or "start:end"' % number)
+	if 'match' not in definition:
+		if extract is not None and not (isinstance(extract, str) and ':' in extract):
+			raise ValueError('rule %s: extracting a group needs a match pattern' % number)
+		return None
+	pattern = definition['match']
+	if not isinstance(pattern, str):
+		raise ValueError('rule %s: match must be a string' % number)
+	if UNSUPPORTED_PATTERN.search(pattern):
+		raise ValueError('rule %s: numbered backreferences and conditional groups are not supported' % number)
+	try:
+		compiled = re.compile(pattern, re.DOTALL)
+	except re.error as e:
+		raise ValueError('rule %s: invalid match pattern: %s' % (number, e))
+	if isinstance(extract, int) and not 0 <= extract <= compiled.groups:
+		raise ValueError('rule %s: match has no group %s' % (number, extract))
+	if isinstance(extract, str) and ':' not in extract and extract not in compiled.groupindex:
+		raise ValueError('rule %s: match has no group named %s' % (number, extract))
+	return compiled
+
+# every rule is one alternative of a single pattern, matched against the whole barcode in one pass
+# the first alternative which matches is the first rule in the profile's order; its outer group tells which rule it is
+class _RegexMatcher(object):
+	def __init__(self, rules, definitions, patterns):
+		parts = []
+		groupRules = {} # number of a rule's outer group -> rule
+		groupCount = 0
+		for rule, definition, compiled in zip(rules, definitions, patterns):
+			names = definition.get('symbology')
+			aim = (r'\][%s][0-9A-Za-z]' % ''.join(sorted(set(SYMBOLOGIES[x] for x in names)))) if names else '(?:%s)?' % AIM_ID
+			if compiled is not None:
+				# group names are made unique per rule
+				body = NAMED_GROUP.sub(lambda m, n=rule.number: '(?P%sr%d_%s' % (m.group(1), n, m.group(2)), compiled.pattern)
+			else:
+				body = re.escape(rule.prefix) + '.*'
+			outer = groupCount + 1
+			data = outer + 1
+			groupCount = data + (compiled.groups if compiled is not None else 0)
+			extract = definition.get('extract')
+			if isinstance(extract, int):
+				rule.group = data + extract if extract else data
+			elif isinstance(extract, str) and ':' not in extract:
+				rule.group = data + compiled.groupindex[extract]
+			else:
+				rule.group = data
+			groupRules[outer] = rule
+			parts.append('(%s(%s))' % (aim, body))
+		self.pattern = re.compile('|'.join(parts), re.DOTALL) if parts else None
+		self.groupRules = groupRules
+
+	# returns tuple: (rule, barcode to pass on), or (None, barcode) if no rule matched
+	def match(self, barcode):
+		if self.pattern is None:
+			return (None, barcode)
+		m = self.pattern.fullmatch(barcode)
+		if m is None:
+			return (None, barcode)
+		rule = self.groupRules[m.lastindex]
+		data = m.group(rule.group)
+		if data is None:
+			data = ''
+		if rule.transforms:
+			return (rule, rule.apply(data))
+		return (rule, data)
+
+# prefix rules (and catch-all rules) only: one walk down a character trie finds the first matching rule
+# every node stores the lowest rule number of the prefixes ending at it or above it, so the deepest node reached decides
+class _TrieMatcher(object):
+	def __init__(self, rules):
+		self.root = [{}, None] # [children by character, best rule]
+		for rule in rules:
+			node = self.root
+			for ch in rule.prefix:
+				node = node[0].setdefault(ch, [{}, None])
+			if node[1] is None:
+				node[1] = rule
+		self._propagate(self.root, None)
+
+	def _propagate(self, node, best):
+		if best is not None and (node[1] is None or best.number < node[1].number):
+			node[1] = best
+		for child in node[0].values():
+			self._propagate(child, node[1])
+
+	def match(self, barcode):
+		start = 3 if len(barcode) >= 3 and barcode[0] == ']' and barcode[1].isalpha() else 0 # skip a symbology identifier
+		node = self.root
+		rule = node[1]
+		for i in range(start, len(barcode)):
+			node = node[0].get(barcode[i])
+			if node is None:
+				break
+			rule = node[1]
+			if not node[0]:
+				break
+		if rule is None:
+			return (None, barcode)
+		data = barcode[start:] if start else barcode
+		if rule.transforms:
+			return (rule, rule.apply(data))
+		return (rule, data)
+
+# the rules of one profile, compiled once
+# rules are evaluated in order and the first one that matches decides; a barcode which matches no rule is accepted unchanged
+# rule fields (all optional):
+#	match		regular expression the whole barcode (without symbology identifier) must match
+#	prefix		text the barcode must start with (instead of match)
+#	symbology	list of symbologies (see SYMBOLOGIES) the barcode's AIM identifier must be one of
+#	scanner		position ('bs') or 'ip:port' of the scanner the rule is limited to
+#	action		'accept' (default) or 'reject'
+#	extract		group number or name of match, or 'start:end' to pass on part of the barcode
+#	addprefix	text put in front of the barcode passed on
+#	addsuffix	text appended to the barcode passed on
+#	route		'serial', 'none' or the name of an output, or a list of them (default: the inspection machine and every output)
+# when a profile has rules, a leading AIM symbology identifier is removed from the barcodes passed on
+# Usage:
+#	ruleSet = getRuleSet(dictProfile)
+#	rule, barcode = ruleSet.evaluate(']d2ABC123', '192.168.188.2:2001')
+#	if rule is not None and rule.action == 'reject': ...
+class RuleSet(object):
+	def __init__(self, definitions, scanners=None, outputs=()):
+		if not isinstance(definitions, list):
+			raise ValueError('rules must be a list')
+		scanners = scanners or {}
+		patterns = [_checkDefinition(number, definition, outputs) for number, definition in enumerate(definitions, 1)]
+		self.count = len(definitions)
+		# rules limited to a scanner are only compiled into that scanner's matcher
+		ruleScanners = []
+		for number, definition in enumerate(definitions, 1):
+			scanner = definition.get('scanner')
+			if scanner is not None:
+				scanner = scanners.get(scanner, str(scanner))
+				if ':' not in scanner:
+					raise ValueError('rule %s: unknown scanner: %s' % (number, definition['scanner']))
+			ruleScanners.append(scanner)
+		self.default = self._compile(definitions, patterns, [x is None for x in ruleScanners])
+		self.matchers = {scanner: self._compile(definitions, patterns, [x is None or x == scanner for x in ruleScanners]) for scanner in set(ruleScanners) if scanner is not None}
+
+	@staticmethod
+	def _compile(definitions, patterns, selected):
+		picked = [(number, definition, pattern) for number, (definition, pattern, isSelected) in enumerate(zip(definitions, patterns, selected), 1) if isSelected]
+		rules = [Rule(number, definition) for number, definition, pattern in picked]
+		if all(pattern is None and not definition.get('symbology') for number, definition, pattern in picked):
+			return _TrieMatcher(rules)
+		return _RegexMatcher(rules, [x[1] for x in picked], [x[2] for x in picked])
+
+	def isEmpty(self):
+		return self.count == 0
+
+	# returns tuple: (rule, barcode to pass on), or (None, barcode) if no rule matched
+	def evaluate(self, barcode, scanner):
+		return self.matchers.get(scanner, self.default).match(barcode)
+
+_ruleSets = {}
+
+# returns the compiled rules of a profile ("rules" list), compiled on first use and whenever they change
+# scanner positions in the rules are resolved to the profile's ip:port, routes are checked against the profile's outputs
+# raises ValueError for invalid rules
+def getRuleSet(dictProfile):
+	definitions = dictProfile.get('rules') or []
+	outputs = sorted(x.get('name') for x in dictProfile.get('outputs') or [] if isinstance(x, dict) and isinstance(x.get('name'), str))
+	scanners = {}
+	for position in dictProfile.get('positions', ()):
+		if dictProfile.get(position + 'ip') and dictProfile.get(position + 'port'):
+			scanners[position] = '%s:%s' % (str(dictProfile[position + 'ip']).strip(), str(dictProfile[position + 'port']).strip())
+	ruleSetKey = json.dumps([definitions, scanners, outputs], sort_keys=True)
+	ruleSet = _ruleSets.get(ruleSetKey)
+	if ruleSet is None:
+		if len(_ruleSets) >= 64:
+			_ruleSets.clear() # only the rules of recently used profiles are kept
+		ruleSet = _ruleSets[ruleSetKey] = RuleSet(definitions, scanners, outputs)
+	return ruleSet
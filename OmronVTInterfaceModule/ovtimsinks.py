@@ -0,0 +1,309 @@
+import http.client
+import json
+import os
+import select
+import socket
+import stat
+import time
+from urllib.parse import urlsplit
+
+import serial
+
+import OmronVTInterfaceModule.ovtimconfig as ovtimconfig
+import OmronVTInterfaceModule.ovtimfunctions as ovtimfunctions
+from OmronVTInterfaceModule.ovtimmetrics import metrics
+from OmronVTInterfaceModule.ovtimoutput import BACKPRESSURE_MODES, BarcodeDispatcher
+
+# output sinks a profile can declare in its "outputs" list, in addition to the inspection machine ('serial')
+# every sink has its own bounded queue and worker (a BarcodeDispatcher), so a slow or failed sink never holds up the others
+# fields of a sink definition:
+#	name			name rules route barcodes to (see ovtimrules); must not be 'serial' or 'none'
+#	type			'serial', 'tcp', 'file', 'fifo' or 'http'
+#	queue			barcodes waiting to be written (default ovtimconfig.sinkQueueSize)
+#	backpressure	'drop' (default) or 'block' when the queue is full, see ovtimoutput.BACKPRESSURE_MODES
+#	retries			attempts after a failed write, reconnecting each time, before the barcode is dropped (default ovtimconfig.sinkRetries)
+#	retrydelay		seconds before the first retry, doubled for every further retry (default ovtimconfig.sinkRetryDelay)
+#	terminator		text written after each barcode (default '\r\n'; not used by http)
+#	serial: port, baud (9600), bytesize (8), stopbits (1), parity ('N')
+#	tcp: host, port, timeout
+#	file, fifo: path (a file is appended to, a fifo needs a reader)
+#	http: url (barcodes are POSTed as json: {"barcode", "time"}), timeout
+SINK_TYPES = ('serial', 'tcp', 'file', 'fifo', 'http')
+SINK_FIELDS = {
+	'serial': frozenset(('port', 'baud', 'bytesize', 'stopbits', 'parity')),
+	'tcp': frozenset(('host', 'port', 'timeout')),
+	'file': frozenset(('path',)),
+	'fifo': frozenset(('path',)),
+	'http': frozenset(('url', 'timeout')),
+}
+COMMON_FIELDS = frozenset(('name', 'type', 'queue', 'backpressure', 'retries', 'retrydelay', 'terminator'))
+RESERVED_NAMES = ('serial', 'none')
+
+# serial port with its own settings
+class SerialSink(object):
+	def __init__(self, definition):
+		self.port = definition['port']
+		self.settings = {'baudrate': int(definition.get('baud', 9600)), 'bytesize': int(definition.get('bytesize', 8)), 'stopbits': float(definition.get('stopbits', 1)), 'parity': definition.get('parity', 'N')}
+		if self.settings['stopbits'] == int(self.settings['stopbits']):
+			self.settings['stopbits'] = int(self.settings['stopbits'])
+		self.tm = None
+
+	def isOpen(self):
+		return self.tm is not None
+
+	def open(self):
+		self.tm = ovtimfunctions.TimeManager(self.port, **self.settings)
+
+	def write(self, data):
+		self.tm.send(data)
+
+	def close(self):
+		if self.tm is not None:
+			try:
+				self.tm.ser.close()
+			except (OSError, serial.SerialException):
+				pass
+			self.tm = None
+
+# raw tcp connection, kept open between barcodes
+class TcpSink(object):
+	def __init__(self, definition):
+		self.address = (definition['host'], int(definition['port']))
+		self.timeout = float(definition.get('timeout', ovtimconfig.sinkTimeout))
+		self.sock = None
+
+	def isOpen(self):
+		return self.sock is not None
+
+	def open(self):
+		self.sock = socket.create_connection(self.address, self.timeout)
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	def write(self, data):
+		self.sock.sendall(data)
+
+	def close(self):
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+# file opened for appending; a fifo is opened without blocking, which fails while nobody is reading it,
+# and a write fails after sinkTimeout seconds if the reader does not make room
+class FileSink(object):
+	def __init__(self, definition):
+		self.path = definition['path']
+		self.isFifo = definition['type'] == 'fifo'
+		self.timeout = ovtimconfig.sinkTimeout
+		self.fd = None
+
+	def isOpen(self):
+		return self.fd is not None
+
+	def open(self):
+		if self.isFifo:
+			fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+			if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+				os.close(fd)
+				raise OSError('not a fifo: ' + self.path)
+		else:
+			fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+		self.fd = fd
+
+	def write(self, data):
+		view = memoryview(data)
+		deadline = time.monotonic() + self.timeout
+		while len(view):
+			try:
+				view = view[os.write(self.fd, view):]
+			except BlockingIOError:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0 or not select.select([], [self.fd], [], remaining)[1]:
+					raise TimeoutError('the reader of %s is not reading' % self.path)
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+# local http webhook, the connection is kept alive between barcodes
+class HttpSink(object):
+	def __init__(self, definition):
+		url = urlsplit(definition['url'])
+		self.host = url.hostname
+		self.port = url.port or 80
+		self.path = (url.path or '/') + ('?' + url.query if url.query else '')
+		self.timeout = float(definition.get('timeout', ovtimconfig.sinkTimeout))
+		self.conn = None
+
+	def isOpen(self):
+		return self.conn is not None
+
+	def open(self):
+		self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+	def write(self, data):
+		self.conn.request('POST', self.path, data, {'Content-Type': 'application/json'})
+		response = self.conn.getresponse()
+		response.read()
+		if response.status >= 300:
+			raise OSError('HTTP status %s %s' % (response.status, response.reason))
+
+	def close(self):
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+
+SINK_CLASSES = {'serial': SerialSink, 'tcp': TcpSink, 'file': FileSink, 'fifo': FileSink, 'http': HttpSink}
+
+# checks the "outputs" list of a profile
+# returns list of sink names; raises ValueError for invalid definitions
+def checkSinks(definitions):
+	if not isinstance(definitions, list):
+		raise ValueError('outputs must be a list')
+	names = []
+	for number, definition in enumerate(definitions, 1):
+		if not isinstance(definition, dict):
+			raise ValueError('output %s: must be an object' % number)
+		name = definition.get('name')
+		if not isinstance(name, str) or not name:
+			raise ValueError('output %s: needs a name' % number)
+		if name in RESERVED_NAMES or name in names:
+			raise ValueError('output %s: name already used: %s' % (number, name))
+		sinkType = definition.get('type')
+		if sinkType not in SINK_TYPES:
+			raise ValueError('output %s: unknown type: %s' % (name, sinkType))
+		unknown = set(definition) - COMMON_FIELDS - SINK_FIELDS[sinkType]
+		if unknown:
+			raise ValueError('output %s: unknown field(s): %s' % (name, ', '.join(sorted(unknown))))
+		required = ('url',) if sinkType == 'http' else ('path',) if sinkType in ('file', 'fifo') else ('host', 'port') if sinkType == 'tcp' else ('port',)
+		for field in required:
+			if not definition.get(field):
+				raise ValueError('output %s: needs %s' % (name, field))
+		if definition.get('backpressure', 'drop') not in BACKPRESSURE_MODES:
+			raise ValueError('output %s: unknown backpressure: %s' % (name, definition.get('backpressure')))
+		try:
+			if not 1 <= int(definition.get('queue', 1)) <= 100000 or not 0 <= int(definition.get('retries', 0)) <= 100 or float(definition.get('retrydelay', 0)) < 0:
+				raise ValueError()
+			if sinkType == 'tcp' and not 1 <= int(definition['port']) <= 65535:
+				raise ValueError()
+			if sinkType == 'serial' and (str(definition.get('baud', 9600)) not in [str(x) for x in serial.Serial.BAUDRATES] or int(definition.get('bytesize', 8)) not in serial.Serial.BYTESIZES or float(definition.get('stopbits', 1)) not in serial.Serial.STOPBITS or definition.get('parity', 'N') not in serial.Serial.PARITIES):
+				raise ValueError()
+		except (TypeError, ValueError):
+			raise ValueError('output %s: invalid queue, retries, retrydelay or connection settings' % name)
+		if sinkType == 'http' and urlsplit(definition['url']).scheme != 'http':
+			raise ValueError('output %s: only http:// urls are supported' % name)
+		names.append(name)
+	return names
+
+# one sink with its queue and worker
+# a failed write is retried retries times with a doubling delay, reopening the sink each time; then the barcode is dropped
+# Usage:
+#	output = SinkOutput({'name': 'mes', 'type': 'tcp', 'host': '10.0.0.5', 'port': 9100}, app.logger)
+#	output.start(socketio.start_background_task)
+#	output.put('ABC123')
+class SinkOutput(object):
+	def __init__(self, definition, logger):
+		self.definition = definition
+		self.name = definition['name']
+		self.type = definition['type']
+		self.logger = logger
+		self.sink = SINK_CLASSES[self.type](definition)
+		self.terminator = str(definition.get('terminator', '\r\n')).encode('utf-8')
+		self.retries = int(definition.get('retries', ovtimconfig.sinkRetries))
+		self.retryDelay = float(definition.get('retrydelay', ovtimconfig.sinkRetryDelay))
+		self.labels = (self.name,)
+		self.dispatcher = BarcodeDispatcher(logger, maxQueued=int(definition.get('queue', ovtimconfig.sinkQueueSize)), backpressure=definition.get('backpressure', 'drop'), blockTimeout=ovtimconfig.sinkBlockTimeout, name='output ' + self.name, latencyMetric='karlbox_read_to_sink_seconds', metricLabels=self.labels)
+		self.lastError = None
+
+	def start(self, spawn):
+		return self.dispatcher.start(spawn, self._send, self.sink.close)
+
+	def stop(self):
+		self.dispatcher.stop()
+
+	def put(self, barcode):
+		self.dispatcher.put(barcode)
+
+	# returns dict: {'name', 'type', 'connected', 'lastError', 'running', 'queued', 'waiting', 'sent', 'dropped', 'failed', 'blocked'}
+	def getStats(self):
+		stats = self.dispatcher.getStats()
+		stats.update({'name': self.name, 'type': self.type, 'connected': self.sink.isOpen(), 'lastError': self.lastError})
+		return stats
+
+	def _encode(self, barcode):
+		if self.type == 'http':
+			return json.dumps({'barcode': barcode, 'time': round(time.time(), 3)}).encode('utf-8')
+		return barcode.encode('utf-8') + self.terminator
+
+	def _send(self, barcode, isResend):
+		data = self._encode(barcode)
+		attempt = 0
+		while True:
+			try:
+				if not self.sink.isOpen():
+					self.sink.open()
+				self.sink.write(data)
+				metrics.inc('karlbox_sink_written_bytes_total', self.labels, len(data))
+				self.lastError = None
+				return
+			except (OSError, http.client.HTTPException, serial.SerialException) as e:
+				self.lastError = str(e)
+				self.sink.close()
+				metrics.inc('karlbox_sink_errors_total', self.labels)
+				if attempt >= self.retries:
+					raise
+				time.sleep(self.retryDelay * 2 ** attempt)
+				attempt += 1
+
+# the sinks of the active profile
+# when the profile's outputs change, sinks whose definition is unchanged keep their queue and connection
+# Usage:
+#	router = SinkRouter(app.logger)
+#	router.start(socketio.start_background_task)
+#	router.configure(dictProfile.get('outputs') or [])
+#	router.put(('mes', 'log'), 'ABC123')
+class SinkRouter(object):
+	def __init__(self, logger):
+		self.logger = logger
+		self.outputs = {} # name -> SinkOutput
+		self.names = () # names of the sinks, in the profile's order
+		self.spawn = None
+
+	def start(self, spawn):
+		if self.spawn is not None:
+			return
+		self.spawn = spawn
+		for output in list(self.outputs.values()):
+			output.start(spawn)
+
+	# raises ValueError for invalid definitions
+	def configure(self, definitions):
+		names = checkSinks(definitions)
+		outputs = {}
+		for definition in definitions:
+			output = self.outputs.get(definition['name'])
+			if output is None or output.definition != definition:
+				output = SinkOutput(definition, self.logger)
+				if self.spawn is not None:
+					output.start(self.spawn)
+				self.logger.info('Barcode output %s (%s) configured', output.name, output.type)
+			outputs[output.name] = output
+		for name, output in self.outputs.items():
+			if outputs.get(name) is not output:
+				output.stop()
+		self.outputs = outputs
+		self.names = tuple(names)
+
+	def put(self, names, barcode):
+		outputs = self.outputs
+		for name in names:
+			output = outputs.get(name)
+			if output is not None:
+				output.put(barcode)
+
+	def getStats(self):
+		return [self.outputs[name].getStats() for name in self.names if name in self.outputs]
+
+	def stop(self):
+		for output in self.outputs.values():
+			output.stop()
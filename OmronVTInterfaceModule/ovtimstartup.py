@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+
+from OmronVTInterfaceModule.ovtimfunctions import getHistoryDepth, getScannerEndpoints
+
+# returns tuple: (seconds since the system booted, seconds since this process started), or (None, None) without /proc
+def getUptimes():
+	try:
+		with open('/proc/uptime') as f:
+			uptime = float(f.read().split()[0])
+		with open('/proc/self/stat') as f:
+			startTicks = int(f.read().rsplit(')', 1)[1].split()[19]) # field 22, starttime
+		return (uptime, max(0.0, uptime - startTicks / float(os.sysconf('SC_CLK_TCK'))))
+	except (OSError, ValueError, IndexError):
+		return (None, None)
+
+# times the start of a process: every phase is logged with the seconds since the process started
+# and since the system booted, so a cold boot to line-ready can be read from the log (and from /status/startup)
+# Usage:
+#	startup = StartupTimer(app.logger, 'webapp')
+#	startup.mark('logging')
+#	startup.getStats()
+class StartupTimer(object):
+	def __init__(self, logger, process):
+		self.logger = logger
+		self.process = process
+		uptime, processAge = getUptimes()
+		self.start = time.monotonic() - (processAge or 0)
+		self.bootOffset = None if uptime is None else uptime - processAge # seconds from the system boot to the process start
+		self.phases = [] # (phase, seconds since the process started)
+		self.lock = threading.Lock()
+
+	# records that a phase completed; returns seconds since the process started
+	def mark(self, phase):
+		elapsed = time.monotonic() - self.start
+		with self.lock:
+			self.phases.append((phase, elapsed))
+		if self.bootOffset is None:
+			self.logger.info('Startup (%s): %s after %.3f s', self.process, phase, elapsed)
+		else:
+			self.logger.info('Startup (%s): %s after %.3f s (%.1f s after system boot)', self.process, phase, elapsed, self.bootOffset + elapsed)
+		return elapsed
+
+	# returns dict: {'process', 'bootOffset', 'phases': [{'phase', 'seconds'}, ...]} (seconds since the process started)
+	def getStats(self):
+		with self.lock:
+			phases = list(self.phases)
+		return {'process': self.process, 'bootOffset': None if self.bootOffset is None else round(self.bootOffset, 3), 'phases': [{'phase': phase, 'seconds': round(seconds, 4)} for phase, seconds in phases]}
+
+# starts scanner ingest and the output to the inspection machine for the active profile's scanners as soon as the process starts,
+# instead of waiting for the kiosk's browser to ask for them; the pages only subscribe to the notifications
+# the scanners are pinned in holder (ScannerHub, or IngestDaemon in the ingest daemon), which keeps their connections open
+# without subscribers until the active profile no longer uses them
+# the phases 'scanner <ip:port> connected', 'output ready' and 'line ready' are recorded by the StartupTimer
+# Usage:
+#	autoStart = AutoStarter(scannerPipeline, scannerHub, app.logger, startup)
+#	autoStart.apply(dictActiveProfile, socketio.start_background_task)		(again whenever the config is saved)
+class AutoStarter(object):
+	def __init__(self, pipeline, holder, logger, startup, readyTimeout=600, pollInterval=0.05):
+		self.pipeline = pipeline
+		self.holder = holder
+		self.logger = logger
+		self.startup = startup
+		self.readyTimeout = readyTimeout
+		self.pollInterval = pollInterval
+		self.pinned = {} # (ip, port) -> (framing, serial settings)
+		self.started = False
+		self.lock = threading.Lock()
+
+	# uses the given (validated) profile and pins its scanners; the first call starts the pipeline and the serial output
+	def apply(self, dictProfile, spawn):
+		scanners = getScannerEndpoints(dictProfile)
+		self.pipeline.setProfile(dictProfile)
+		depth = getHistoryDepth(dictProfile)
+		with self.lock:
+			for key in scanners:
+				self.pipeline.setHistoryDepth('%s:%s' % key, depth)
+			for key in set(self.pinned) - set(scanners):
+				self.holder.unpin(key[0], key[1])
+			for key, settings in scanners.items():
+				if self.pinned.get(key) != settings:
+					self.holder.pin(key[0], key[1], *settings)
+			self.pinned = scanners
+			if self.started:
+				return
+			self.started = True
+		self.logger.info('Starting scanner ingest and barcode output for %s scanner(s) of the active profile', len(scanners))
+		self.pipeline.start(spawn)
+		spawn(self.pipeline.startOutput, spawn)
+		spawn(self.waitReady, list(scanners))
+
+	# records when each scanner is connected and the serial output runs; the line is ready once all of them are
+	def waitReady(self, scanners):
+		waiting = set(scanners)
+		outputReady = False
+		deadline = time.monotonic() + self.readyTimeout
+		while True:
+			states = self.pipeline.ingest.getStates()
+			for key in sorted(waiting):
+				if states.get(key) == 'connected':
+					waiting.discard(key)
+					self.startup.mark('scanner %s:%s connected' % key)
+			if not outputReady and self.pipeline.output.running:
+				outputReady = True
+				self.startup.mark('output ready')
+			if outputReady and not waiting:
+				self.startup.mark('line ready')
+				return
+			if time.monotonic() > deadline:
+				missing = ['%s:%s' % key for key in sorted(waiting)] + ([] if outputReady else ['serial output'])
+				self.logger.warning('Line not ready %s seconds after the start, waiting for: %s', self.readyTimeout, ', '.join(missing))
+				return
+			time.sleep(self.pollInterval)
@@ -0,0 +1,233 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS main (
+	key TEXT PRIMARY KEY,
+	value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS profiles (
+	name TEXT PRIMARY KEY,
+	sortorder INTEGER NOT NULL,
+	data TEXT NOT NULL,
+	updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scanners (
+	profile TEXT NOT NULL REFERENCES profiles(name) ON DELETE CASCADE,
+	position TEXT NOT NULL,
+	mac TEXT NOT NULL,
+	ip TEXT NOT NULL,
+	port TEXT NOT NULL,
+	PRIMARY KEY (profile, position)
+);
+CREATE INDEX IF NOT EXISTS scanners_mac ON scanners (mac);
+CREATE INDEX IF NOT EXISTS scanners_ip ON scanners (ip, port);
+CREATE TABLE IF NOT EXISTS history (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	name TEXT NOT NULL,
+	operation TEXT NOT NULL,
+	data TEXT,
+	changed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_name ON history (name, id);
+'''
+
+# profile store backed by an embedded SQLite database
+# profiles are stored one row each, with their scanners indexed by MAC and IP/port
+# every change is made in a transaction and the previous version of a profile is kept in the history table,
+# which keeps the newest historyDepth revisions of each profile (0 keeps every revision)
+# Usage:
+#	store = ProfileStore('/path/to/karlboxconfig.db', positions=['bs', 'ts'], historyDepth=50)
+#	store.importJson('/path/to/karlboxconfig.json')	does nothing unless the store is empty: once the store has profiles, edits of
+#													the json file are not picked up (remove the database to import it again)
+#	karlboxConfig = store.loadConfig()					same layout as karlboxconfig.json
+#	store.saveConfig(karlboxConfig)					only writes the profiles which changed
+class ProfileStore(object):
+	def __init__(self, dbFilePath, positions=('bs', 'ts'), historyDepth=50):
+		self.dbFilePath = dbFilePath
+		self.positions = tuple(positions)
+		self.historyDepth = int(historyDepth)
+		self.lock = threading.RLock()
+		self.localGeneration = 0 # incremented on every commit made through this connection
+		directory = os.path.dirname(dbFilePath)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		self.db = sqlite3.connect(dbFilePath, check_same_thread=False, isolation_level=None)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=FULL')
+		self.db.execute('PRAGMA foreign_keys=ON')
+		self.db.executescript(SCHEMA)
+
+	# returns a value which changes whenever the stored config changes (from this or any other process)
+	# used as the key of ovtimfunctions.ConfigCache; PRAGMA data_version does not read the database file
+	def cacheKey(self):
+		with self.lock:
+			return ('store', self.dbFilePath, self.db.execute('PRAGMA data_version').fetchone()[0], self.localGeneration)
+
+	def isEmpty(self):
+		with self.lock:
+			return self.db.execute('SELECT COUNT(*) FROM profiles').fetchone()[0] == 0
+
+	# one-time import of an existing json config file, only into an empty store
+	# returns True if the file was imported, False if the store already contained profiles (the file is not read then)
+	def importJson(self, jsonFilePath):
+		with self.lock:
+			if not self.isEmpty():
+				return False
+			with open(jsonFilePath, 'r') as cfile:
+				karlboxConfig = json.load(cfile)
+			self.saveConfig(karlboxConfig, operation='import')
+			return True
+
+	# returns the whole config as a dict laid out like karlboxconfig.json
+	def loadConfig(self):
+		with self.lock:
+			main = dict(self.db.execute('SELECT key, value FROM main').fetchall())
+			profiles = [json.loads(row[0]) for row in self.db.execute('SELECT data FROM profiles ORDER BY sortorder')]
+		karlboxConfig = {'main': {}, 'profiles': profiles}
+		if 'activeProfile' in main:
+			karlboxConfig['main']['activeProfile'] = main['activeProfile']
+		return karlboxConfig
+
+	# replace the stored config with karlboxConfig, writing only the rows which changed
+	# returns number of profiles which were inserted, updated or deleted
+	def saveConfig(self, karlboxConfig, operation='update'):
+		profiles = karlboxConfig.get('profiles', [])
+		names = [profile['profilename'] for profile in profiles]
+		if len(set(names)) != len(names):
+			raise ValueError('profile names must be unique')
+		now = time.time()
+		changed = 0
+		with self.lock, self._transaction():
+			existing = {row[0]: (row[1], row[2]) for row in self.db.execute('SELECT name, sortorder, data FROM profiles')}
+			for sortorder, profile in enumerate(profiles):
+				data = json.dumps(profile, sort_keys=True)
+				previous = existing.pop(profile['profilename'], None)
+				if previous is None:
+					self._insertProfile(profile, sortorder, data, now, operation if operation == 'import' else 'insert')
+					changed += 1
+				elif previous[1] != data:
+					self._updateProfile(profile, sortorder, data, previous[1], now)
+					changed += 1
+				elif previous[0] != sortorder:
+					self.db.execute('UPDATE profiles SET sortorder = ? WHERE name = ?', (sortorder, profile['profilename']))
+			for name, (sortorder, data) in existing.items():
+				self._deleteProfile(name, data, now)
+				changed += 1
+			activeProfile = karlboxConfig.get('main', {}).get('activeProfile')
+			if activeProfile is None:
+				self.db.execute("DELETE FROM main WHERE key = 'activeProfile'")
+			else:
+				self.db.execute("INSERT OR REPLACE INTO main (key, value) VALUES ('activeProfile', ?)", (str(activeProfile),))
+		return changed
+
+	# insert or update a single profile
+	def saveProfile(self, profile):
+		data = json.dumps(profile, sort_keys=True)
+		now = time.time()
+		with self.lock, self._transaction():
+			row = self.db.execute('SELECT data FROM profiles WHERE name = ?', (profile['profilename'],)).fetchone()
+			if row is None:
+				sortorder = self.db.execute('SELECT COALESCE(MAX(sortorder) + 1, 0) FROM profiles').fetchone()[0]
+				self._insertProfile(profile, sortorder, data, now, 'insert')
+			elif row[0] != data:
+				self._updateProfile(profile, None, data, row[0], now)
+
+	def deleteProfile(self, name):
+		with self.lock, self._transaction():
+			row = self.db.execute('SELECT data FROM profiles WHERE name = ?', (name,)).fetchone()
+			if row is not None:
+				self._deleteProfile(name, row[0], time.time())
+
+	def setActiveProfile(self, name):
+		with self.lock, self._transaction():
+			self.db.execute("INSERT OR REPLACE INTO main (key, value) VALUES ('activeProfile', ?)", (str(name),))
+
+	# returns tuple: (name of active profile, profile dict), or (name, None) if the active profile does not exist
+	def getActiveProfile(self):
+		with self.lock:
+			row = self.db.execute("SELECT main.value, profiles.data FROM main LEFT JOIN profiles ON profiles.name = main.value WHERE main.key = 'activeProfile'").fetchone()
+		if row is None:
+			return ('', None)
+		return (row[0], json.loads(row[1]) if row[1] is not None else None)
+
+	def getProfile(self, name):
+		with self.lock:
+			row = self.db.execute('SELECT data FROM profiles WHERE name = ?', (name,)).fetchone()
+		return json.loads(row[0]) if row is not None else None
+
+	# returns list of tuples: (profile name, position) for every scanner matching the given MAC or IP (and port)
+	def findScanner(self, mac=None, ip=None, port=None):
+		if mac is not None:
+			query, args = 'SELECT profile, position FROM scanners WHERE mac = ?', (str(mac).upper(),)
+		elif port is not None:
+			query, args = 'SELECT profile, position FROM scanners WHERE ip = ? AND port = ?', (str(ip), str(port))
+		else:
+			query, args = 'SELECT profile, position FROM scanners WHERE ip = ?', (str(ip),)
+		with self.lock:
+			return self.db.execute(query, args).fetchall()
+
+	# returns list of dicts: {'id', 'name', 'operation', 'data', 'changed'} newest first
+	# data is the profile as it was before the change (None for inserts)
+	def getHistory(self, name=None, limit=50):
+		with self.lock:
+			if name is None:
+				rows = self.db.execute('SELECT id, name, operation, data, changed FROM history ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+			else:
+				rows = self.db.execute('SELECT id, name, operation, data, changed FROM history WHERE name = ? ORDER BY id DESC LIMIT ?', (name, limit)).fetchall()
+		return [{'id': row[0], 'name': row[1], 'operation': row[2], 'data': json.loads(row[3]) if row[3] is not None else None, 'changed': row[4]} for row in rows]
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+	def _insertProfile(self, profile, sortorder, data, now, operation):
+		self.db.execute('INSERT INTO profiles (name, sortorder, data, updated) VALUES (?, ?, ?, ?)', (profile['profilename'], sortorder, data, now))
+		self._indexScanners(profile)
+		self._addHistory(profile['profilename'], operation, None, now)
+
+	def _updateProfile(self, profile, sortorder, data, previousData, now):
+		if sortorder is None:
+			self.db.execute('UPDATE profiles SET data = ?, updated = ? WHERE name = ?', (data, now, profile['profilename']))
+		else:
+			self.db.execute('UPDATE profiles SET sortorder = ?, data = ?, updated = ? WHERE name = ?', (sortorder, data, now, profile['profilename']))
+		self.db.execute('DELETE FROM scanners WHERE profile = ?', (profile['profilename'],))
+		self._indexScanners(profile)
+		self._addHistory(profile['profilename'], 'update', previousData, now)
+
+	def _deleteProfile(self, name, previousData, now):
+		self.db.execute('DELETE FROM profiles WHERE name = ?', (name,))
+		self._addHistory(name, 'delete', previousData, now)
+
+	# record a revision of a profile and remove its revisions beyond historyDepth, in the transaction of the change
+	def _addHistory(self, name, operation, previousData, now):
+		self.db.execute('INSERT INTO history (name, operation, data, changed) VALUES (?, ?, ?, ?)', (name, operation, previousData, now))
+		if self.historyDepth > 0:
+			self.db.execute('DELETE FROM history WHERE name = ? AND id NOT IN (SELECT id FROM history WHERE name = ? ORDER BY id DESC LIMIT ?)', (name, name, self.historyDepth))
+
+	def _indexScanners(self, profile):
+		positions = profile.get('positions', self.positions)
+		rows = [(profile['profilename'], position, str(profile.get(position + 'mac', '')).upper(), str(profile.get(position + 'ip', '')), str(profile.get(position + 'port', ''))) for position in positions if profile.get(position + 'mac') or profile.get(position + 'ip') or profile.get(position + 'port')]
+		self.db.executemany('INSERT OR REPLACE INTO scanners (profile, position, mac, ip, port) VALUES (?, ?, ?, ?, ?)', rows)
+
+	# context manager wrapping BEGIN IMMEDIATE ... COMMIT/ROLLBACK
+	def _transaction(self):
+		return _Transaction(self)
+
+class _Transaction(object):
+	def __init__(self, store):
+		self.store = store
+
+	def __enter__(self):
+		self.store.db.execute('BEGIN IMMEDIATE')
+
+	def __exit__(self, excType, excValue, traceback):
+		if excType is None:
+			self.store.db.execute('COMMIT')
+			self.store.localGeneration += 1
+		else:
+			self.store.db.execute('ROLLBACK')
+		return False
@@ -0,0 +1,163 @@
+import ipaddress
+import re
+
+import serial
+
+from OmronVTInterfaceModule.ovtimdedup import DEDUP_KEYS
+from OmronVTInterfaceModule.ovtimframing import parseFraming
+from OmronVTInterfaceModule.ovtimrules import getRuleSet
+from OmronVTInterfaceModule.ovtimsinks import checkSinks
+
+# values stored for every scanner position; the key in a profile is the position prefix + field (e.g. 'bs' + 'ip')
+SCANNER_FIELDS = ('model', 'name', 'mac', 'commtype', 'ip', 'port', 'baud', 'bytesize', 'stopbit', 'parity', 'framing')
+
+# lookup tables are normalized to strings so that 9600 and '9600' validate the same way
+# (stop bits are compared as numbers, so that 1, '1' and '1.0' are all valid)
+BAUDRATES = frozenset(str(x) for x in serial.Serial.BAUDRATES)
+BYTESIZES = frozenset(str(x) for x in serial.Serial.BYTESIZES)
+STOPBITS = frozenset(float(x) for x in serial.Serial.STOPBITS)
+PARITIES = frozenset(str(x) for x in serial.Serial.PARITIES)
+
+SIMPLE_FRAMINGS = frozenset(('', 'crlf', 'stxetx'))
+
+MAX_HISTORY_DEPTH = 100000
+MAX_DEDUP_WINDOW = 86400
+
+IPV4 = re.compile(r'^(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}$')
+
+# returns list of profile keys for the given scanner positions
+def getProfileKeys(positions):
+	return [position + field for position in positions for field in SCANNER_FIELDS]
+
+def isValidIp(value):
+	if IPV4.match(value):
+		return True
+	if ':' not in value:
+		return False
+	try:
+		ipaddress.ip_address(value) # IPv6
+		return True
+	except ValueError:
+		return False
+
+def isValidTcpPort(value):
+	return value.isdigit() and 1 <= int(value) <= 65535
+
+def isValidSerialPort(value):
+	value = value.lower()
+	return value.startswith('com') or 'tty' in value
+
+def isValidStopbits(value):
+	try:
+		return float(value) in STOPBITS
+	except ValueError:
+		return False
+
+def isValidHistoryDepth(value):
+	return value == '' or (value.isdigit() and 1 <= int(value) <= MAX_HISTORY_DEPTH)
+
+def isValidDedupWindow(value):
+	if value == '':
+		return True
+	try:
+		return 0 <= float(value) <= MAX_DEDUP_WINDOW
+	except ValueError:
+		return False
+
+def isValidFraming(value):
+	if value in SIMPLE_FRAMINGS:
+		return True
+	try:
+		parseFraming(value)
+		return True
+	except ValueError:
+		return False
+
+# profile validator compiled once for a set of scanner positions and model names
+# each position is checked in a single pass against frozenset lookup tables
+# Usage:
+#	validator = getValidator(['bs', 'ts'], ovtimconfig.possibleModelValues)
+#	dictProfile, returnCode = validator.validate(app.logger, profile)
+class ProfileValidator(object):
+	def __init__(self, positions, possibleModelValues, extraKeys=()):
+		self.positions = tuple(positions)
+		self.models = frozenset(str(x).lower() for x in possibleModelValues)
+		positionKeys = getProfileKeys(self.positions)
+		self.keys = tuple(positionKeys) + tuple(x for x in extraKeys if x not in positionKeys)
+		# one tuple of precomputed keys per position: (prefix, enabled, model, commtype, ip, port, baud, bytesize, stopbit, parity, framing)
+		self.table = tuple((position, position + 'enabled', position + 'model', position + 'commtype', position + 'ip', position + 'port', position + 'baud', position + 'bytesize', position + 'stopbit', position + 'parity', position + 'framing') for position in self.positions)
+		# checks for rs232 positions: (key index in the table entry, check function)
+		self.serialChecks = ((5, isValidSerialPort), (6, BAUDRATES.__contains__), (7, BYTESIZES.__contains__), (8, isValidStopbits), (9, PARITIES.__contains__))
+
+	# copy the known values of one profile and validate them
+	# returns tuple: (dict containing the profile values, returncode) using the readConfig returncode values
+	def validate(self, weblogger, profile):
+		returnCode = 0
+		dictProfile = {key: profile.get(key, '') for key in self.keys}
+		dictProfile['positions'] = list(self.positions)
+		for entry in self.table:
+			enabledKey, modelKey, commtypeKey, ipKey, portKey = entry[1:6]
+			enabled = 1
+			if str(dictProfile[commtypeKey]).lower() != 'rs232': # if commtype is not rs 232, it should be ethernet or "unknown" (default to ethernet)
+				dictProfile[commtypeKey] = 'ethernet'
+				if not isValidIp(str(dictProfile[ipKey]).strip()):
+					weblogger.warning('Config file: invalid %s for ethernet commType: %s', ipKey, dictProfile[ipKey])
+					enabled = 0
+				if not isValidTcpPort(str(dictProfile[portKey]).strip()):
+					weblogger.warning('Config file: invalid %s for ethernet commType: %s', portKey, dictProfile[portKey])
+					enabled = 0
+			else:
+				for index, check in self.serialChecks:
+					key = entry[index]
+					if not check(str(dictProfile[key]).strip()):
+						weblogger.warning('Config file: invalid %s for serial commType: %s', key, dictProfile[key])
+						enabled = 0
+			# check for valid model number
+			if str(dictProfile[modelKey]).lower() not in self.models:
+				dictProfile[modelKey] = 'Other Scanner'
+			# check for valid output framing (defaults to crlf)
+			framingKey = entry[10]
+			if not isValidFraming(dictProfile[framingKey]):
+				weblogger.warning('Config file: invalid %s: %s', framingKey, dictProfile[framingKey])
+				dictProfile[framingKey] = 'crlf'
+			dictProfile[enabledKey] = enabled
+			if not enabled:
+				returnCode = 2
+		# check for valid barcode history depth (empty uses the default)
+		if 'historydepth' in dictProfile and not isValidHistoryDepth(str(dictProfile['historydepth']).strip()):
+			weblogger.warning('Config file: invalid historydepth: %s', dictProfile['historydepth'])
+			dictProfile['historydepth'] = ''
+		# check for valid deduplication settings (empty uses the defaults)
+		if 'dedupwindow' in dictProfile and not isValidDedupWindow(str(dictProfile['dedupwindow']).strip()):
+			weblogger.warning('Config file: invalid dedupwindow: %s', dictProfile['dedupwindow'])
+			dictProfile['dedupwindow'] = ''
+		if 'dedupkey' in dictProfile and dictProfile['dedupkey'] not in DEDUP_KEYS and dictProfile['dedupkey'] != '':
+			weblogger.warning('Config file: invalid dedupkey: %s', dictProfile['dedupkey'])
+			dictProfile['dedupkey'] = ''
+		# check the additional outputs (a profile with invalid outputs only sends barcodes to the inspection machine)
+		if 'outputs' in dictProfile and dictProfile['outputs'] != '':
+			try:
+				checkSinks(dictProfile['outputs'])
+			except ValueError as e:
+				weblogger.warning('Config file: invalid outputs: %s', e)
+				dictProfile['outputs'] = []
+				returnCode = max(returnCode, 1)
+		# check that the barcode rules compile (a profile with invalid rules passes every barcode on unchanged)
+		if 'rules' in dictProfile:
+			try:
+				getRuleSet(dictProfile)
+			except ValueError as e:
+				weblogger.warning('Config file: invalid rules: %s', e)
+				dictProfile['rules'] = []
+				returnCode = max(returnCode, 1)
+		return ((dictProfile, returnCode))
+
+_validators = {}
+
+# returns the compiled validator for the given positions and model names (compiled on first use)
+def getValidator(positions, possibleModelValues, extraKeys=()):
+	validatorKey = (tuple(positions), tuple(possibleModelValues), tuple(extraKeys))
+	validator = _validators.get(validatorKey)
+	if validator is None:
+		validator = _validators[validatorKey] = ProfileValidator(positions, possibleModelValues, extraKeys)
+	return validator
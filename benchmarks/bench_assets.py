@@ -0,0 +1,128 @@
+# Benchmark of the kiosk's page loads with the static assets as they are (KARLBOX_ASSETS=source) and as built by ovtimassetbuild
+# starts the real app in a subprocess for each mode and loads the pages like the kiosk's browser does: the page, its stylesheets
+# and scripts and the webfonts of the stylesheets, over one keep-alive connection with Accept-Encoding: gzip, deflate
+# (chromium only asks for brotli over https)
+# the cold load starts with an empty cache; the warm load skips what the cold load was told to cache (max-age) and revalidates the rest
+# reports requests, bytes transferred and load time of both loads
+# Usage: python benchmarks/bench_assets.py [--pages / /managescanners /help] [--rounds 5] [--limit 0]
+#	the assets are built first unless static/dist was built already
+#	--limit exits with status 1 if the cold load of the built assets transfers more than this many kB
+import argparse
+import gzip
+import http.client
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_e2e import freePort, startApp, stopApp
+
+PAGE_ASSET = re.compile(r'''(?:href|src)\s*=\s*["'](/static/[^"']+\.(?:css|js))["']''')
+WEBFONT_URL = re.compile(r'''url\(\s*["']?(/static/[^"')?#]+\.woff2)''') # the format chromium picks from a font's src list
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+# returns tuple: (status, headers, body as transferred)
+def request(connection, path, headers):
+	connection.request('GET', path, headers=dict(headers, **{'Accept-Encoding': 'gzip, deflate'}))
+	response = connection.getresponse()
+	return response.status, response.headers, response.read()
+
+# loads the pages and everything they refer to; cache maps path -> (validators, cacheable) and is filled by a cold load
+# returns dict: {'requests': n, 'bytes': n, 'seconds': s}
+def loadPages(port, pages, cache):
+	result = {'requests': 0, 'bytes': 0}
+	connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+	start = time.perf_counter()
+	seen = set()
+
+	def load(path):
+		if path in seen:
+			return None
+		seen.add(path)
+		validators, cacheable = cache.get(path, ({}, False))
+		if cacheable:
+			return None
+		status, headers, body = request(connection, path, validators)
+		result['requests'] += 1
+		result['bytes'] += len(body)
+		if status == 304:
+			return None
+		if status != 200:
+			raise RuntimeError('%s answered %d' % (path, status))
+		validators = {}
+		if headers.get('ETag'):
+			validators['If-None-Match'] = headers['ETag']
+		if headers.get('Last-Modified'):
+			validators['If-Modified-Since'] = headers['Last-Modified']
+		maxAge = MAX_AGE.search(headers.get('Cache-Control', ''))
+		cache[path] = (validators, maxAge is not None and int(maxAge.group(1)) > 0 and 'no-cache' not in headers.get('Cache-Control', ''))
+		if headers.get('Content-Encoding') == 'gzip':
+			body = gzip.decompress(body)
+		return body.decode('utf-8', errors='replace')
+
+	for page in pages:
+		text = load(page) or ''
+		for asset in PAGE_ASSET.findall(text):
+			css = load(asset)
+			if css is not None and asset.endswith('.css'):
+				for font in sorted(set(WEBFONT_URL.findall(css))):
+					load(font)
+	result['seconds'] = time.perf_counter() - start
+	connection.close()
+	return result
+
+def measure(mode, pages, rounds):
+	logDirectory = tempfile.mkdtemp(prefix='karlbox-bench-')
+	env = dict(os.environ, KARLBOX_ASSETS=mode, KARLBOX_LOG_DIRECTORY=logDirectory, KARLBOX_OUTPUT_PORT=os.path.join(logDirectory, 'tty'), KARLBOX_AUTOSTART='0', PYTHONPATH=ROOT)
+	port = freePort()
+	app = startApp(port, env)
+	try:
+		cold, warm = [], []
+		for i in range(rounds):
+			cache = {}
+			cold.append(loadPages(port, pages, cache))
+			warm.append(loadPages(port, pages, cache))
+	finally:
+		stopApp(app)
+		shutil.rmtree(logDirectory, ignore_errors=True)
+	return {'cold': summarize(cold), 'warm': summarize(warm)}
+
+# requests and bytes are the same in every round, the load time is the median
+def summarize(loads):
+	seconds = sorted(x['seconds'] for x in loads)
+	return {'requests': loads[0]['requests'], 'bytes': loads[0]['bytes'], 'seconds': seconds[len(seconds) // 2]}
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark page loads with source and built static assets')
+	parser.add_argument('--pages', nargs='+', default=['/', '/managescanners', '/help'])
+	parser.add_argument('--rounds', type=int, default=5)
+	parser.add_argument('--limit', type=float, default=0, help='exit with status 1 if the cold load of the built assets transfers more than this many kB')
+	args = parser.parse_args()
+
+	if not os.path.isfile(os.path.join(ROOT, 'OmronVTInterfaceModule', 'static', 'dist', 'manifest.json')):
+		subprocess.check_call([sys.executable, '-m', 'OmronVTInterfaceModule.ovtimassetbuild'], cwd=ROOT)
+
+	results = {}
+	for mode in ('source', 'built'):
+		results[mode] = measure(mode, args.pages, args.rounds)
+
+	print('pages: %s, median of %d rounds' % (' '.join(args.pages), args.rounds))
+	print('%-8s %-5s %9s %12s %10s' % ('assets', 'load', 'requests', 'kB', 'ms'))
+	for mode, result in results.items():
+		for load in ('cold', 'warm'):
+			x = result[load]
+			print('%-8s %-5s %9d %12.1f %10.1f' % (mode, load, x['requests'], x['bytes'] / 1024.0, x['seconds'] * 1000))
+
+	builtKB = results['built']['cold']['bytes'] / 1024.0
+	if args.limit and builtKB > args.limit:
+		print('FAIL: the cold load transferred %.1f kB, more than %.1f kB' % (builtKB, args.limit))
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
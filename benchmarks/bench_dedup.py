@@ -0,0 +1,68 @@
+# Benchmark the cross-scanner deduplication engine at high scan rates
+# reports microseconds per read (check + add) and the number of barcodes remembered, which must stay within --max-entries
+# Usage: python benchmarks/bench_dedup.py [--reads 1000000] [--rate 1000] [--window 5] [--repeat 0.3] [--max-entries 100000] [--limit 5]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from OmronVTInterfaceModule.ovtimdedup import DedupEngine
+
+SCANNERS = ('192.168.188.2:2001', '192.168.188.3:2001')
+
+# reads at rate per second (simulated clock); a share of repeat reads is a barcode read recently, by either scanner
+def generateReads(readCount, rate, repeat, window):
+	rng = random.Random(1)
+	recent = []
+	reads = []
+	for i in range(readCount):
+		now = i / rate
+		if recent and rng.random() < repeat:
+			barcode = recent[rng.randrange(max(0, len(recent) - int(rate * window)), len(recent))]
+		else:
+			barcode = 'SN%09d' % i
+			recent.append(barcode)
+		reads.append((barcode, rng.choice(SCANNERS), now))
+	return reads
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark barcode deduplication')
+	parser.add_argument('--reads', type=int, default=1000000)
+	parser.add_argument('--rate', type=float, default=1000, help='reads per second (simulated)')
+	parser.add_argument('--window', type=float, default=5)
+	parser.add_argument('--repeat', type=float, default=0.3, help='share of reads repeating a barcode read within the window')
+	parser.add_argument('--max-entries', type=int, default=100000)
+	parser.add_argument('--limit', type=float, default=0, help='exit with status 1 if a read takes longer than this many microseconds')
+	args = parser.parse_args()
+
+	reads = generateReads(args.reads, args.rate, args.repeat, args.window)
+	failed = False
+	for keyMode in ('barcode', 'barcode+scanner'):
+		dedup = DedupEngine(args.window, keyMode, args.max_entries)
+		check = dedup.check
+		add = dedup.add
+		duplicates = 0
+		peak = 0
+		start = time.perf_counter()
+		for seq, (barcode, scanner, now) in enumerate(reads, 1):
+			if check(barcode, scanner, now) is None:
+				add(barcode, scanner, seq, now)
+			else:
+				duplicates += 1
+			if not seq & 1023:
+				peak = max(peak, len(dedup), len(dedup.expiries))
+		elapsed = time.perf_counter() - start
+		perRead = elapsed / len(reads) * 1e6
+		print('%-16s %d reads in %.1f ms (%.2f us/read), %d duplicates, peak %d remembered (max %d), %d evicted' % (keyMode + ':', len(reads), elapsed * 1000, perRead, duplicates, peak, args.max_entries, dedup.evicted))
+		if peak > args.max_entries or (args.limit and perRead > args.limit):
+			failed = True
+
+	if failed:
+		print('FAIL: over the limit of %.2f us/read or %d remembered barcodes' % (args.limit, args.max_entries))
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,328 @@
+# End-to-end benchmark of the webapp with simulated scanners and inspection machine
+# starts the real app in a subprocess, fake MicroHAWK scanners (TCP) and a fake inspection machine (pty),
+# subscribes to every scanner through a Socket.IO client and starts the barcode output like the kiosk does
+# reports throughput, scan-to-serial and scan-to-browser latency, and CPU and memory used by the app process
+# results can be saved as a JSON baseline and compared against one (exits with 1 on a regression)
+# Usage: python benchmarks/bench_e2e.py [--scanners 2] [--rate 5] [--burst 1] [--disconnect-after 0] [--downtime 0] [--duration 20] [--ingest-daemon]
+#	[--save-baseline benchmarks/baselines/default.json] [--baseline benchmarks/baselines/default.json] [--tolerance 0.25]
+#	--rate is barcodes per second per scanner; reads closer together than ovtimconfig.scannerTimelimit are dropped by the app
+#	--ingest-daemon runs the scanner ingest and serial output in the ingest daemon (ingestMode 'daemon') instead of the app
+#	requires the Socket.IO client: pip install "python-socketio[client]"
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakedevices import FakeInspectionMachine, FakeScanner
+
+try:
+	import socketio
+except ImportError:
+	socketio = None
+
+# runs the app the way gunicorn's gevent worker does
+APP_CODE = '''
+from gevent import monkey; monkey.patch_all()
+import sys
+from OmronVTInterfaceModule import app
+app.extensions['socketio'].run(app, host='127.0.0.1', port=int(sys.argv[1]), log_output=False)
+'''
+
+# result fields compared against a baseline: name -> True if higher is better
+COMPARED = {
+	'throughput': True,
+	'serialLatencyP50': False,
+	'serialLatencyP99': False,
+	'browserLatencyP50': False,
+	'browserLatencyP99': False,
+	'cpuPercent': False,
+	'rssPeakMB': False,
+	'recoveryP50': False,
+}
+
+def percentile(values, pct):
+	if not values:
+		return None
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+def freePort():
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+def httpGet(url, timeout=2):
+	with urllib.request.urlopen(url, timeout=timeout) as response:
+		return response.read().decode()
+
+# returns CPU seconds (user + system) used by a process, or None if /proc is not available
+def cpuTime(pid):
+	try:
+		with open('/proc/%d/stat' % pid) as f:
+			fields = f.read().rsplit(')', 1)[1].split()
+		return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+	except (OSError, ValueError, IndexError):
+		return None
+
+# returns dict: {'VmRSS': MB, 'VmHWM': MB} of a process (empty if /proc is not available)
+def memory(pid):
+	result = {}
+	try:
+		with open('/proc/%d/status' % pid) as f:
+			for line in f:
+				if line.startswith(('VmRSS:', 'VmHWM:')):
+					name, value = line.split(':', 1)
+					result[name] = int(value.split()[0]) / 1024.0
+	except OSError:
+		pass
+	return result
+
+# returns dict: {metric line without value: value} for the counters of /metrics
+def readMetrics(baseUrl):
+	values = {}
+	try:
+		for line in httpGet(baseUrl + '/metrics').splitlines():
+			match = re.match(r'^(karlbox_\w+_total(?:\{[^}]*\})?) (\S+)$', line)
+			if match:
+				values[match.group(1)] = float(match.group(2))
+	except OSError:
+		pass
+	return values
+
+def sumMetric(values, name):
+	return sum(value for key, value in values.items() if key == name or key.startswith(name + '{'))
+
+def startDaemon(env):
+	process = subprocess.Popen([sys.executable, '-m', 'OmronVTInterfaceModule.ovtimdaemon'], cwd=ROOT, env=env)
+	deadline = time.monotonic() + 30
+	while time.monotonic() < deadline:
+		if process.poll() is not None:
+			raise RuntimeError('ingest daemon exited with code %s' % process.returncode)
+		if os.path.exists(env['KARLBOX_INGEST_SOCKET']):
+			return process
+		time.sleep(0.1)
+	process.kill()
+	raise RuntimeError('ingest daemon did not start within 30 seconds')
+
+def startApp(port, env):
+	process = subprocess.Popen([sys.executable, '-c', APP_CODE, str(port)], cwd=ROOT, env=env)
+	deadline = time.monotonic() + 30
+	while time.monotonic() < deadline:
+		if process.poll() is not None:
+			raise RuntimeError('app exited with code %s' % process.returncode)
+		try:
+			httpGet('http://127.0.0.1:%d/metrics' % port)
+			return process
+		except OSError:
+			time.sleep(0.2)
+	process.kill()
+	raise RuntimeError('app did not start within 30 seconds')
+
+def stopApp(process):
+	if process.poll() is not None:
+		return
+	process.send_signal(signal.SIGTERM)
+	try:
+		process.wait(5)
+	except subprocess.TimeoutExpired:
+		process.kill()
+		process.wait()
+
+def compare(result, baseline, tolerance):
+	regressions = []
+	print('\ncompared with baseline (%s, %s):' % (baseline.get('date', '?'), baseline.get('host', '?')))
+	for name, higherIsBetter in COMPARED.items():
+		new, old = result.get(name), baseline.get(name)
+		if new is None or not old:
+			continue
+		change = (new - old) / float(old)
+		worse = -change if higherIsBetter else change
+		flag = 'REGRESSION' if worse > tolerance else ''
+		if flag:
+			regressions.append(name)
+		print('  %-18s %10.3f -> %10.3f  (%+6.1f%%) %s' % (name, old, new, change * 100, flag))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description='End-to-end benchmark with simulated scanners and inspection machine')
+	parser.add_argument('--scanners', type=int, default=2)
+	parser.add_argument('--rate', type=float, default=5, help='barcodes per second per scanner')
+	parser.add_argument('--burst', type=int, default=1, help='barcodes sent back-to-back per burst')
+	parser.add_argument('--disconnect-after', type=int, default=0, help='scanners close the connection after this many barcodes (0 never)')
+	parser.add_argument('--downtime', type=float, default=0, help='scanners refuse connections for this many seconds after each disconnect (simulated reboot)')
+	parser.add_argument('--duration', type=float, default=20, help='measured seconds')
+	parser.add_argument('--warmup', type=float, default=2, help='seconds before measuring starts')
+	parser.add_argument('--ack', action='store_true', help='inspection machine acknowledges every barcode (for serialAckMode)')
+	parser.add_argument('--ingest-daemon', action='store_true', help='run scanner ingest and serial output in the ingest daemon')
+	parser.add_argument('--save-baseline', help='write the results to this JSON file')
+	parser.add_argument('--baseline', help='compare the results with this JSON file')
+	parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative change before a result counts as a regression')
+	args = parser.parse_args()
+
+	if socketio is None:
+		print('the Socket.IO client is not installed: pip install "python-socketio[client]"')
+		sys.exit(2)
+
+	logDirectory = tempfile.mkdtemp(prefix='karlbox-bench-')
+	machine = FakeInspectionMachine(ack=args.ack)
+	machine.start()
+	# every scanner gets its own loopback address, the app applies its time limit per scanner ip
+	scanners = [FakeScanner('127.0.0.%d' % (i + 2), 'S%d' % (i + 1), args.rate, args.burst, args.disconnect_after, args.downtime) for i in range(args.scanners)]
+	for scanner in scanners:
+		scanner.start()
+
+	port = freePort()
+	baseUrl = 'http://127.0.0.1:%d' % port
+	# the scanners are subscribed like the kiosk page does, not started with the active profile of the installation
+	env = dict(os.environ, KARLBOX_OUTPUT_PORT=machine.port, KARLBOX_LOG_DIRECTORY=logDirectory, KARLBOX_AUTOSTART='0', PYTHONPATH=ROOT)
+	daemon = None
+	if args.ingest_daemon:
+		env.update(KARLBOX_INGEST_MODE='daemon', KARLBOX_INGEST_SOCKET=os.path.join(logDirectory, 'ingest.sock'))
+		daemon = startDaemon(env)
+	app = startApp(port, env)
+	client = socketio.Client(reconnection=False)
+	browser = {} # barcode -> monotonic time its notification arrived
+	resubscribes = [0]
+	finished = threading.Event()
+
+	def subscribe(scanner):
+		client.emit('Event_readDataFromLan', (scanner.ip, scanner.port))
+
+	# the kiosk page subscribes again when the app gave up connecting to its scanner
+	def onNotifications(msg):
+		now = time.monotonic()
+		for event in msg['events']:
+			if event['event'] in ('barcode', 'duplicate'):
+				browser.setdefault(event['barcode'], now)
+			elif event['event'] == 'connectfailed' and msg['ip'] is not None and not finished.is_set():
+				resubscribes[0] += 1
+				scanner = next(x for x in scanners if (x.ip, x.port) == (msg['ip'], msg['port']))
+				threading.Timer(0.1, subscribe, (scanner,)).start()
+
+	client.on('Event_scannerNotifications', onNotifications)
+	try:
+		client.connect(baseUrl)
+		client.emit('Event_startBarcodeOutput')
+		for scanner in scanners:
+			subscribe(scanner)
+		deadline = time.monotonic() + 10
+		while any(scanner.connections == 0 for scanner in scanners):
+			if time.monotonic() > deadline:
+				raise RuntimeError('the app did not connect to every scanner')
+			time.sleep(0.05)
+
+		for scanner in scanners:
+			scanner.go.set()
+		time.sleep(args.warmup)
+		countersBefore = readMetrics(baseUrl)
+		cpuBefore = cpuTime(app.pid)
+		daemonCpuBefore = cpuTime(daemon.pid) if daemon else None
+		measureStart = time.monotonic()
+		time.sleep(args.duration)
+		measureEnd = time.monotonic()
+		cpuAfter = cpuTime(app.pid)
+		daemonCpuAfter = cpuTime(daemon.pid) if daemon else None
+		countersAfter = readMetrics(baseUrl)
+		finished.set()
+		for scanner in scanners:
+			scanner.stop()
+		# let the pipeline drain
+		time.sleep(2)
+		mem = memory(app.pid)
+	finally:
+		finished.set()
+		for scanner in scanners:
+			scanner.stop()
+		if client.connected:
+			client.disconnect()
+		stopApp(app)
+		if daemon:
+			stopApp(daemon)
+		machine.stop()
+		shutil.rmtree(logDirectory, ignore_errors=True)
+
+	sent = {}
+	for scanner in scanners:
+		sent.update((barcode, t) for barcode, t in scanner.sent.items() if measureStart <= t < measureEnd)
+	serialLatencies = [machine.received[barcode] - t for barcode, t in sent.items() if barcode in machine.received]
+	browserLatencies = [browser[barcode] - t for barcode, t in sent.items() if barcode in browser]
+	elapsed = measureEnd - measureStart
+	# time from a scanner closing the connection until the app is connected to it again (including the simulated downtime)
+	recoveries = [end - start for scanner in scanners for start, end in scanner.outages if end is not None and measureStart <= start < measureEnd]
+	counters = {name: sumMetric(countersAfter, name) - sumMetric(countersBefore, name) for name in ('karlbox_scanner_toosoon_total', 'karlbox_scanner_duplicates_total', 'karlbox_scanner_connection_events_total')}
+
+	def ms(value):
+		return None if value is None else round(value * 1000, 3)
+
+	result = {
+		'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+		'host': platform.node(),
+		'platform': platform.platform(),
+		'python': platform.python_version(),
+		'args': vars(args),
+		'sent': len(sent),
+		'serialReceived': len(serialLatencies),
+		'browserReceived': len(browserLatencies),
+		'throughput': round(len(serialLatencies) / elapsed, 2),
+		'serialLatencyP50': ms(percentile(serialLatencies, 50)),
+		'serialLatencyP99': ms(percentile(serialLatencies, 99)),
+		'serialLatencyMax': ms(max(serialLatencies) if serialLatencies else None),
+		'browserLatencyP50': ms(percentile(browserLatencies, 50)),
+		'browserLatencyP99': ms(percentile(browserLatencies, 99)),
+		'cpuPercent': None if cpuBefore is None or cpuAfter is None else round((cpuAfter - cpuBefore) / elapsed * 100, 1),
+		'daemonCpuPercent': None if daemonCpuBefore is None or daemonCpuAfter is None else round((daemonCpuAfter - daemonCpuBefore) / elapsed * 100, 1),
+		'rssMB': round(mem['VmRSS'], 1) if 'VmRSS' in mem else None,
+		'rssPeakMB': round(mem['VmHWM'], 1) if 'VmHWM' in mem else None,
+		'tooSoon': int(counters['karlbox_scanner_toosoon_total']),
+		'duplicates': int(counters['karlbox_scanner_duplicates_total']),
+		'connectionEvents': int(counters['karlbox_scanner_connection_events_total']),
+		'scannerDisconnects': sum(scanner.disconnects for scanner in scanners),
+		'recoveryP50': ms(percentile(recoveries, 50)),
+		'recoveryMax': ms(max(recoveries) if recoveries else None),
+		'resubscribes': resubscribes[0],
+	}
+
+	print('barcodes sent:          %d by %d scanner(s) in %.1f s' % (result['sent'], len(scanners), elapsed))
+	print('received on serial:     %d (%d dropped as too soon)' % (result['serialReceived'], result['tooSoon']))
+	print('received by browser:    %d' % result['browserReceived'])
+	print('throughput:             %.2f barcodes/s' % result['throughput'])
+	print('scan-to-serial latency: p50 %s ms, p99 %s ms, max %s ms' % (result['serialLatencyP50'], result['serialLatencyP99'], result['serialLatencyMax']))
+	print('scan-to-browser latency: p50 %s ms, p99 %s ms' % (result['browserLatencyP50'], result['browserLatencyP99']))
+	print('app cpu:                %s %%' % result['cpuPercent'])
+	if daemon:
+		print('ingest daemon cpu:      %s %%' % result['daemonCpuPercent'])
+	print('app memory:             %s MB (peak %s MB)' % (result['rssMB'], result['rssPeakMB']))
+	print('disconnects:            %d by the scanners, %d re-subscribes, %d connection events' % (result['scannerDisconnects'], result['resubscribes'], result['connectionEvents']))
+	print('recovery after disconnect: p50 %s ms, max %s ms (downtime %s s)' % (result['recoveryP50'], result['recoveryMax'], args.downtime))
+
+	if args.save_baseline:
+		directory = os.path.dirname(os.path.abspath(args.save_baseline))
+		os.makedirs(directory, exist_ok=True)
+		with open(args.save_baseline, 'w') as f:
+			json.dump(result, f, indent=2, sort_keys=True)
+		print('\nbaseline saved to %s' % args.save_baseline)
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		regressions = compare(result, baseline, args.tolerance)
+		if regressions:
+			print('\nregressions: %s' % ', '.join(regressions))
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
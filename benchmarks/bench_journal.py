@@ -0,0 +1,52 @@
+# Benchmark barcode journal appends and time range queries over a month of generated reads
+# Usage: python benchmarks/bench_journal.py [--days 30] [--rate 2] [--scanners 4] [--segment 65536]
+#	--rate is barcodes per minute per scanner
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from OmronVTInterfaceModule.ovtimjournal import BarcodeJournal, FLAG_DUPLICATE
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the barcode journal')
+	parser.add_argument('--days', type=int, default=30)
+	parser.add_argument('--rate', type=float, default=2)
+	parser.add_argument('--scanners', type=int, default=4)
+	parser.add_argument('--segment', type=int, default=65536)
+	parser.add_argument('--queries', type=int, default=200)
+	args = parser.parse_args()
+
+	directory = tempfile.mkdtemp(prefix='karlbox-journal-')
+	try:
+		journal = BarcodeJournal(directory, args.segment, retentionDays=0)
+		scanners = ['192.168.188.%d:2001' % (i + 2) for i in range(args.scanners)]
+		interval = int(60e9 / (args.rate * args.scanners))
+		startNs = time.time_ns() - args.days * 86400 * 10**9
+		count = int(args.days * 1440 * args.rate * args.scanners)
+		start = time.perf_counter()
+		for i in range(count):
+			journal.append('LOT%06d-%08d' % (i // 1000, i), scanners[i % len(scanners)], FLAG_DUPLICATE if i % 17 == 0 else 0, wallNs=startNs + i * interval, monoNs=i * interval)
+		elapsed = time.perf_counter() - start
+		print('append: %d records in %.2f s (%.1f us/record, %d segments)' % (count, elapsed, elapsed / count * 1e6, journal.active.number))
+
+		# five minute windows spread over the whole month, for one scanner
+		results = 0
+		timings = []
+		for q in range(args.queries):
+			queryStart = startNs + (count * interval) * q // args.queries
+			start = time.perf_counter()
+			results += sum(1 for entry in journal.query(queryStart, queryStart + 300 * 10**9, scanner=scanners[0].split(':')[0]))
+			timings.append(time.perf_counter() - start)
+		timings.sort()
+		print('query (5 minutes, one scanner): p50 %.2f ms, p99 %.2f ms, max %.2f ms, %.1f results/query' % (timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.99)] * 1000, timings[-1] * 1000, results / args.queries))
+		journal.close()
+	finally:
+		shutil.rmtree(directory)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,107 @@
+# Benchmark of what logging writes to the storage on a busy line, with the logging as it was (TimedRotatingFileHandler, webapp at
+# DEBUG, every record written as soon as it is queued) and as it is (CompressingRotatingFileHandler, INFO, records committed in
+# chunks every logCommitInterval seconds and synced, rotated segments gzipped)
+# generates the records of a line for --seconds in real time: --requests page requests and socket events per second (DEBUG)
+# and --barcodes barcodes per second (INFO, like the pipeline's 'Barcode read' lines), through a LogPipeline of its own
+# reports write calls (from /proc/self/io), fsyncs, bytes written per hour and the size of the
+# rotated segments on disk
+# Usage: python benchmarks/bench_logging.py [--seconds 20] [--requests 50] [--barcodes 5] [--limit 0]
+#	--limit exits with status 1 if the current logging makes more write calls per hour than this
+import argparse
+import logging
+import logging.handlers
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import OmronVTInterfaceModule.ovtimconfig as ovtimconfig
+from OmronVTInterfaceModule.ovtimlogging import CompressingRotatingFileHandler, LogCompressor, LogPipeline
+
+# returns dict: {'syscw': write calls} of this process, or {} without /proc
+def readIo():
+	try:
+		with open('/proc/self/io') as f:
+			return {name: int(value) for name, value in (line.split(':') for line in f) if name == 'syscw'}
+	except OSError:
+		return {}
+
+def measure(mode, args):
+	directory = tempfile.mkdtemp(prefix='karlbox-logging-')
+	compressor = LogCompressor(ovtimconfig.logCompressLevel)
+	if mode == 'before':
+		pipeline = LogPipeline(ovtimconfig.logQueueSize, ovtimconfig.logBatchSize, ovtimconfig.logFlushInterval)
+		level = 'DEBUG'
+	else:
+		pipeline = LogPipeline(ovtimconfig.logQueueSize, ovtimconfig.logBatchSize, ovtimconfig.logFlushInterval, ovtimconfig.logCommitInterval, logging.getLevelName(ovtimconfig.logCommitLevel))
+		level = ovtimconfig.logLevel
+	loggers = {}
+	handlers = []
+	for config in (ovtimconfig.logConfigWebapp, ovtimconfig.logConfigBarcode):
+		path = os.path.join(directory, config['basefilename'])
+		if mode == 'before':
+			handler = logging.handlers.TimedRotatingFileHandler(path, when='midnight', backupCount=config['logrotatecount'])
+		else:
+			handler = CompressingRotatingFileHandler(path, maxBytes=config['logmaxbytes'], backupCount=config['logrotatecount'], maxTotalBytes=config['logmaxtotalbytes'], compressor=compressor)
+		handler.setFormatter(logging.Formatter(config['logmsgformat'], datefmt=config['logdateformat']))
+		handlers.append(handler)
+		logger = logging.getLogger('bench-%s-%s' % (mode, config['logname']))
+		logger.propagate = False
+		logger.setLevel(level if config is ovtimconfig.logConfigWebapp else config['loglevel'])
+		logger.addHandler(pipeline.queueHandler(handler))
+		loggers[config['logname']] = logger
+
+	io = readIo()
+	start = time.monotonic()
+	events = 0
+	barcodes = 0
+	while time.monotonic() - start < args.seconds:
+		elapsed = time.monotonic() - start
+		while events < elapsed * args.requests:
+			loggers['webapp'].debug('192.168.188.%d requested http://karlbox.local:8080/displayweblink?scanner1ip=192.168.188.2&scanner1port=2001', 10 + events % 4)
+			loggers['webapp'].debug('Event_readDataFromLan event received, subscribing %s to 192.168.188.2:2001', events)
+			events += 1
+		while barcodes < elapsed * args.barcodes:
+			loggers['barcode'].info('Barcode read from 192.168.188.2:2001: LOT%06d-%08d', barcodes // 1000, barcodes)
+			loggers['webapp'].info('Barcode LOT%06d-%08d sent to the inspection machine', barcodes // 1000, barcodes)
+			barcodes += 1
+		time.sleep(0.005)
+	pipeline.stop()
+	after = readIo()
+	seconds = time.monotonic() - start
+	written = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+	# rotate every log and let the compressor finish, like at midnight
+	for handler in handlers:
+		handler.doRollover()
+		handler.close()
+	compressor.join()
+	onDisk = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+	shutil.rmtree(directory, ignore_errors=True)
+	perHour = 3600.0 / seconds
+	return {'writes': (after.get('syscw', 0) - io.get('syscw', 0)) * perHour, 'fsyncs': pipeline.fsyncs * perHour, 'bytes': written * perHour, 'rotated': onDisk * perHour, 'records': pipeline.written}
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the writes of the logging on a busy line')
+	parser.add_argument('--seconds', type=float, default=20)
+	parser.add_argument('--requests', type=float, default=50, help='page requests and socket events per second')
+	parser.add_argument('--barcodes', type=float, default=5, help='barcodes per second')
+	parser.add_argument('--limit', type=float, default=0, help='exit with status 1 if the current logging makes more write calls per hour than this')
+	args = parser.parse_args()
+
+	results = {mode: measure(mode, args) for mode in ('before', 'after')}
+
+	print('%.0f s, %.0f requests/s, %.0f barcodes/s; per hour:' % (args.seconds, args.requests, args.barcodes))
+	print('%-8s %10s %12s %10s %14s %16s' % ('logging', 'records', 'write calls', 'fsyncs', 'MB written', 'MB kept rotated'))
+	for mode, x in results.items():
+		print('%-8s %10d %12.0f %10.0f %14.2f %16.2f' % (mode, x['records'] * 3600.0 / args.seconds, x['writes'], x['fsyncs'], x['bytes'] / 1048576.0, x['rotated'] / 1048576.0))
+
+	if args.limit and results['after']['writes'] > args.limit:
+		print('FAIL: %.0f write calls per hour, more than %.0f' % (results['after']['writes'], args.limit))
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,73 @@
+# Benchmark barcode rule evaluation for generated rule sets of different shapes
+# reports microseconds per barcode for prefix-only rules (trie), regex rules, symbology rules and per-scanner rules
+# Usage: python benchmarks/bench_rules.py [--rules 50] [--barcodes 100000] [--limit 10]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from OmronVTInterfaceModule.ovtimrules import RuleSet
+
+SCANNERS = {'bs': '192.168.188.2:2001', 'ts': '192.168.188.3:2001'}
+
+# rule sets of ruleCount rules each, the last rule of every set accepts everything
+def generateRuleSets(ruleCount):
+	prefixRules = [{'prefix': 'P%03d-' % i, 'action': 'reject' if i % 5 == 0 else 'accept', 'addprefix': 'L1-'} for i in range(ruleCount - 1)] + [{}]
+	regexRules = []
+	for i in range(ruleCount - 1):
+		if i % 3 == 0:
+			regexRules.append({'match': r'P%03d-(?P<serial>\d{6})-[A-Z]{2}' % i, 'extract': 'serial'})
+		elif i % 3 == 1:
+			regexRules.append({'match': r'P%03d-\d+-AB' % i, 'action': 'reject'})
+		else:
+			regexRules.append({'prefix': 'P%03d-' % i, 'extract': '5:', 'addsuffix': '-X'})
+	regexRules.append({})
+	symbologyRules = [{'symbology': ['datamatrix', 'qr'], 'match': r'P%03d-.*' % i, 'addprefix': 'DM-'} if i % 2 else {'symbology': ['code128'], 'prefix': 'P%03d-' % i, 'action': 'reject'} for i in range(ruleCount - 1)] + [{}]
+	scannerRules = [dict(rule, scanner='bs' if i % 2 else 'ts') for i, rule in enumerate(regexRules[:-1])] + [{}]
+	return [('prefix (trie)', prefixRules), ('regex', regexRules), ('symbology', symbologyRules), ('per scanner', scannerRules)]
+
+# barcodes for every rule (and some which match none but the last), with and without AIM identifier
+def generateBarcodes(ruleCount, barcodeCount):
+	rng = random.Random(1)
+	barcodes = []
+	for i in range(barcodeCount):
+		rule = rng.randrange(ruleCount + ruleCount // 4)
+		barcode = 'P%03d-%06d-%s' % (rule, rng.randrange(1000000), rng.choice(('AB', 'XY', 'Q1')))
+		aim = rng.choice(('', ']d2', ']C0', ']Q3'))
+		barcodes.append((aim + barcode, rng.choice(list(SCANNERS.values()))))
+	return barcodes
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark barcode rule evaluation')
+	parser.add_argument('--rules', type=int, default=50)
+	parser.add_argument('--barcodes', type=int, default=100000)
+	parser.add_argument('--limit', type=float, default=0, help='exit with status 1 if any rule set takes longer than this many microseconds per barcode')
+	args = parser.parse_args()
+
+	barcodes = generateBarcodes(args.rules, args.barcodes)
+	slowest = 0
+	for name, definitions in generateRuleSets(args.rules):
+		start = time.perf_counter()
+		ruleSet = RuleSet(definitions, SCANNERS)
+		compileTime = time.perf_counter() - start
+		evaluate = ruleSet.evaluate
+		rejected = 0
+		start = time.perf_counter()
+		for barcode, scanner in barcodes:
+			rule, output = evaluate(barcode, scanner)
+			if rule is not None and rule.action == 'reject':
+				rejected += 1
+		elapsed = time.perf_counter() - start
+		perBarcode = elapsed / len(barcodes) * 1e6
+		slowest = max(slowest, perBarcode)
+		print('%-14s %d rules compiled in %.1f ms, %d barcodes in %.1f ms (%.2f us/barcode, %d rejected)' % (name + ':', ruleSet.count, compileTime * 1000, len(barcodes), elapsed * 1000, perBarcode, rejected))
+
+	if args.limit and slowest > args.limit:
+		print('FAIL: %.2f us/barcode is over the limit of %.2f us' % (slowest, args.limit))
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,71 @@
+# Benchmark the serial output transport (TimeManager) against a pty standing in for the inspection machine
+# reports barcodes per second and per-write latency
+# Usage: python benchmarks/bench_serial.py [--count 500] [--baud 9600] [--ack]
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from OmronVTInterfaceModule.ovtimfunctions import TimeManager
+
+# fake inspection machine: reads everything written to the pty and optionally answers each line with ACK
+def inspectionMachine(masterFd, ack, stop, received):
+	pending = b''
+	while not stop.is_set():
+		try:
+			data = os.read(masterFd, 4096)
+		except OSError:
+			return
+		pending += data
+		while b'\r\n' in pending:
+			line, pending = pending.split(b'\r\n', 1)
+			received.append(line)
+			if ack:
+				os.write(masterFd, b'\x06')
+
+def percentile(values, pct):
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the serial output transport against a pty')
+	parser.add_argument('--count', type=int, default=500, help='number of barcodes to send')
+	parser.add_argument('--baud', type=int, default=9600)
+	parser.add_argument('--ack', action='store_true', help='use request/ack mode')
+	args = parser.parse_args()
+
+	masterFd, slaveFd = os.openpty()
+	stop = threading.Event()
+	received = []
+	reader = threading.Thread(target=inspectionMachine, args=(masterFd, args.ack, stop, received), daemon=True)
+	reader.start()
+
+	tm = TimeManager(os.ttyname(slaveFd), baudrate=args.baud)
+	latencies = []
+	start = time.perf_counter()
+	for i in range(args.count):
+		barcode = ('BARCODE%08d\r\n' % i).encode('ascii')
+		t0 = time.perf_counter()
+		if args.ack:
+			tm.request(barcode)
+		else:
+			tm.send(barcode)
+		latencies.append(time.perf_counter() - t0)
+	elapsed = time.perf_counter() - start
+	deadline = time.time() + 2
+	while len(received) < args.count and time.time() < deadline:
+		time.sleep(0.01)
+	stop.set()
+	tm.close()
+
+	print('barcodes sent:     %d (received %d)' % (args.count, len(received)))
+	print('throughput:        %.1f barcodes/s' % (args.count / elapsed))
+	print('write latency p50: %.3f ms' % (percentile(latencies, 50) * 1000))
+	print('write latency p99: %.3f ms' % (percentile(latencies, 99) * 1000))
+	print('write latency max: %.3f ms' % (max(latencies) * 1000))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,104 @@
+# Benchmark of the time from starting the webapp (and the ingest daemon) to a line ready to pass barcodes on, without a browser
+# starts the real app in a subprocess with a profile store of its own whose active profile uses fake MicroHAWK scanners (TCP),
+# which send barcodes from the moment they are connected, and a fake inspection machine (pty)
+# (--serial makes the first scanner an rs232 scanner on a pty, see FakeSerialScanner)
+# reports the startup phases of every process (see ovtimstartup) and the time from the process start to the first barcode
+# received by the inspection machine
+# Usage: python benchmarks/bench_startup.py [--scanners 2] [--rounds 3] [--serial] [--ingest-daemon] [--limit 0]
+#	--ingest-daemon starts the ingest daemon (ingestMode 'daemon') first, which starts the scanners and the serial output itself
+#	--limit exits with status 1 if the median time to the first barcode is longer than this many seconds
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_e2e import freePort, httpGet, startApp, startDaemon, stopApp
+from fakedevices import FakeInspectionMachine, FakeScanner, FakeSerialScanner
+from OmronVTInterfaceModule.ovtimstore import ProfileStore
+
+# the active profile of the store uses the fake scanners (at most two, one per position)
+# (a config needs two profiles at least, the second one is a copy)
+def writeStore(path, scanners):
+	profile = {'profilename': 'Benchmark'}
+	for position, scanner in zip(('bs', 'ts'), scanners + [None]):
+		profile.update({position + 'model': 'Other Scanner', position + 'name': '', position + 'mac': '', position + 'commtype': 'ethernet', position + 'ip': '', position + 'port': ''})
+		if isinstance(scanner, FakeSerialScanner):
+			profile.update({position + 'name': scanner.name, position + 'commtype': 'rs232', position + 'port': scanner.port, position + 'baud': '9600', position + 'bytesize': '8', position + 'stopbit': '1', position + 'parity': 'N'})
+		elif scanner is not None:
+			profile.update({position + 'name': scanner.name, position + 'ip': scanner.ip, position + 'port': str(scanner.port)})
+	store = ProfileStore(path)
+	store.saveConfig({'main': {'activeProfile': 'Benchmark'}, 'profiles': [profile, dict(profile, profilename='Benchmark copy')]})
+	store.close()
+
+# returns dict: {'firstBarcode': seconds from starting the first process to the first barcode sent to the inspection machine, 'processes': /status/startup}
+def measure(scannerCount, serialScanner, ingestDaemon):
+	logDirectory = tempfile.mkdtemp(prefix='karlbox-bench-')
+	machine = FakeInspectionMachine()
+	machine.start()
+	scanners = [FakeSerialScanner('S1', rate=20) if serialScanner and i == 0 else FakeScanner('127.0.0.%d' % (i + 2), 'S%d' % (i + 1), rate=20) for i in range(scannerCount)]
+	for scanner in scanners:
+		scanner.go.set()
+		scanner.start()
+	storePath = os.path.join(logDirectory, 'karlboxconfig.db')
+	writeStore(storePath, scanners)
+	env = dict(os.environ, KARLBOX_OUTPUT_PORT=machine.port, KARLBOX_LOG_DIRECTORY=logDirectory, KARLBOX_STORE=storePath, KARLBOX_AUTOSTART='1', PYTHONPATH=ROOT)
+	port = freePort()
+	daemon = app = None
+	start = time.monotonic()
+	try:
+		if ingestDaemon:
+			env.update(KARLBOX_INGEST_MODE='daemon', KARLBOX_INGEST_SOCKET=os.path.join(logDirectory, 'ingest.sock'))
+			daemon = startDaemon(env)
+		app = startApp(port, env)
+		deadline = time.monotonic() + 30
+		while not machine.received:
+			if time.monotonic() > deadline:
+				raise RuntimeError('no barcode reached the inspection machine within 30 seconds')
+			time.sleep(0.01)
+		firstBarcode = min(machine.received.values()) - start
+		time.sleep(0.5) # the readiness of the line is polled
+		processes = json.loads(httpGet('http://127.0.0.1:%d/status/startup' % port))
+	finally:
+		for scanner in scanners:
+			scanner.stop()
+		if app:
+			stopApp(app)
+		if daemon:
+			stopApp(daemon)
+		machine.stop()
+		shutil.rmtree(logDirectory, ignore_errors=True)
+	return {'firstBarcode': firstBarcode, 'processes': processes}
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the start of the webapp up to a line ready to pass barcodes on')
+	parser.add_argument('--scanners', type=int, default=2, choices=(1, 2))
+	parser.add_argument('--rounds', type=int, default=3)
+	parser.add_argument('--serial', action='store_true', help='the first scanner is an rs232 scanner')
+	parser.add_argument('--ingest-daemon', action='store_true')
+	parser.add_argument('--limit', type=float, default=0, help='exit with status 1 if the median time to the first barcode is longer than this many seconds')
+	args = parser.parse_args()
+
+	results = [measure(args.scanners, args.serial, args.ingest_daemon) for i in range(args.rounds)]
+	results.sort(key=lambda x: x['firstBarcode'])
+	median = results[len(results) // 2]
+
+	print('%s scanner(s)%s, %s, median of %d rounds' % (args.scanners, ' (the first one rs232)' if args.serial else '', 'ingest daemon' if args.ingest_daemon else 'in process', args.rounds))
+	for process in median['processes']:
+		print('%s:' % process['process'])
+		for phase in process.get('phases', ()):
+			print('  %-36s %8.3f s' % (phase['phase'], phase['seconds']))
+	print('first barcode at the inspection machine: %.3f s after the start (rounds: %s)' % (median['firstBarcode'], ', '.join('%.3f' % x['firstBarcode'] for x in results)))
+
+	if args.limit and median['firstBarcode'] > args.limit:
+		print('FAIL: the first barcode took %.3f s, longer than %.3f s' % (median['firstBarcode'], args.limit))
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
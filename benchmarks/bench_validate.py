@@ -0,0 +1,65 @@
+# Benchmark profile validation over a generated library of profiles
+# reports validated profiles per second for the compiled validator and for a cold parse of the whole config
+# Usage: python benchmarks/bench_validate.py [--profiles 5000] [--positions 2]
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from OmronVTInterfaceModule import ovtimconfig
+from OmronVTInterfaceModule.ovtimfunctions import parseConfig
+from OmronVTInterfaceModule.ovtimvalidator import getValidator
+
+# generate a config with a mix of ethernet and rs232 scanners, some with invalid values
+def generateConfig(profileCount, positionCount):
+	positions = ['bs', 'ts'] + ['s' + str(i) for i in range(3, positionCount + 1)]
+	positions = positions[:positionCount]
+	profiles = []
+	for i in range(profileCount):
+		profile = {'profilename': 'Product line ' + str(i), 'positions': positions}
+		for j, position in enumerate(positions):
+			profile[position + 'model'] = ovtimconfig.possibleModelValues[(i + j) % len(ovtimconfig.possibleModelValues)]
+			profile[position + 'name'] = 'Scanner ' + str(j)
+			profile[position + 'mac'] = '00:0B:43:3A:%02X:%02X' % (i % 256, j)
+			if (i + j) % 3 == 0:
+				profile[position + 'commtype'] = 'rs232'
+				profile[position + 'port'] = '/dev/ttyUSB' + str(j)
+				profile[position + 'baud'] = 9600 if i % 7 else 1234
+				profile[position + 'bytesize'] = 8
+				profile[position + 'stopbit'] = 1
+				profile[position + 'parity'] = 'N'
+			else:
+				profile[position + 'commtype'] = 'ethernet'
+				profile[position + 'ip'] = '192.168.%d.%d' % (i % 250, j + 2) if i % 11 else 'not an ip'
+				profile[position + 'port'] = str(2001 + j)
+		profiles.append(profile)
+	return {'main': {'activeProfile': profiles[0]['profilename']}, 'profiles': profiles}, positions
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark profile validation')
+	parser.add_argument('--profiles', type=int, default=5000)
+	parser.add_argument('--positions', type=int, default=2)
+	args = parser.parse_args()
+
+	karlboxConfig, positions = generateConfig(args.profiles, args.positions)
+	logger = logging.getLogger('bench_validate')
+	logger.addHandler(logging.NullHandler())
+	logger.propagate = False
+
+	validator = getValidator(positions, ovtimconfig.possibleModelValues, ovtimconfig.possibleIniValues)
+	start = time.perf_counter()
+	for profile in karlboxConfig['profiles']:
+		validator.validate(logger, profile)
+	elapsed = time.perf_counter() - start
+	print('compiled validator: %d profiles x %d positions in %.1f ms (%.0f profiles/s, %.1f us/profile)' % (args.profiles, len(positions), elapsed * 1000, args.profiles / elapsed, elapsed / args.profiles * 1e6))
+
+	start = time.perf_counter()
+	parseConfig(logger, karlboxConfig, ovtimconfig.possibleIniValues, ovtimconfig.possibleModelValues)
+	elapsed = time.perf_counter() - start
+	print('parseConfig:        %d profiles in %.1f ms' % (args.profiles, elapsed * 1000))
+
+if __name__ == '__main__':
+	main()
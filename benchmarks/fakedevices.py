@@ -0,0 +1,197 @@
+# Simulated devices for the end-to-end benchmarks
+#	FakeScanner				TCP server speaking the MicroHAWK output protocol (one barcode per <CR><LF> terminated frame)
+#	FakeSerialScanner		pty standing in for an rs232 scanner's serial port, sending the same frames as FakeScanner
+#	FakeInspectionMachine	pty standing in for the inspection machine's serial port (/dev/ttyTHS2)
+# all of them record the time.monotonic() each barcode was sent or received, keyed by barcode
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import tty
+
+# sends rate barcodes per second in bursts of burst back-to-back frames to whoever connects
+# barcodes are unique: <name>-<sequence number>
+# disconnectAfter closes the connection after that many barcodes (0 keeps it open), the scanner then waits for the next connection
+# downtime simulates a reboot after each disconnect: connections are refused for that many seconds
+# outages records (time the connection was closed, time the app connected again) for every disconnect
+# Usage:
+#	scanner = FakeScanner('127.0.0.2', 'S1', rate=5)
+#	scanner.start()									(accepts connections, sends nothing yet)
+#	scanner.go.set()								(start sending)
+#	scanner.stop()
+class FakeScanner(object):
+	def __init__(self, ip, name, rate=1.0, burst=1, disconnectAfter=0, downtime=0):
+		self.ip = ip
+		self.name = name
+		self.rate = float(rate)
+		self.burst = max(1, int(burst))
+		self.disconnectAfter = int(disconnectAfter)
+		self.downtime = float(downtime)
+		self.port = 0
+		self.server = self._listen()
+		self.port = self.server.getsockname()[1]
+		self.outages = [] # (monotonic time the scanner closed the connection, time the app connected again or None)
+		self.sent = {} # barcode -> monotonic time it was written to the socket
+		self.connections = 0 # number of connections accepted
+		self.disconnects = 0 # number of times the scanner closed the connection itself
+		self.nextSeq = 1
+		self.go = threading.Event()
+		self.stopEvent = threading.Event()
+		self.thread = threading.Thread(target=self.run, name='FakeScanner-' + name, daemon=True)
+
+	def start(self):
+		self.thread.start()
+
+	def stop(self):
+		self.stopEvent.set()
+		self.go.set()
+		try:
+			self.server.close()
+		except OSError:
+			pass
+		self.thread.join(5)
+
+	def _listen(self):
+		server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		server.bind((self.ip, self.port))
+		server.listen(4)
+		return server
+
+	def run(self):
+		while not self.stopEvent.is_set():
+			try:
+				conn, addr = self.server.accept()
+			except OSError:
+				return
+			self.connections += 1
+			if self.outages and self.outages[-1][1] is None:
+				self.outages[-1] = (self.outages[-1][0], time.monotonic())
+			try:
+				self._serve(conn)
+			except OSError:
+				pass # the app closed the connection
+			finally:
+				conn.close()
+			if self.stopEvent.is_set():
+				return
+			self.outages.append((time.monotonic(), None))
+			if self.downtime:
+				self.server.close()
+				if self.stopEvent.wait(self.downtime):
+					return
+				self.server = self._listen()
+
+	def _serve(self, conn):
+		conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.go.wait()
+		interval = self.burst / self.rate
+		nextBurst = time.monotonic()
+		count = 0
+		while not self.stopEvent.is_set():
+			delay = nextBurst - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+			nextBurst += interval
+			for i in range(self.burst):
+				barcode = '%s-%08d' % (self.name, self.nextSeq)
+				self.nextSeq += 1
+				self.sent[barcode] = time.monotonic()
+				conn.sendall(barcode.encode('ascii') + b'\r\n')
+				count += 1
+				if self.disconnectAfter and count >= self.disconnectAfter:
+					self.disconnects += 1
+					return
+
+# writes rate barcodes per second (<name>-<sequence number>, <CR><LF> terminated) to the master side of a pty once go is set;
+# the app opens port like the serial port of an rs232 scanner: a tty<name> symlink to the slave side of the pty
+# (profiles only accept serial ports named like one, see ovtimvalidator.isValidSerialPort)
+# Usage:
+#	scanner = FakeSerialScanner('S1', rate=5)
+#	scanner.start()
+#	scanner.go.set()								(start sending)
+#	scanner.stop()
+class FakeSerialScanner(object):
+	def __init__(self, name, rate=1.0):
+		self.name = name
+		self.rate = float(rate)
+		self.masterFd, self.slaveFd = os.openpty()
+		tty.setraw(self.slaveFd) # no line discipline, like a real serial port
+		self.directory = tempfile.mkdtemp(prefix='karlbox-serial-')
+		self.port = os.path.join(self.directory, 'tty' + name)
+		os.symlink(os.ttyname(self.slaveFd), self.port)
+		self.sent = {} # barcode -> monotonic time it was written to the pty
+		self.nextSeq = 1
+		self.go = threading.Event()
+		self.stopEvent = threading.Event()
+		self.thread = threading.Thread(target=self.run, name='FakeSerialScanner-' + name, daemon=True)
+
+	def start(self):
+		self.thread.start()
+
+	def stop(self):
+		self.stopEvent.set()
+		self.go.set()
+		self.thread.join(5)
+		os.close(self.slaveFd)
+		os.close(self.masterFd)
+		shutil.rmtree(self.directory, ignore_errors=True)
+
+	def run(self):
+		self.go.wait()
+		interval = 1 / self.rate
+		nextBarcode = time.monotonic()
+		while not self.stopEvent.is_set():
+			delay = nextBarcode - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+			nextBarcode += interval
+			barcode = '%s-%08d' % (self.name, self.nextSeq)
+			self.nextSeq += 1
+			self.sent[barcode] = time.monotonic()
+			try:
+				os.write(self.masterFd, barcode.encode('ascii') + b'\r\n')
+			except OSError:
+				return
+
+# reads everything written to the pty and records each line, optionally answering it with ACK
+# Usage:
+#	machine = FakeInspectionMachine()
+#	machine.start()
+#	... run the app with KARLBOX_OUTPUT_PORT=machine.port ...
+#	machine.stop()
+class FakeInspectionMachine(object):
+	def __init__(self, ack=False):
+		self.ack = ack
+		self.masterFd, self.slaveFd = os.openpty()
+		self.port = os.ttyname(self.slaveFd)
+		self.received = {} # barcode -> monotonic time its line was complete
+		self.lines = 0
+		self.stopEvent = threading.Event()
+		self.thread = threading.Thread(target=self.run, name='FakeInspectionMachine', daemon=True)
+
+	def start(self):
+		self.thread.start()
+
+	def stop(self):
+		self.stopEvent.set()
+		os.close(self.slaveFd)
+		os.close(self.masterFd)
+
+	def run(self):
+		pending = b''
+		while not self.stopEvent.is_set():
+			try:
+				data = os.read(self.masterFd, 4096)
+			except OSError:
+				return
+			now = time.monotonic()
+			pending += data
+			while b'\r\n' in pending:
+				line, pending = pending.split(b'\r\n', 1)
+				self.lines += 1
+				self.received.setdefault(line.decode('ascii', errors='replace'), now)
+				if self.ack:
+					os.write(self.masterFd, b'\x06')
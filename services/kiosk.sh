@@ -14,6 +14,9 @@ echo "Entering While Loop" | systemd-cat -t kioskService -p info
 
 while true; do
  sleep 5
- rm -rf ~/.{config,cache}/chromium/
+ # keep chromium's cache (the webapp's assets are cached as immutable), only clear what makes it
+ # show the restore pages bar or refuse to start after the kiosk was switched off
+ sed -i 's/"exited_cleanly":false/"exited_cleanly":true/; s/"exit_type":"[^"]*"/"exit_type":"Normal"/' ~/.config/chromium/Default/Preferences 2>/dev/null
+ rm -f ~/.config/chromium/Singleton*
  chromium-browser '127.0.0.1:5000' --kiosk --password-store=basic --no-first-run --enable-logging=stderr --v=1 > ~/chromiumlog.txt 2>&1
 done
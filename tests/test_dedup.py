@@ -0,0 +1,70 @@
+import pytest
+
+from OmronVTInterfaceModule.ovtimdedup import DedupEngine
+
+def test_duplicate_within_window():
+	dedup = DedupEngine(5.0, 'barcode')
+	assert dedup.check('ABC123', 'a:2001', 100.0) is None
+	dedup.add('ABC123', 'a:2001', 1, 100.0)
+	assert dedup.check('ABC123', 'b:2001', 104.0) == ('a:2001', 1)
+	assert dedup.check('XYZ789', 'a:2001', 104.0) is None
+
+def test_expires_after_window():
+	dedup = DedupEngine(5.0, 'barcode')
+	dedup.add('ABC123', 'a:2001', 1, 100.0)
+	assert dedup.check('ABC123', 'a:2001', 105.0) is None
+	assert len(dedup) == 0
+
+def test_duplicate_restarts_window():
+	dedup = DedupEngine(5.0, 'barcode')
+	dedup.add('ABC123', 'a:2001', 1, 100.0)
+	assert dedup.check('ABC123', 'a:2001', 104.0) is not None
+	# the read at 104 started the window again, so the entry outlives its first heap item
+	assert dedup.check('ABC123', 'a:2001', 108.0) == ('a:2001', 1)
+	assert dedup.check('ABC123', 'a:2001', 113.5) is None
+
+def test_expiry_order_with_restarted_windows():
+	dedup = DedupEngine(5.0, 'barcode')
+	dedup.add('A', 's', 1, 100.0)
+	dedup.add('B', 's', 2, 101.0)
+	dedup.check('A', 's', 102.0) # A now expires at 107, after B
+	assert dedup.check('C', 's', 106.5) is None
+	assert set(dedup.entries) == {'A'}
+	assert len(dedup.expiries) == 1
+
+def test_key_per_scanner():
+	dedup = DedupEngine(5.0, 'barcode+scanner')
+	dedup.add('ABC123', 'a:2001', 1, 100.0)
+	assert dedup.check('ABC123', 'b:2001', 101.0) is None
+	assert dedup.check('ABC123', 'a:2001', 101.0) == ('a:2001', 1)
+
+def test_disabled_without_window():
+	dedup = DedupEngine(0)
+	dedup.add('ABC123', 'a:2001', 1, 100.0)
+	assert dedup.check('ABC123', 'a:2001', 100.0) is None
+	assert len(dedup) == 0
+
+def test_max_entries_forgets_first_expiring():
+	dedup = DedupEngine(60.0, 'barcode', maxEntries=3)
+	for i in range(5):
+		dedup.add('B%d' % i, 's', i, 100.0 + i)
+	assert len(dedup) == 3
+	assert len(dedup.expiries) == 3
+	assert dedup.evicted == 2
+	assert set(dedup.entries) == {'B2', 'B3', 'B4'}
+
+def test_unknown_key_mode():
+	with pytest.raises(ValueError):
+		DedupEngine(5.0, 'scanner')
+
+def test_restarted_windows_keep_the_fifo_bounded():
+	dedup = DedupEngine(5.0, 'barcode', maxEntries=10)
+	for i in range(10):
+		dedup.add('B%d' % i, 's', i, 100.0)
+	for step in range(1000):
+		assert dedup.check('B%d' % (step % 10), 's', 100.0 + step * 0.001) is not None
+	assert len(dedup) == 10
+	assert len(dedup.expiries) <= 2 * len(dedup) + 16
+	# every entry expires window seconds after its last read
+	assert dedup.check('B9', 's', 100.999 + 4.99) is not None
+	assert dedup.check('B0', 's', 100.99 + 5.0) is None
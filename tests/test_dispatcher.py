@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+
+from OmronVTInterfaceModule.ovtimoutput import BarcodeDispatcher
+
+logger = logging.getLogger('test_dispatcher')
+
+def spawnThread(function):
+	thread = threading.Thread(target=function, daemon=True)
+	thread.start()
+	return thread
+
+def waitFor(predicate, timeout=5):
+	deadline = time.monotonic() + timeout
+	while not predicate():
+		assert time.monotonic() < deadline, 'timed out'
+		time.sleep(0.005)
+
+# send function which blocks until released, like a wedged serial port
+class WedgedSink(object):
+	def __init__(self):
+		self.sent = []
+		self.release = threading.Event()
+		self.sending = threading.Event()
+
+	def send(self, barcode, isResend):
+		self.sending.set()
+		self.release.wait(10)
+		self.sent.append(barcode)
+
+def startWedged(dispatcher):
+	sink = WedgedSink()
+	dispatcher.start(spawnThread, sink.send)
+	dispatcher.put('B0')
+	assert sink.sending.wait(5) # the worker holds B0 and waits in send()
+	return sink
+
+def test_drop_oldest_when_full():
+	dispatcher = BarcodeDispatcher(logger, maxQueued=3, backpressure='drop')
+	for i in range(5):
+		dispatcher.put('B%d' % i)
+	assert [barcode for barcode, readTime in dispatcher.queue] == ['B2', 'B3', 'B4']
+	assert dispatcher.droppedCount == 2
+
+def test_sends_in_order():
+	sent = []
+	dispatcher = BarcodeDispatcher(logger, maxQueued=8)
+	dispatcher.start(spawnThread, lambda barcode, isResend: sent.append(barcode))
+	for i in range(5):
+		dispatcher.put('B%d' % i)
+	waitFor(lambda: len(sent) == 5)
+	dispatcher.stop()
+	assert sent == ['B0', 'B1', 'B2', 'B3', 'B4']
+	assert dispatcher.getStats()['sent'] == 5
+
+def test_block_never_waits_in_put():
+	dispatcher = BarcodeDispatcher(logger, maxQueued=2, backpressure='block', blockTimeout=60)
+	sink = startWedged(dispatcher)
+	start = time.monotonic()
+	for i in range(1, 5):
+		dispatcher.put('B%d' % i)
+	assert time.monotonic() - start < 0.5
+	stats = dispatcher.getStats()
+	assert (stats['queued'], stats['waiting'], stats['dropped'], stats['blocked']) == (2, 2, 0, 2)
+	# once the sink recovers within blockTimeout nothing is lost
+	sink.release.set()
+	waitFor(lambda: len(sink.sent) == 5)
+	dispatcher.stop()
+	assert sink.sent == ['B0', 'B1', 'B2', 'B3', 'B4']
+	assert dispatcher.droppedCount == 0
+
+def test_block_drops_oldest_after_timeout():
+	dispatcher = BarcodeDispatcher(logger, maxQueued=2, backpressure='block', blockTimeout=0.05)
+	sink = startWedged(dispatcher)
+	for i in range(1, 4):
+		dispatcher.put('B%d' % i)
+	assert dispatcher.getStats()['waiting'] == 1
+	time.sleep(0.1)
+	dispatcher.put('B4') # B3 waited blockTimeout, so it takes the place of B1; B4 waits in turn
+	assert [barcode for barcode, readTime in dispatcher.queue] == ['B2', 'B3']
+	assert dispatcher.droppedCount == 1
+	assert dispatcher.getStats()['waiting'] == 1
+	sink.release.set()
+	waitFor(lambda: len(sink.sent) == 4)
+	dispatcher.stop()
+	assert sink.sent == ['B0', 'B2', 'B3', 'B4']
+
+def test_block_overflow_is_bounded():
+	dispatcher = BarcodeDispatcher(logger, maxQueued=2, backpressure='block', blockTimeout=60)
+	sink = startWedged(dispatcher)
+	for i in range(1, 11):
+		dispatcher.put('B%d' % i)
+	stats = dispatcher.getStats()
+	assert stats['queued'] == 2
+	assert stats['waiting'] <= 2
+	assert stats['dropped'] == 10 - stats['queued'] - stats['waiting']
+	dispatcher.stop()
+	sink.release.set()
+	assert dispatcher.getStats()['waiting'] == 0
+
+def test_block_before_start_drops_like_drop():
+	dispatcher = BarcodeDispatcher(logger, maxQueued=2, backpressure='block')
+	for i in range(4):
+		dispatcher.put('B%d' % i)
+	assert [barcode for barcode, readTime in dispatcher.queue] == ['B2', 'B3']
+	assert dispatcher.getStats()['waiting'] == 0
@@ -0,0 +1,85 @@
+import pytest
+
+from OmronVTInterfaceModule.ovtimframing import FrameReader, parseFraming
+
+# feeds data in pieces of size bytes and returns every frame read
+def feedInPieces(reader, data, size):
+	frames = []
+	for i in range(0, len(data), size):
+		reader.feed(data[i:i + size])
+		frames.extend(reader.frames())
+	return frames
+
+def test_parse_framing():
+	assert parseFraming('') == ('crlf', 0)
+	assert parseFraming(' CRLF ') == ('crlf', 0)
+	assert parseFraming('stxetx') == ('stxetx', 0)
+	assert parseFraming('fixed:12') == ('fixed', 12)
+	for spec in ('fixed:0', 'fixed:x', 'lf'):
+		with pytest.raises(ValueError):
+			parseFraming(spec)
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 100])
+def test_crlf_split_across_reads(size):
+	reader = FrameReader('crlf')
+	assert feedInPieces(reader, b'ABC123\r\nDEF456\r\n\r\nGHI', size) == [b'ABC123', b'DEF456']
+	reader.feed(b'789\r\n')
+	assert reader.frames() == [b'GHI789']
+
+@pytest.mark.parametrize('size', [1, 2, 5, 100])
+def test_stxetx_split_across_reads(size):
+	reader = FrameReader('stxetx')
+	assert feedInPieces(reader, b'noise\x02ABC123\x03\r\n\x02DEF456\x03\x02GH', size) == [b'ABC123', b'DEF456']
+	reader.feed(b'I\x03')
+	assert reader.frames() == [b'GHI']
+
+@pytest.mark.parametrize('size', [1, 4, 5, 11])
+def test_fixed_split_across_reads(size):
+	reader = FrameReader('fixed:5')
+	assert feedInPieces(reader, b'AAAAABBBBBCC', size) == [b'AAAAA', b'BBBBB']
+	reader.feed(b'CCC')
+	assert reader.frames() == [b'CCCCC']
+
+def test_fixed_frame_longer_than_buffer():
+	reader = FrameReader('fixed:32', bufferSize=16)
+	reader.feed(b'A' * 32 + b'B' * 32)
+	assert reader.frames() == [b'A' * 32, b'B' * 32]
+
+@pytest.mark.parametrize('framing, data, expected', [
+	('crlf', b''.join(b'BC%04d\r\n' % i for i in range(20)), [b'BC%04d' % i for i in range(20)]),
+	('stxetx', b''.join(b'\x02BC%04d\x03' % i for i in range(20)), [b'BC%04d' % i for i in range(20)]),
+	('fixed:6', b''.join(b'BC%04d' % i for i in range(20)), [b'BC%04d' % i for i in range(20)]),
+])
+def test_feed_larger_than_buffer_keeps_frames(framing, data, expected):
+	reader = FrameReader(framing, bufferSize=16)
+	reader.feed(data)
+	assert reader.frames() == expected
+	assert reader.overflows == 0
+
+def test_oversized_frame_is_discarded():
+	reader = FrameReader('crlf', bufferSize=16)
+	reader.feed(b'OK1\r\n' + b'X' * 40)
+	assert reader.frames() == [b'OK1']
+	reader.feed(b'XXXX\r\nOK2\r\n')
+	assert reader.frames() == [b'OK2']
+	assert reader.overflows == 1
+
+@pytest.mark.parametrize('size', [1, 3, 16, 100])
+def test_oversized_frame_split_across_reads(size):
+	reader = FrameReader('crlf', bufferSize=16)
+	assert feedInPieces(reader, b'OK1\r\n' + b'X' * 40 + b'\r\nOK2\r\n', size) == [b'OK1', b'OK2']
+
+def test_terminator_straddling_a_full_buffer():
+	reader = FrameReader('crlf', bufferSize=16)
+	reader.feed(b'A' * 15 + b'\r')
+	assert reader.frames() == []
+	reader.feed(b'\nB\r\n')
+	assert reader.frames() == [b'B']
+	assert reader.overflows == 1
+
+def test_reset_drops_buffered_data():
+	reader = FrameReader('crlf', bufferSize=8)
+	reader.feed(b'A\r\nBBBBBBBBBB')
+	reader.reset()
+	reader.feed(b'C\r\n')
+	assert reader.frames() == [b'C']
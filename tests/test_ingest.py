@@ -0,0 +1,48 @@
+import logging
+import socket
+import threading
+import time
+
+from OmronVTInterfaceModule.ovtimingest import IngestEngine
+
+logger = logging.getLogger('test_ingest')
+
+def spawnThread(function):
+	thread = threading.Thread(target=function, daemon=True)
+	thread.start()
+	return thread
+
+def waitFor(predicate, timeout=5):
+	deadline = time.monotonic() + timeout
+	while not predicate():
+		assert time.monotonic() < deadline, 'timed out'
+		time.sleep(0.005)
+
+def test_callback_and_command_errors_do_not_stop_the_loop():
+	server = socket.socket()
+	server.bind(('127.0.0.1', 0))
+	server.listen(1)
+	port = server.getsockname()[1]
+	frames = []
+	events = []
+	def onFrame(conn, frame):
+		if frame == b'BAD':
+			raise RuntimeError('pipeline failed')
+		frames.append(frame)
+	def onEvent(conn, event, detail):
+		events.append(event)
+		raise RuntimeError('notification failed')
+	engine = IngestEngine(onFrame, onEvent, logger)
+	engine.start(spawnThread)
+	try:
+		engine.addScanner('127.0.0.1', port, 'nonsense') # raises inside the loop
+		engine.addScanner('127.0.0.1', port)
+		client, address = server.accept()
+		client.sendall(b'BAD\r\nGOOD\r\n')
+		waitFor(lambda: frames == [b'GOOD'])
+		assert events == ['connected']
+		assert engine.running
+		client.close()
+	finally:
+		engine.stop()
+		server.close()
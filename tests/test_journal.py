@@ -0,0 +1,94 @@
+import os
+import time
+
+import pytest
+
+from OmronVTInterfaceModule.ovtimjournal import FLAG_DUPLICATE, FLAG_REJECTED, BarcodeJournal, flagNames, parseTime
+
+DAY_NS = 86400 * 10 ** 9
+
+def segmentFiles(directory):
+	return sorted(name for name in os.listdir(directory) if name.endswith('.rec'))
+
+def barcodes(entries):
+	return [entry['barcode'] for entry in entries]
+
+def test_append_and_query(tmp_path):
+	journal = BarcodeJournal(str(tmp_path))
+	journal.append('ABC123', '192.168.188.2:2001', wallNs=1000, monoNs=10)
+	journal.append('DEF456', '192.168.188.3:2001', FLAG_DUPLICATE, wallNs=2000, monoNs=20)
+	journal.append('GHI789', '192.168.188.2:2002', wallNs=3000, monoNs=30)
+	entries = list(journal.query(0, 10000))
+	assert entries[1] == {'wall': 2000, 'mono': 20, 'scanner': '192.168.188.3:2001', 'flags': FLAG_DUPLICATE, 'barcode': 'DEF456'}
+	assert barcodes(entries) == ['ABC123', 'DEF456', 'GHI789']
+	assert barcodes(journal.query(2000, 3000)) == ['DEF456']
+	assert barcodes(journal.query(0, 10000, limit=2)) == ['ABC123', 'DEF456']
+	assert barcodes(journal.query(0, 10000, scanner='192.168.188.2:2002')) == ['GHI789']
+	assert barcodes(journal.query(0, 10000, scanner='192.168.188.2')) == ['ABC123', 'GHI789']
+	assert list(journal.query(0, 10000, scanner='10.0.0.1')) == []
+	journal.close()
+
+def test_roll_into_new_segments(tmp_path):
+	journal = BarcodeJournal(str(tmp_path), segmentCapacity=4, retentionDays=0)
+	for i in range(10):
+		journal.append('B%d' % i, 's:1', wallNs=1000 + i)
+	assert len(segmentFiles(str(tmp_path))) == 3
+	assert barcodes(journal.query(0, 10 ** 6)) == ['B%d' % i for i in range(10)]
+	assert barcodes(journal.query(1003, 1006)) == ['B3', 'B4', 'B5']
+	journal.close()
+	# a reopened journal appends to its newest segment
+	journal = BarcodeJournal(str(tmp_path), segmentCapacity=4, retentionDays=0)
+	journal.append('B10', 's:1', wallNs=1010)
+	assert len(segmentFiles(str(tmp_path))) == 3
+	assert barcodes(journal.query(1009, 10 ** 6)) == ['B9', 'B10']
+	journal.close()
+
+def test_query_when_wall_clock_stepped_back(tmp_path):
+	journal = BarcodeJournal(str(tmp_path))
+	for i, wallNs in enumerate((5000, 6000, 4000, 7000)):
+		journal.append('B%d' % i, 's:1', wallNs=wallNs)
+	assert barcodes(journal.query(4500, 6500)) == ['B0', 'B1']
+	assert barcodes(journal.query(3000, 4500)) == ['B2']
+	journal.close()
+
+def test_retention_removes_old_segments(tmp_path):
+	now = time.time_ns()
+	journal = BarcodeJournal(str(tmp_path), segmentCapacity=2, retentionDays=1)
+	for i in range(4):
+		journal.append('OLD%d' % i, 's:1', wallNs=now - 3 * DAY_NS + i)
+	journal.append('NEW0', 's:1', wallNs=now)
+	journal.append('NEW1', 's:1', wallNs=now + 1)
+	journal.append('NEW2', 's:1', wallNs=now + 2)
+	assert segmentFiles(str(tmp_path)) == ['segment-00000003.rec', 'segment-00000004.rec']
+	assert not any(name.startswith(('segment-00000001', 'segment-00000002')) for name in os.listdir(str(tmp_path)))
+	assert barcodes(journal.query(0, now + DAY_NS)) == ['NEW0', 'NEW1', 'NEW2']
+	journal.close()
+
+def test_read_only_journal_follows_the_writer(tmp_path):
+	writer = BarcodeJournal(str(tmp_path), segmentCapacity=2, retentionDays=0)
+	reader = BarcodeJournal(str(tmp_path), readOnly=True)
+	writer.append('A', 's:1', wallNs=1000)
+	assert [(entry['scanner'], entry['barcode']) for entry in reader.query(0, 10000)] == [('s:1', 'A')]
+	writer.append('B', 's:2', wallNs=2000)
+	writer.append('C', 's:2', wallNs=3000)
+	assert barcodes(reader.query(0, 10000, scanner='s:2')) == ['B', 'C']
+	with pytest.raises(ValueError):
+		reader.append('D', 's:1')
+	writer.close()
+
+def test_query_skips_segment_missing_its_heap(tmp_path):
+	journal = BarcodeJournal(str(tmp_path), segmentCapacity=2, retentionDays=0)
+	for i in range(4):
+		journal.append('B%d' % i, 's:1', wallNs=1000 + i)
+	os.remove(os.path.join(str(tmp_path), 'segment-00000001.heap'))
+	assert barcodes(journal.query(0, 10000)) == ['B2', 'B3']
+	journal.close()
+
+def test_flag_names_and_parse_time():
+	assert flagNames(FLAG_DUPLICATE | FLAG_REJECTED) == ['duplicate', 'rejected']
+	assert flagNames(0) == []
+	assert parseTime('1760364000.5') == 1760364000500000000
+	assert parseTime('2026-10-13T14:00:00') == int(time.mktime((2026, 10, 13, 14, 0, 0, 0, 0, -1)) * 1e9)
+	for value in ('yesterday', 'inf', '-inf', 'nan', '1e300'):
+		with pytest.raises(ValueError):
+			parseTime(value)